@@ -64,12 +64,22 @@ def load_user(user_id):
     from models import User
     return User.query.get(user_id)
 
+# Metriche delle richieste HTTP e delle query al database (esposte su /metrics)
+from services.metrics import init_metrics
+init_metrics(app)
+
 # Create database tables if they don't exist
 with app.app_context():
     # Import models before creating tables
-    from models import User, Category, Company, Template, Request, Setting
+    from models import User, Category, Company, Template, Request, Setting, GenerationJob, GenerationLength, OutboxMessage
     db.create_all()
     
+    # create_all non modifica le tabelle esistenti: colonne aggiunte in seguito
+    from sqlalchemy import inspect, text
+    if 'priority' not in {column['name'] for column in inspect(db.engine).get_columns('generation_job')}:
+        db.session.execute(text("ALTER TABLE generation_job ADD COLUMN priority VARCHAR(20) DEFAULT 'interactive'"))
+        db.session.commit()
+    
     # Inizializza le impostazioni predefinite nel database
     from services.settings_service import init_default_settings
     init_default_settings()
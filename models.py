@@ -84,7 +84,7 @@ class Request(db.Model):
     subject = db.Column(db.String(255), nullable=False)
     message = db.Column(db.Text, nullable=False)
     date_sent = db.Column(db.DateTime, default=datetime.utcnow)
-    status = db.Column(db.String(50), default='pending')  # pending, delivered, failed
+    status = db.Column(db.String(50), default='pending')  # pending, queued, delivered, failed
     opened = db.Column(db.Boolean, default=False)
     date_opened = db.Column(db.DateTime, nullable=True)
     responded = db.Column(db.Boolean, default=False)
@@ -111,6 +111,114 @@ class Request(db.Model):
             'opened_count': self.opened_count
         }
 
+class GenerationJob(db.Model):
+    """Job di generazione asincrona di una richiesta di recensione."""
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    company_id = db.Column(db.String(36), db.ForeignKey('company.id'), nullable=False)
+    template_id = db.Column(db.String(36), db.ForeignKey('template.id'), nullable=False)
+    user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=True)
+    status = db.Column(db.String(20), default='queued', index=True)  # queued, running, completed, failed
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, default=0)
+    max_attempts = db.Column(db.Integer, default=3)
+    priority = db.Column(db.String(20), default='interactive')  # interactive, batch, prewarm (vedi llm_scheduler)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+    
+    # Relazioni
+    company = db.relationship('Company', lazy=True)
+    template = db.relationship('Template', lazy=True)
+    
+    def to_dict(self):
+        """Converte l'oggetto in un dizionario."""
+        return {
+            'id': self.id,
+            'company_id': self.company_id,
+            'company_name': self.company.name if self.company else None,
+            'template_id': self.template_id,
+            'template_name': self.template.name if self.template else None,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'priority': self.priority,
+            'run_after': self.run_after.isoformat() if self.run_after else None,
+            'locked_by': self.locked_by,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
+        }
+
+class OutboxMessage(db.Model):
+    """Email da inviare per una richiesta accodata (outbox transazionale)."""
+    __table_args__ = (
+        db.Index('ix_outbox_message_ready', 'status', 'next_attempt_at'),
+    )
+    
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    request_id = db.Column(db.String(36), db.ForeignKey('request.id'), nullable=False, unique=True)
+    recipient = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    max_attempts = db.Column(db.Integer, default=5)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(100), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    
+    # Relazioni
+    request = db.relationship('Request', backref=db.backref('outbox', uselist=False), lazy=True)
+    
+    def to_dict(self):
+        """Converte l'oggetto in un dizionario."""
+        return {
+            'id': self.id,
+            'request_id': self.request_id,
+            'recipient': self.recipient,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'claimed_by': self.claimed_by,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None
+        }
+
+class GenerationLength(db.Model):
+    """Lunghezza richiesta e ottenuta di una generazione, per adattare max_length."""
+    id = db.Column(db.Integer, primary_key=True)
+    # Nessuna chiave esterna: i campioni restano validi per la categoria anche se il template viene eliminato
+    template_id = db.Column(db.String(36), nullable=True, index=True)
+    category_id = db.Column(db.String(36), nullable=True, index=True)
+    mode = db.Column(db.String(20), nullable=False)  # sync, stream, variants
+    requested_tokens = db.Column(db.Integer, nullable=False)
+    output_tokens = db.Column(db.Integer, nullable=False)
+    truncated = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def to_dict(self):
+        """Converte l'oggetto in un dizionario."""
+        return {
+            'id': self.id,
+            'template_id': self.template_id,
+            'category_id': self.category_id,
+            'mode': self.mode,
+            'requested_tokens': self.requested_tokens,
+            'output_tokens': self.output_tokens,
+            'truncated': self.truncated,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
 class User(UserMixin, db.Model):
     """Utente del sistema."""
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
@@ -1,16 +1,24 @@
 import os
 import logging
-import datetime
 import json
-from flask import render_template, request, redirect, url_for, flash, jsonify, session
+from flask import render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context
 from app import app, db
 from models import Category, Company, Template, Request, Setting, User
 from flask_login import login_user, logout_user, current_user, login_required
 from urllib.parse import urlparse
 from forms import RegistrationForm, LoginForm, EmailSettingsForm
-from services.ai_service import generate_review_request
-from services.email_service import send_email
+from services.ai_service import generate_review_request, generate_review_variants, generate_review_requests_batch, stream_review_request, ai_cache, invalidate_cached_requests
+from services.campaign_service import enqueue_campaign, MAX_CAMPAIGN_SIZE
+from services.outbox_service import enqueue_email, get_campaign_progress
 from services.kobold_api import kobold_client
+from services.health_monitor import kobold_health_monitor
+from services.settings_service import get_generation_concurrency
+from services.prewarm_service import prewarm_queue, prewarm_for_company, prewarm_for_template
+from services.template_engine import template_engine
+from services.length_service import length_predictor
+from services.metrics import metrics
+from services.job_service import enqueue_generation_job, get_job, get_queue_stats, get_recent_jobs, JOB_STATUSES
+from services.llm_scheduler import PRIORITIES, PRIORITY_INTERACTIVE
 
 # Routes di autenticazione
 @app.route('/login', methods=['GET', 'POST'])
@@ -103,6 +111,7 @@ def add_company_route():
         
         db.session.add(company)
         db.session.commit()
+        prewarm_for_company(company)
         flash('Azienda aggiunta con successo', 'success')
     
     return redirect(url_for('companies'))
@@ -134,6 +143,8 @@ def edit_company(company_id):
         company.products = products or ""
         
         db.session.commit()
+        invalidate_cached_requests(company_id=company.id)
+        prewarm_for_company(company)
         flash('Azienda aggiornata con successo', 'success')
     
     return redirect(url_for('companies'))
@@ -145,6 +156,7 @@ def delete_company_route(company_id):
     if company:
         db.session.delete(company)
         db.session.commit()
+        invalidate_cached_requests(company_id=company_id)
         flash('Azienda eliminata con successo', 'success')
     else:
         flash('Azienda non trovata', 'danger')
@@ -184,6 +196,7 @@ def add_template_route():
         
         db.session.add(template)
         db.session.commit()
+        prewarm_for_template(template)
         flash('Template aggiunto con successo', 'success')
     
     return redirect(url_for('templates'))
@@ -211,6 +224,8 @@ def edit_template(template_id):
         template.content = content
         
         db.session.commit()
+        invalidate_cached_requests(template_id=template.id)
+        prewarm_for_template(template)
         flash('Template aggiornato con successo', 'success')
     
     return redirect(url_for('templates'))
@@ -222,6 +237,7 @@ def delete_template_route(template_id):
     if template:
         db.session.delete(template)
         db.session.commit()
+        invalidate_cached_requests(template_id=template_id)
         flash('Template eliminato con successo', 'success')
     else:
         flash('Template non trovato', 'danger')
@@ -234,13 +250,19 @@ def dashboard():
     templates_data = Template.query.all()
     categories = Category.query.all()
     requests_data = Request.query.all()
+    settings_data = Setting.get_settings_dict()
+    
+    # L'identificativo serve già alla prima generazione, anche se parte prima che
+    # un'altra risposta abbia impostato il cookie di sessione
+    _generation_owner()
     
     return render_template(
         'dashboard.html', 
         companies=[c.to_dict() for c in companies_data], 
         templates=[t.to_dict() for t in templates_data], 
         categories=[c.to_dict() for c in categories],
-        requests=[r.to_dict() for r in requests_data]
+        requests=[r.to_dict() for r in requests_data],
+        use_job_queue=settings_data.get('use_job_queue', False)
     )
 
 @app.route('/reports')
@@ -282,7 +304,19 @@ def reports():
                 'responded': cat_responded
             }
     
-    return render_template('reports.html', requests=requests_list, stats=stats, category_stats=category_stats)
+    return render_template('reports.html', requests=requests_list, stats=stats, category_stats=category_stats,
+                          length_report=length_predictor.report())
+
+def _generation_owner():
+    """
+    Identifica il browser che chiede una generazione interattiva.
+    
+    L'identificativo è salvato nella sessione: una nuova generazione dallo stesso
+    browser annulla quella precedente ancora in corso.
+    """
+    if 'generation_owner' not in session:
+        session['generation_owner'] = os.urandom(8).hex()
+    return session['generation_owner']
 
 @app.route('/generate_request', methods=['POST'])
 def generate_request_route():
@@ -301,7 +335,7 @@ def generate_request_route():
     
     try:
         # Generate the request using AI
-        ai_generated_request = generate_review_request(company.to_dict(), template.to_dict())
+        ai_generated_request = generate_review_request(company.to_dict(), template.to_dict(), owner=_generation_owner())
         
         return jsonify({
             'message': ai_generated_request,
@@ -311,6 +345,183 @@ def generate_request_route():
         logging.error(f"Error generating request: {str(e)}")
         return jsonify({'error': f'Errore durante la generazione della richiesta: {str(e)}'}), 500
 
+@app.route('/generate_request/variants', methods=['POST'])
+def generate_request_variants_route():
+    """Genera più varianti della richiesta con una sola chiamata al modello."""
+    data = request.json or {}
+    company_id = data.get('company_id')
+    template_id = data.get('template_id')
+    
+    if not company_id or not template_id:
+        return jsonify({'error': 'Dati mancanti'}), 400
+    
+    try:
+        count = int(data.get('count', 3))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Numero di varianti non valido'}), 400
+    
+    company = Company.query.get(company_id)
+    template = Template.query.get(template_id)
+    
+    if not company or not template:
+        return jsonify({'error': 'Azienda o template non trovato'}), 404
+    
+    try:
+        result = generate_review_variants(company.to_dict(), template.to_dict(), count=count, owner=_generation_owner())
+        
+        return jsonify({
+            'variants': result['variants'],
+            'source': result['source'],
+            'company': company.to_dict()
+        })
+    except Exception as e:
+        logging.error(f"Error generating request variants: {str(e)}")
+        return jsonify({'error': f'Errore durante la generazione delle varianti: {str(e)}'}), 500
+
+@app.route('/generate_request/stream')
+def generate_request_stream_route():
+    """Genera una richiesta inviando i token al browser tramite Server-Sent Events."""
+    company_id = request.args.get('company_id')
+    template_id = request.args.get('template_id')
+    
+    if not company_id or not template_id:
+        return jsonify({'error': 'Dati mancanti'}), 400
+    
+    company = Company.query.get(company_id)
+    template = Template.query.get(template_id)
+    
+    if not company or not template:
+        return jsonify({'error': 'Azienda o template non trovato'}), 404
+    
+    company_data = company.to_dict()
+    template_data = template.to_dict()
+    events = stream_review_request(company_data, template_data, owner=_generation_owner())
+    
+    def generate():
+        try:
+            for event in events:
+                if event['type'] == 'done':
+                    event['company'] = company_data
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            logging.error(f"Error streaming request: {str(e)}")
+            error_event = {'type': 'error', 'error': f'Errore durante la generazione della richiesta: {str(e)}'}
+            yield f"event: error\ndata: {json.dumps(error_event, ensure_ascii=False)}\n\n"
+        finally:
+            # Client disconnesso: chiude la generazione, che viene interrotta anche su Kobold
+            events.close()
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Disabilita il buffering dei reverse proxy (es. nginx) per inoltrare subito i token
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/generate_requests_batch', methods=['POST'])
+def generate_requests_batch_route():
+    """Genera richieste per più aziende in parallelo, restituendo i risultati in streaming (NDJSON)."""
+    data = request.json or {}
+    template_id = data.get('template_id')
+    company_ids = data.get('company_ids')
+    category_id = data.get('category_id')
+    
+    if not template_id or not (company_ids or category_id):
+        return jsonify({'error': 'Dati mancanti: specificare un template e una lista o un filtro di aziende'}), 400
+    
+    template = Template.query.get(template_id)
+    if not template:
+        return jsonify({'error': 'Template non trovato'}), 404
+    
+    query = Company.query
+    if company_ids:
+        query = query.filter(Company.id.in_(company_ids))
+    if category_id:
+        query = query.filter_by(category_id=category_id)
+    
+    companies_data = [c.to_dict() for c in query.all()]
+    if not companies_data:
+        return jsonify({'error': 'Nessuna azienda trovata'}), 404
+    
+    # La concorrenza richiesta non può superare quella configurata per il server Kobold
+    max_workers = get_generation_concurrency()
+    try:
+        if data.get('concurrency'):
+            max_workers = max(1, min(int(data['concurrency']), max_workers))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Valore di concorrenza non valido'}), 400
+    
+    # "cluster": un solo testo per gruppo di aziende con stessa categoria e stessi prodotti
+    mode = data.get('mode', 'company')
+    if mode not in ('company', 'cluster'):
+        return jsonify({'error': 'Modalità non valida: usare "company" o "cluster"'}), 400
+    
+    template_data = template.to_dict()
+    owner = _generation_owner()
+    logging.info(f"Generazione batch per {len(companies_data)} aziende con {max_workers} worker")
+    
+    def generate():
+        for result in generate_review_requests_batch(companies_data, template_data, max_workers, owner=owner,
+                                                      clustered=mode == 'cluster'):
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/jobs/generate', methods=['POST'])
+def enqueue_generation_job_route():
+    """Accoda la generazione di una richiesta e restituisce subito l'ID del job."""
+    data = request.json or {}
+    company_id = data.get('company_id')
+    template_id = data.get('template_id')
+    # Le richieste della dashboard sono interattive; un client può accodare lavoro batch
+    priority = data.get('priority') or PRIORITY_INTERACTIVE
+    
+    if not company_id or not template_id:
+        return jsonify({'error': 'Dati mancanti'}), 400
+    if priority not in PRIORITIES:
+        return jsonify({'error': f'Priorità non valida: usare {", ".join(PRIORITIES)}'}), 400
+    
+    if not Company.query.get(company_id) or not Template.query.get(template_id):
+        return jsonify({'error': 'Azienda o template non trovato'}), 404
+    
+    try:
+        user_id = current_user.id if current_user.is_authenticated else None
+        job = enqueue_generation_job(company_id, template_id, user_id=user_id, priority=priority)
+    except Exception as e:
+        logging.error(f"Error enqueuing generation job: {str(e)}")
+        db.session.rollback()
+        return jsonify({'error': f'Errore durante l\'accodamento della richiesta: {str(e)}'}), 500
+    
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('generation_job_status', job_id=job.id)
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def generation_job_status(job_id):
+    """Restituisce lo stato di un job di generazione (e il risultato, se completato)."""
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job non trovato'}), 404
+    
+    job_data = job.to_dict()
+    if job.status == 'completed' and job.company:
+        job_data['company'] = job.company.to_dict()
+    return jsonify(job_data)
+
+@app.route('/jobs')
+def jobs_status():
+    """Visualizza lo stato della coda dei job di generazione."""
+    status_filter = request.args.get('status')
+    if status_filter not in JOB_STATUSES:
+        status_filter = None
+    
+    return render_template('jobs.html',
+                          stats=get_queue_stats(),
+                          jobs=[j.to_dict() for j in get_recent_jobs(status=status_filter)],
+                          status_filter=status_filter,
+                          statuses=JOB_STATUSES)
+
 @app.route('/send_request', methods=['POST'])
 def send_request_route():
     data = request.json
@@ -328,58 +539,142 @@ def send_request_route():
         return jsonify({'error': 'Azienda non trovata'}), 404
     
     try:
-        # Send email
-        send_result = send_email(company.email, subject, message)
-        
-        if send_result:
-            # Save the request to track it
-            request_obj = Request(
-                company_id=company_id,
-                template_id=template_id,
-                subject=subject,
-                message=message,
-                date_sent=datetime.datetime.fromisoformat(send_result['date']) if isinstance(send_result['date'], str) else datetime.datetime.utcnow(),
-                status='delivered',
-                opened=False,
-                responded=False
-            )
-            
-            db.session.add(request_obj)
-            db.session.commit()
-            
-            return jsonify({'success': True, 'message': 'Richiesta inviata con successo'})
-        else:
-            return jsonify({'error': 'Errore durante l\'invio dell\'email'}), 500
+        # La richiesta e il messaggio da inviare vengono salvati con un solo commit;
+        # l'email viene spedita dal worker (vedi services/outbox_service.py)
+        user_id = current_user.id if current_user.is_authenticated else None
+        request_obj = enqueue_email(company, subject, message, template_id=template_id, user_id=user_id)
+        
+        return jsonify({
+            'success': True,
+            'message': 'Richiesta accodata per l\'invio',
+            'request_id': request_obj.id,
+            'status': request_obj.status
+        }), 202
     except Exception as e:
-        logging.error(f"Error sending email: {str(e)}")
-        return jsonify({'error': f'Errore durante l\'invio dell\'email: {str(e)}'}), 500
+        db.session.rollback()
+        logging.error(f"Error queuing email: {str(e)}")
+        return jsonify({'error': f'Errore durante l\'accodamento dell\'email: {str(e)}'}), 500
+
+@app.route('/send_campaign', methods=['POST'])
+def send_campaign_route():
+    """Accoda una campagna di richieste nell'outbox; l'invio è a carico del worker."""
+    data = request.json or {}
+    items = data.get('items')
+    template_id = data.get('template_id')
+    subject = data.get('subject', 'Richiesta di recensione prodotto')
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Dati mancanti: specificare le coppie azienda/messaggio'}), 400
+    if len(items) > MAX_CAMPAIGN_SIZE:
+        return jsonify({'error': f'Troppi messaggi: massimo {MAX_CAMPAIGN_SIZE} per campagna'}), 400
+    if any(not isinstance(item, dict) or not item.get('company_id') or not item.get('message') for item in items):
+        return jsonify({'error': 'Ogni messaggio deve indicare company_id e message'}), 400
+    
+    # Una sola query per tutte le aziende della campagna
+    company_ids = {item['company_id'] for item in items}
+    emails = dict(Company.query.with_entities(Company.id, Company.email).filter(Company.id.in_(company_ids)).all())
+    missing = company_ids - emails.keys()
+    if missing:
+        return jsonify({'error': f'Aziende non trovate: {len(missing)}', 'company_ids': sorted(missing)}), 404
+    
+    campaign = [
+        {'company_id': item['company_id'], 'email': emails[item['company_id']], 'message': item['message']}
+        for item in items
+    ]
+    user_id = current_user.id if current_user.is_authenticated else None
+    
+    try:
+        request_ids = enqueue_campaign(campaign, subject, template_id=template_id, user_id=user_id)
+    except Exception as e:
+        logging.error(f"Error queuing campaign: {str(e)}")
+        return jsonify({'error': f'Errore durante l\'accodamento della campagna: {str(e)}'}), 500
+    
+    return jsonify({
+        'success': True,
+        'message': f'Campagna accodata: {len(request_ids)} richieste in attesa di invio',
+        'queued': len(request_ids),
+        'request_ids': request_ids,
+        'progress_url': url_for('campaign_progress_route')
+    }), 202
+
+@app.route('/send_campaign/progress', methods=['POST'])
+def campaign_progress_route():
+    """Restituisce lo stato di invio dei messaggi di una campagna accodata."""
+    data = request.json or {}
+    request_ids = data.get('request_ids')
+
+    if not isinstance(request_ids, list) or not request_ids:
+        return jsonify({'error': 'Dati mancanti: specificare le richieste della campagna'}), 400
+    if len(request_ids) > MAX_CAMPAIGN_SIZE:
+        return jsonify({'error': f'Troppe richieste: massimo {MAX_CAMPAIGN_SIZE} per campagna'}), 400
+
+    return jsonify(get_campaign_progress(request_ids))
 
 @app.route('/settings')
 def settings():
     """Visualizza la pagina delle impostazioni."""
     settings_data = Setting.get_settings_dict()
-    return render_template('settings.html', current_settings=settings_data)
+    return render_template('settings.html', current_settings=settings_data,
+                          kobold_health=kobold_health_monitor.get_status(),
+                          ai_cache_stats=ai_cache.stats(),
+                          prewarm_status=prewarm_queue.status())
 
 @app.route('/settings/save', methods=['POST'])
 def save_settings_route():
     """Salva le impostazioni dell'applicazione."""
     if request.method == 'POST':
+        # Campi numerici: nome, etichetta, tipo, minimo, massimo e valore se il campo è vuoto
+        numeric_fields = (
+            ('max_length', 'Lunghezza massima della generazione', int, 100, 2000, 1000),
+            ('temperature', 'Temperatura', float, 0.1, 1.0, 0.7),
+            ('generation_concurrency', 'Generazioni parallele', int, 1, 32, 2),
+            ('prewarm_concurrency', 'Pre-generazioni parallele', int, 1, 8, 1)
+        )
+        numbers = {}
+        for field, label, kind, minimum, maximum, default in numeric_fields:
+            raw_value = (request.form.get(field) or '').strip()
+            try:
+                value = kind(raw_value) if raw_value else default
+            except ValueError:
+                flash(f'{label}: inserire un numero valido', 'danger')
+                return redirect(url_for('settings'))
+            if not minimum <= value <= maximum:
+                flash(f'{label}: il valore deve essere compreso tra {minimum} e {maximum}', 'danger')
+                return redirect(url_for('settings'))
+            numbers[field] = value
+        
         settings_data = {
             'kobold_api_url': request.form.get('kobold_api_url'),
             'use_fallback': 'use_fallback' in request.form,
-            'max_length': request.form.get('max_length', 1000),
-            'temperature': request.form.get('temperature', 0.7)
+            'max_length': numbers['max_length'],
+            'temperature': numbers['temperature'],
+            'generation_concurrency': numbers['generation_concurrency'],
+            'prewarm_enabled': 'prewarm_enabled' in request.form,
+            'prewarm_concurrency': numbers['prewarm_concurrency'],
+            'use_job_queue': 'use_job_queue' in request.form
         }
         
         if Setting.save_settings_dict(settings_data):
             # Aggiorna il client Kobold con le nuove impostazioni
             kobold_client.update_settings()
+            # L'URL potrebbe essere cambiato: aggiorna lo stato in background
+            kobold_health_monitor.request_refresh()
             flash('Impostazioni salvate con successo', 'success')
         else:
             flash('Errore durante il salvataggio delle impostazioni', 'danger')
     
     return redirect(url_for('settings'))
 
+@app.route('/prewarm/status')
+def prewarm_status():
+    """Restituisce lo stato di avanzamento del pre-warm della cache AI."""
+    return jsonify(prewarm_queue.status())
+
+@app.route('/metrics')
+def metrics_route():
+    """Espone le metriche dell'applicazione nel formato testuale di Prometheus."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/test_kobold_connection', methods=['POST'])
 def test_kobold_connection():
     """Test della connessione all'API Kobold."""
@@ -419,40 +714,27 @@ def get_kobold_model_info():
 
 @app.route('/emails')
 def show_local_emails():
-    """Visualizza le email salvate localmente per debugging."""
-    from services.email_service import LOCAL_EMAIL_DIR
-    from pathlib import Path
-    import json
+    """Visualizza le email salvate localmente per debugging, dalla più recente, una pagina alla volta."""
+    from services.local_mail_store import local_mail_store
     
     # Verifica se la modalità di debug è attiva
     if not app.debug and os.environ.get("SHOW_EMAILS", "false").lower() != "true":
         flash('Questa funzionalità è disponibile solo in modalità debug', 'warning')
         return redirect(url_for('index'))
     
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(max(1, request.args.get('per_page', 20, type=int)), 100)
+    
     try:
-        # Crea la directory se non esiste
-        LOCAL_EMAIL_DIR.mkdir(parents=True, exist_ok=True)
+        # Vengono lette solo le email della pagina richiesta
+        emails, total = local_mail_store.page(page, per_page)
+        pages = max(1, (total + per_page - 1) // per_page)
         
-        # Leggi le email salvate
-        emails = []
-        for email_file in LOCAL_EMAIL_DIR.glob('*.json'):
-            try:
-                with open(email_file, 'r', encoding='utf-8') as f:
-                    email_data = json.load(f)
-                    
-                email_data['filename'] = email_file.name
-                email_data['created_at'] = datetime.datetime.fromtimestamp(
-                    email_file.stat().st_mtime
-                ).strftime('%Y-%m-%d %H:%M:%S')
-                
-                emails.append(email_data)
-            except Exception as e:
-                logging.warning(f"Errore nella lettura del file email {email_file}: {e}")
-        
-        # Ordina le email per data (più recenti prima)
-        emails.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-        
-        return render_template('emails.html', emails=emails)
+        for email_data in emails:
+            email_data['created_at'] = (email_data.get('date') or '').replace('T', ' ')[:19]
+        
+        return render_template('emails.html', emails=emails, total=total,
+                              page=page, pages=pages, per_page=per_page)
     except Exception as e:
         logging.error(f"Errore nel recupero delle email locali: {e}")
         flash(f'Errore nel recupero delle email: {str(e)}', 'danger')
@@ -479,6 +761,7 @@ def init_db():
         
         db.session.add_all(default_categories)
         db.session.commit()
+        template_engine.invalidate_categories()
         
         # Template di esempio
         default_templates = [
@@ -0,0 +1,912 @@
+"""
+AI Cache
+
+Questo modulo fornisce i backend di cache per le richieste generate dall'AI.
+Il backend predefinito è un database SQLite a file singolo in modalità WAL,
+condivisibile in sicurezza tra più worker gunicorn, con dimensione massima ed
+eviction LRU. Il vecchio formato a un file JSON per chiave resta disponibile
+impostando AI_CACHE_BACKEND=json. Davanti al backend persistente può essere
+posto un livello LRU in memoria per singolo processo (TieredCache).
+
+Ogni voce può essere associata al template e all'azienda da cui è generata:
+gli indici secondari permettono di invalidare solo le voci interessate da una
+modifica (invalidate), invece di attenderne la scadenza.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from services.metrics import AI_CACHE_EVENTS
+
+# Percorsi predefiniti dei backend
+DEFAULT_DB_PATH = Path('data/ai_cache.sqlite3')
+DEFAULT_JSON_DIR = Path('data/ai_cache')
+
+# Limiti predefiniti della cache
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_MEMORY_CAPACITY = 512
+
+# Secondi prima della scadenza in cui una voce viene servita ma rigenerata in background
+DEFAULT_REFRESH_WINDOW = 3600
+
+# Intervallo minimo (secondi) tra due aggiornamenti dell'ultimo accesso di una voce,
+# per non trasformare ogni lettura in una scrittura
+ACCESS_UPDATE_INTERVAL = 60
+
+class CacheBackend:
+    """Interfaccia comune dei backend di cache."""
+
+    def __init__(self, ttl, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Inizializza i parametri comuni.
+
+        Args:
+            ttl (float): Validità delle voci in secondi
+            max_entries (int): Numero massimo di voci
+            max_bytes (int): Dimensione massima complessiva dei valori in byte
+        """
+        self.logger = logging.getLogger(__name__)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # Contatori del processo corrente
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'writes': 0, 'invalidations': 0}
+        self._counters_lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        """Incrementa un contatore statistico."""
+        with self._counters_lock:
+            self._counters[name] += amount
+        AI_CACHE_EVENTS.inc(amount, tier=self.name, event=name)
+
+    def get(self, key):
+        """
+        Recupera una voce dalla cache.
+
+        Args:
+            key (str): Chiave di cache
+
+        Returns:
+            dict|None: {'value': ..., 'created_at': ..., 'template_id': ..., 'company_id': ...}
+                oppure None se assente o scaduta
+        """
+        raise NotImplementedError
+
+    def peek(self, key):
+        """
+        Legge una voce senza aggiornare statistiche, ultimo accesso o scadenze.
+
+        Usata per i controlli ripetuti (es. attesa del risultato di un altro processo).
+
+        Returns:
+            dict|None: Come get(), oppure None se assente o scaduta
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, template_id=None, company_id=None):
+        """
+        Salva una voce nella cache.
+
+        Args:
+            key (str): Chiave di cache
+            value (str): Valore da salvare
+            template_id (str, optional): Template da cui dipende la voce
+            company_id (str, optional): Azienda da cui dipende la voce
+        """
+        raise NotImplementedError
+
+    def invalidate(self, template_id=None, company_id=None):
+        """
+        Elimina le voci che dipendono da un template e/o da un'azienda.
+
+        Se sono indicati entrambi, vengono eliminate solo le voci della coppia.
+
+        Args:
+            template_id (str, optional): ID del template
+            company_id (str, optional): ID dell'azienda
+
+        Returns:
+            int: Numero di voci eliminate
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Elimina una voce dalla cache."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Svuota completamente la cache."""
+        raise NotImplementedError
+
+    def entry_count(self):
+        """Restituisce il numero di voci presenti."""
+        raise NotImplementedError
+
+    def acquire_lock(self, key, ttl):
+        """
+        Tenta di acquisire un lock condiviso tra processi per una chiave.
+
+        Args:
+            key (str): Chiave da bloccare
+            ttl (float): Secondi dopo i quali il lock è considerato abbandonato
+
+        Returns:
+            bool: True se il lock è stato acquisito
+        """
+        raise NotImplementedError
+
+    def release_lock(self, key):
+        """Rilascia un lock acquisito con acquire_lock."""
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Restituisce le statistiche della cache.
+
+        I contatori di hit, miss ed eviction si riferiscono al processo corrente.
+
+        Returns:
+            dict: Statistiche e configurazione del backend
+        """
+        with self._counters_lock:
+            stats = dict(self._counters)
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+        stats['backend'] = self.name
+        stats['entries'] = self.entry_count()
+        stats['max_entries'] = self.max_entries
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+class SQLiteCacheBackend(CacheBackend):
+    """Cache su file SQLite singolo (WAL), con eviction LRU e per scadenza."""
+
+    name = 'sqlite'
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, **kwargs):
+        """
+        Inizializza il backend SQLite.
+
+        Args:
+            db_path (Path|str): Percorso del file di database
+            **kwargs: Parametri comuni (ttl, max_entries, max_bytes)
+        """
+        super().__init__(**kwargs)
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Restituisce la connessione del thread corrente, creandola se necessario.
+
+        Le connessioni non vengono mai condivise tra thread o tra processi (fork).
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # isolation_level=None: le transazioni sono gestite esplicitamente
+        conn = sqlite3.connect(str(self.db_path), timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+
+        with self._schema_lock:
+            if not self._schema_ready:
+                self._create_schema(conn)
+                self._schema_ready = True
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _create_schema(self, conn):
+        """Crea le tabelle e gli indici se non esistono."""
+        self._enable_incremental_vacuum(conn)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                template_id TEXT,
+                company_id TEXT
+            )
+        """)
+
+        # Database creati prima degli indici per template e azienda
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(cache_entries)")}
+        for column in ('template_id', 'company_id'):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE cache_entries ADD COLUMN {column} TEXT")
+
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache_entries (accessed_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_created ON cache_entries (created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_template ON cache_entries (template_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_company ON cache_entries (company_id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_locks (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+
+    def _enable_incremental_vacuum(self, conn):
+        """
+        Attiva l'auto_vacuum incrementale, così lo spazio delle voci invalidate
+        può essere restituito al filesystem senza un VACUUM completo.
+
+        Su un database esistente la modalità richiede un VACUUM una tantum; se un
+        altro processo lo sta usando la conversione viene rimandata.
+        """
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        try:
+            conn.execute("VACUUM")
+        except sqlite3.Error as e:
+            self.logger.debug(f"Conversione della cache ad auto_vacuum incrementale rimandata: {e}")
+
+    def get(self, key):
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, created_at, accessed_at, template_id, company_id FROM cache_entries WHERE key = ?",
+                (key,)
+            ).fetchone()
+
+            if row is None:
+                self._count('misses')
+                return None
+
+            value, created_at, accessed_at, template_id, company_id = row
+            if now - created_at > self.ttl:
+                # Voce scaduta: la rimuoviamo subito invece di lasciarla occupare spazio
+                conn.execute("DELETE FROM cache_entries WHERE key = ? AND created_at = ?", (key, created_at))
+                self._count('misses')
+                self._count('evictions')
+                return None
+
+            if now - accessed_at > ACCESS_UPDATE_INTERVAL:
+                conn.execute("UPDATE cache_entries SET accessed_at = ? WHERE key = ?", (now, key))
+
+            self._count('hits')
+            return {'value': value, 'created_at': created_at, 'template_id': template_id, 'company_id': company_id}
+        except sqlite3.Error as e:
+            self.logger.warning(f"Errore nel recupero dalla cache SQLite: {e}")
+            self._count('misses')
+            return None
+
+    def peek(self, key):
+        try:
+            row = self._connect().execute(
+                "SELECT value, created_at, template_id, company_id FROM cache_entries WHERE key = ?",
+                (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        value, created_at, template_id, company_id = row
+        return {'value': value, 'created_at': created_at, 'template_id': template_id, 'company_id': company_id}
+
+    def set(self, key, value, template_id=None, company_id=None):
+        now = time.time()
+        size = len(value.encode('utf-8'))
+        try:
+            conn = self._connect()
+            # BEGIN IMMEDIATE acquisisce subito il lock di scrittura: inserimento ed
+            # eviction avvengono in un'unica transazione atomica tra i worker
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries "
+                    "(key, value, created_at, accessed_at, size, template_id, company_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, value, now, now, size, template_id, company_id)
+                )
+                evicted = self._evict(conn, now)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            self._count('writes')
+            if evicted:
+                self._count('evictions', evicted)
+                self.logger.debug(f"Cache AI: rimosse {evicted} voci")
+        except sqlite3.Error as e:
+            # Non solleviamo l'eccezione per non interrompere il flusso principale
+            self.logger.warning(f"Errore nel salvataggio nella cache SQLite: {e}")
+
+    def _evict(self, conn, now):
+        """
+        Rimuove le voci scadute e, se necessario, quelle usate meno di recente.
+
+        Returns:
+            int: Numero di voci rimosse
+        """
+        evicted = conn.execute("DELETE FROM cache_entries WHERE created_at < ?", (now - self.ttl,)).rowcount
+
+        count, total_size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+        if count <= self.max_entries and total_size <= self.max_bytes:
+            return evicted
+
+        # Scorre le voci dalla meno recente finché i limiti non sono rispettati
+        to_delete = []
+        for key, size in conn.execute("SELECT key, size FROM cache_entries ORDER BY accessed_at ASC"):
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            count -= 1
+            total_size -= size
+
+        conn.executemany("DELETE FROM cache_entries WHERE key = ?", to_delete)
+        return evicted + len(to_delete)
+
+    def delete(self, key):
+        try:
+            self._connect().execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            self.logger.warning(f"Errore nella rimozione dalla cache SQLite: {e}")
+
+    def invalidate(self, template_id=None, company_id=None):
+        conditions, params = _dependency_filter(template_id, company_id)
+        try:
+            conn = self._connect()
+            # Gli indici su template_id e company_id limitano la DELETE alle voci interessate
+            removed = conn.execute(f"DELETE FROM cache_entries WHERE {conditions}", params).rowcount
+            if removed:
+                # Restituisce subito al filesystem le pagine liberate
+                conn.execute("PRAGMA incremental_vacuum")
+                self._count('invalidations', removed)
+            return removed
+        except sqlite3.Error as e:
+            self.logger.warning(f"Errore nell'invalidazione della cache SQLite: {e}")
+            return 0
+
+    def clear(self):
+        try:
+            conn = self._connect()
+            conn.execute("DELETE FROM cache_entries")
+            conn.execute("PRAGMA incremental_vacuum")
+        except sqlite3.Error as e:
+            self.logger.warning(f"Errore nello svuotamento della cache SQLite: {e}")
+
+    def entry_count(self):
+        try:
+            return self._connect().execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+    def _lock_owner(self):
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def acquire_lock(self, key, ttl):
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Un lock scaduto appartiene a un processo terminato o bloccato: lo rimuoviamo
+                conn.execute("DELETE FROM cache_locks WHERE key = ? AND expires_at < ?", (key, now))
+                acquired = conn.execute(
+                    "INSERT OR IGNORE INTO cache_locks (key, owner, expires_at) VALUES (?, ?, ?)",
+                    (key, self._lock_owner(), now + ttl)
+                ).rowcount == 1
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return acquired
+        except sqlite3.Error as e:
+            # Senza lock condiviso si procede comunque: al peggio si genera due volte
+            self.logger.warning(f"Errore nell'acquisizione del lock di cache: {e}")
+            return True
+
+    def release_lock(self, key):
+        try:
+            self._connect().execute(
+                "DELETE FROM cache_locks WHERE key = ? AND owner = ?", (key, self._lock_owner())
+            )
+        except sqlite3.Error as e:
+            self.logger.warning(f"Errore nel rilascio del lock di cache: {e}")
+
+class JsonFileCacheBackend(CacheBackend):
+    """
+    Cache a un file JSON per chiave (formato storico), con scritture atomiche.
+
+    L'eviction avviene per scadenza e in ordine di scrittura (FIFO).
+    """
+
+    name = 'json'
+
+    def __init__(self, cache_dir=DEFAULT_JSON_DIR, **kwargs):
+        """
+        Inizializza il backend a file JSON.
+
+        Args:
+            cache_dir (Path|str): Cartella dei file di cache
+            **kwargs: Parametri comuni (ttl, max_entries, max_bytes)
+        """
+        super().__init__(**kwargs)
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key):
+        cache_file = self._path(key)
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cache_data = json.load(f)
+        except FileNotFoundError:
+            self._count('misses')
+            return None
+        except Exception as e:
+            self.logger.warning(f"Errore nel recupero cache: {e}")
+            self._count('misses')
+            return None
+
+        if time.time() - cache_data['timestamp'] > self.ttl:
+            self.logger.debug(f"Cache scaduta per {key}")
+            cache_file.unlink(missing_ok=True)
+            self._count('misses')
+            self._count('evictions')
+            return None
+
+        self._count('hits')
+        return {
+            'value': cache_data['request'],
+            'created_at': cache_data['timestamp'],
+            'template_id': cache_data.get('template_id'),
+            'company_id': cache_data.get('company_id')
+        }
+
+    def peek(self, key):
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                cache_data = json.load(f)
+        except Exception:
+            return None
+        if time.time() - cache_data['timestamp'] > self.ttl:
+            return None
+        return {
+            'value': cache_data['request'],
+            'created_at': cache_data['timestamp'],
+            'template_id': cache_data.get('template_id'),
+            'company_id': cache_data.get('company_id')
+        }
+
+    def set(self, key, value, template_id=None, company_id=None):
+        cache_data = {
+            'timestamp': time.time(),
+            'request': value,
+            'template_id': template_id,
+            'company_id': company_id
+        }
+        try:
+            # Scrittura su file temporaneo e rinomina atomica: i lettori non vedono mai file parziali
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(cache_data, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+            self._count('writes')
+            self._evict()
+        except Exception as e:
+            self.logger.warning(f"Errore nel salvataggio in cache: {e}")
+
+    def _evict(self):
+        """Rimuove i file scaduti e i più vecchi oltre i limiti."""
+        now = time.time()
+        files = []
+        for cache_file in self.cache_dir.glob('*.json'):
+            try:
+                stat = cache_file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, cache_file))
+
+        count = len(files)
+        total_size = sum(size for _, size, _ in files)
+        evicted = 0
+
+        for mtime, size, cache_file in sorted(files, key=lambda item: item[0]):
+            expired = now - mtime > self.ttl
+            if not expired and count <= self.max_entries and total_size <= self.max_bytes:
+                continue
+            cache_file.unlink(missing_ok=True)
+            count -= 1
+            total_size -= size
+            evicted += 1
+
+        if evicted:
+            self._count('evictions', evicted)
+
+    def delete(self, key):
+        self._path(key).unlink(missing_ok=True)
+
+    def invalidate(self, template_id=None, company_id=None):
+        # Il formato storico non ha indici: è necessario leggere ogni file
+        _dependency_filter(template_id, company_id)
+        removed = 0
+        for cache_file in self.cache_dir.glob('*.json'):
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    cache_data = json.load(f)
+            except Exception:
+                continue
+            if template_id is not None and cache_data.get('template_id') != template_id:
+                continue
+            if company_id is not None and cache_data.get('company_id') != company_id:
+                continue
+            cache_file.unlink(missing_ok=True)
+            removed += 1
+
+        if removed:
+            self._count('invalidations', removed)
+        return removed
+
+    def clear(self):
+        for cache_file in self.cache_dir.glob('*.json'):
+            cache_file.unlink(missing_ok=True)
+
+    def entry_count(self):
+        return sum(1 for _ in self.cache_dir.glob('*.json'))
+
+    def _lock_path(self, key):
+        return self.cache_dir / f"{key}.lock"
+
+    def acquire_lock(self, key, ttl):
+        lock_path = self._lock_path(key)
+        try:
+            if time.time() - lock_path.stat().st_mtime > ttl:
+                lock_path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            pass
+
+        try:
+            # O_EXCL garantisce che un solo processo riesca a creare il file
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        except OSError as e:
+            self.logger.warning(f"Errore nell'acquisizione del lock di cache: {e}")
+            return True
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+
+    def release_lock(self, key):
+        self._lock_path(key).unlink(missing_ok=True)
+
+class MemoryCacheTier:
+    """Cache LRU in memoria, locale al processo."""
+
+    name = 'memory'
+
+    def __init__(self, capacity=DEFAULT_MEMORY_CAPACITY):
+        """
+        Inizializza il livello in memoria.
+
+        Args:
+            capacity (int): Numero massimo di voci mantenute
+        """
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        # Indici secondari: ('template'|'company', id) → chiavi, e chiave → dipendenze
+        self._index = {}
+        self._dependencies = {}
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """
+        Recupera una voce aggiornandone la posizione LRU.
+
+        Returns:
+            dict|None: {'value': ..., 'created_at': ...} oppure None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+            else:
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+        AI_CACHE_EVENTS.inc(tier='memory', event='misses' if entry is None else 'hits')
+        return entry
+
+    def peek(self, key):
+        """Recupera una voce senza aggiornare posizione LRU e statistiche."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, key, entry, template_id=None, company_id=None):
+        """
+        Salva una voce, rimuovendo la meno recente se la capacità è esaurita.
+
+        Le dipendenze non indicate restano quelle già note per la chiave (ad
+        esempio quando una voce letta dal backend viene riportata in memoria).
+        """
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if template_id is not None or company_id is not None:
+                self._unindex(key)
+                self._dependencies[key] = (template_id, company_id)
+                for dependency in (('template', template_id), ('company', company_id)):
+                    if dependency[1] is not None:
+                        self._index.setdefault(dependency, set()).add(key)
+            evicted = 0
+            while len(self._entries) > self.capacity:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._unindex(evicted_key)
+                evicted += 1
+            self._counters['evictions'] += evicted
+        if evicted:
+            AI_CACHE_EVENTS.inc(evicted, tier='memory', event='evictions')
+
+    def _unindex(self, key):
+        """Rimuove una chiave dagli indici secondari (da chiamare con il lock)."""
+        template_id, company_id = self._dependencies.pop(key, (None, None))
+        for dependency in (('template', template_id), ('company', company_id)):
+            keys = self._index.get(dependency)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[dependency]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._unindex(key)
+
+    def invalidate(self, template_id=None, company_id=None):
+        """
+        Elimina le voci che dipendono da un template e/o da un'azienda.
+
+        Returns:
+            int: Numero di voci eliminate
+        """
+        _dependency_filter(template_id, company_id)
+        with self._lock:
+            candidates = None
+            for dependency in (('template', template_id), ('company', company_id)):
+                if dependency[1] is None:
+                    continue
+                keys = self._index.get(dependency, set())
+                candidates = set(keys) if candidates is None else candidates & keys
+
+            for key in candidates:
+                self._entries.pop(key, None)
+                self._unindex(key)
+            self._counters['invalidations'] += len(candidates)
+
+        if candidates:
+            AI_CACHE_EVENTS.inc(len(candidates), tier='memory', event='invalidations')
+        return len(candidates)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self._dependencies.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+        stats['capacity'] = self.capacity
+        return stats
+
+class TieredCache:
+    """
+    Cache a due livelli: LRU in memoria davanti al backend persistente.
+
+    Le voci prossime alla scadenza (entro refresh_window secondi) vengono
+    comunque restituite ma segnalate come da rigenerare (stale-while-revalidate).
+    """
+
+    def __init__(self, memory, backend, refresh_window=DEFAULT_REFRESH_WINDOW):
+        """
+        Inizializza la cache a livelli.
+
+        Args:
+            memory (MemoryCacheTier): Livello in memoria
+            backend (CacheBackend): Backend persistente
+            refresh_window (float): Anticipo in secondi sulla scadenza per la rigenerazione
+        """
+        self.memory = memory
+        self.backend = backend
+        self.ttl = backend.ttl
+        self.refresh_window = min(refresh_window, self.ttl)
+
+    def get(self, key):
+        """
+        Recupera una voce dal primo livello che la contiene.
+
+        Returns:
+            dict|None: {'value': ..., 'created_at': ..., 'stale': bool} oppure None
+        """
+        now = time.time()
+        stale_after = self.ttl - self.refresh_window
+        entry = self.memory.get(key)
+
+        if entry is not None and now - entry['created_at'] > stale_after:
+            # Un altro worker potrebbe aver già rigenerato la voce: verifichiamo il backend
+            fresher = self.backend.get(key)
+            if fresher is not None and fresher['created_at'] > entry['created_at']:
+                entry = fresher
+                self._remember(key, entry)
+            elif now - entry['created_at'] > self.ttl:
+                self.memory.delete(key)
+                entry = None
+
+        if entry is None:
+            entry = self.backend.get(key)
+            if entry is None:
+                return None
+            self._remember(key, entry)
+
+        return dict(entry, stale=now - entry['created_at'] > stale_after)
+
+    def peek(self, key):
+        """
+        Recupera una voce come get(), senza aggiornare statistiche, LRU e accessi.
+
+        Returns:
+            dict|None: {'value': ..., 'created_at': ..., 'stale': bool} oppure None
+        """
+        now = time.time()
+        entry = self.memory.peek(key)
+        if entry is None or now - entry['created_at'] > self.ttl:
+            entry = self.backend.peek(key)
+            if entry is None:
+                return None
+        return dict(entry, stale=now - entry['created_at'] > self.ttl - self.refresh_window)
+
+    def _remember(self, key, entry):
+        """Porta in memoria una voce letta dal backend, con le sue dipendenze."""
+        self.memory.set(key, entry, template_id=entry.get('template_id'), company_id=entry.get('company_id'))
+
+    def set(self, key, value, template_id=None, company_id=None):
+        """Salva una voce in entrambi i livelli, con le dipendenze da template e azienda."""
+        self.backend.set(key, value, template_id=template_id, company_id=company_id)
+        self._remember(key, {
+            'value': value,
+            'created_at': time.time(),
+            'template_id': template_id,
+            'company_id': company_id
+        })
+
+    def delete(self, key):
+        self.memory.delete(key)
+        self.backend.delete(key)
+
+    def invalidate(self, template_id=None, company_id=None):
+        """
+        Elimina da entrambi i livelli le voci che dipendono da un template e/o da un'azienda.
+
+        Il livello in memoria degli altri processi non viene toccato: le sue voci
+        non sono più raggiungibili se il contenuto è cambiato (la chiave dipende
+        dal contenuto) e vengono comunque scartate dall'LRU.
+
+        Returns:
+            int: Numero di voci eliminate dal backend persistente
+        """
+        self.memory.invalidate(template_id=template_id, company_id=company_id)
+        return self.backend.invalidate(template_id=template_id, company_id=company_id)
+
+    def acquire_lock(self, key, ttl):
+        return self.backend.acquire_lock(key, ttl)
+
+    def release_lock(self, key):
+        self.backend.release_lock(key)
+
+    def clear(self):
+        self.memory.clear()
+        self.backend.clear()
+
+    def stats(self):
+        """
+        Restituisce le statistiche del backend con quelle del livello in memoria.
+
+        Returns:
+            dict: Statistiche del backend, con la chiave 'memory' per il livello in memoria
+        """
+        stats = self.backend.stats()
+        stats['memory'] = self.memory.stats()
+        stats['refresh_window'] = self.refresh_window
+        return stats
+
+def _dependency_filter(template_id, company_id):
+    """
+    Costruisce la condizione SQL per le voci di un template e/o di un'azienda.
+
+    Returns:
+        tuple: (condizione WHERE, parametri)
+
+    Raises:
+        ValueError: Se non è indicato né il template né l'azienda
+    """
+    conditions = []
+    params = []
+    if template_id is not None:
+        conditions.append("template_id = ?")
+        params.append(template_id)
+    if company_id is not None:
+        conditions.append("company_id = ?")
+        params.append(company_id)
+    if not conditions:
+        raise ValueError("È necessario indicare template_id o company_id")
+    return ' AND '.join(conditions), params
+
+def create_cache_backend(ttl, json_dir=DEFAULT_JSON_DIR, db_path=DEFAULT_DB_PATH):
+    """
+    Crea il backend di cache configurato tramite variabili d'ambiente.
+
+    Variabili supportate: AI_CACHE_BACKEND (sqlite|json), AI_CACHE_MAX_ENTRIES,
+    AI_CACHE_MAX_BYTES, AI_CACHE_PATH.
+
+    Args:
+        ttl (float): Validità delle voci in secondi
+        json_dir (Path|str): Cartella per il backend JSON
+        db_path (Path|str): File di database per il backend SQLite
+
+    Returns:
+        CacheBackend: Backend di cache
+    """
+    backend = os.environ.get("AI_CACHE_BACKEND", "sqlite").lower()
+    options = {
+        'ttl': ttl,
+        'max_entries': int(os.environ.get("AI_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+        'max_bytes': int(os.environ.get("AI_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+    }
+
+    if backend == 'json':
+        return JsonFileCacheBackend(cache_dir=os.environ.get("AI_CACHE_PATH", json_dir), **options)
+
+    if backend != 'sqlite':
+        logging.warning(f"Backend di cache sconosciuto '{backend}', utilizzo SQLite")
+
+    return SQLiteCacheBackend(db_path=os.environ.get("AI_CACHE_PATH", db_path), **options)
+
+def create_tiered_cache(ttl, json_dir=DEFAULT_JSON_DIR, db_path=DEFAULT_DB_PATH):
+    """
+    Crea la cache a livelli: memoria del processo davanti al backend configurato.
+
+    Variabili supportate, oltre a quelle di create_cache_backend:
+    AI_CACHE_MEMORY_CAPACITY e AI_CACHE_REFRESH_WINDOW.
+
+    Args:
+        ttl (float): Validità delle voci in secondi
+        json_dir (Path|str): Cartella per il backend JSON
+        db_path (Path|str): File di database per il backend SQLite
+
+    Returns:
+        TieredCache: Cache a livelli
+    """
+    memory = MemoryCacheTier(capacity=int(os.environ.get("AI_CACHE_MEMORY_CAPACITY", DEFAULT_MEMORY_CAPACITY)))
+    backend = create_cache_backend(ttl, json_dir=json_dir, db_path=db_path)
+    refresh_window = float(os.environ.get("AI_CACHE_REFRESH_WINDOW", DEFAULT_REFRESH_WINDOW))
+    return TieredCache(memory, backend, refresh_window=refresh_window)
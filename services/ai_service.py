@@ -3,15 +3,71 @@ import json
 import logging
 import hashlib
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from services.kobold_api import kobold_client
+from services.health_monitor import kobold_health_monitor
+from services.ai_cache import create_tiered_cache
+from services.singleflight import SingleFlight
+from services.prompt_builder import PromptBuilder, STOP_SEQUENCES, clean_generated_text
+from services.length_service import length_predictor
+from services.llm_scheduler import GenerationScheduler, SchedulerTimeoutError, PRIORITY_INTERACTIVE, PRIORITY_BATCH, PRIORITY_PREWARM
+from services.template_engine import template_engine, PLACEHOLDER_RE, PLACEHOLDERS
+from services.cluster_service import cluster_companies
+from services.metrics import metrics, AI_GENERATION_DURATION, AI_FIRST_TOKEN_DURATION, AI_REVIEW_REQUESTS
 
-# Cartella per il caching delle richieste generate
+# Cartella per il caching delle richieste generate (backend JSON)
 CACHE_DIR = Path('data/ai_cache')
 # Validità della cache in secondi (24 ore)
 CACHE_VALIDITY = 86400
 
-def generate_review_request(company, template, use_cache=True):
+# Cache a due livelli: LRU in memoria davanti al backend persistente
+# (SQLite predefinito, configurabile con AI_CACHE_BACKEND)
+ai_cache = create_tiered_cache(ttl=CACHE_VALIDITY, json_dir=CACHE_DIR)
+
+# Costruzione dei prompt entro il budget di token del modello
+prompt_builder = PromptBuilder(kobold_client)
+
+# Rigenerazione in background delle voci di cache prossime alla scadenza
+_refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-refresh')
+_refreshing_keys = set()
+_refreshing_lock = threading.Lock()
+
+# Numero di generazioni Kobold in corso nel processo (usato per dare precedenza al lavoro interattivo)
+_active_generations = 0
+_active_generations_lock = threading.Lock()
+
+# Secondi massimi di una generazione: oltre, la generazione viene interrotta sul backend
+GENERATION_DEADLINE = float(os.environ.get("AI_GENERATION_DEADLINE", 60))
+
+# Accesso ai backend Kobold per classe di priorità: interattiva, batch, pre-warm
+generation_scheduler = GenerationScheduler(kobold_client)
+kobold_client.scheduler = generation_scheduler
+
+# Generazione interattiva in corso per ciascun utente (owner → genkey e chiamata di
+# _generation_flight che la esegue): una nuova richiesta dello stesso utente annulla
+# la precedente, se nessun'altra richiesta ne attende il risultato
+_owner_generations = {}
+_owner_generations_lock = threading.Lock()
+
+# Numero massimo di varianti generate con una sola richiesta
+MAX_VARIANTS = int(os.environ.get("AI_MAX_VARIANTS", 5))
+
+# Durata del lock tra processi di una generazione: il leader può attendere uno slot
+# interattivo per GENERATION_DEADLINE (vedi _slot_timeout) e poi generare per
+# altrettanto; il margine copre costruzione del prompt e salvataggio in cache
+GENERATION_LOCK_TTL = float(os.environ.get("AI_GENERATION_LOCK_TTL", 0)) or 2 * GENERATION_DEADLINE + 30
+
+# Coalizza le generazioni concorrenti per la stessa chiave di cache, anche tra worker
+_generation_flight = SingleFlight(lock_store=ai_cache, lock_ttl=GENERATION_LOCK_TTL)
+
+class GenerationUnavailableError(Exception):
+    """Sollevata quando la generazione AI non è possibile e il fallback è disattivato."""
+    pass
+
+def generate_review_request(company, template, use_cache=True, allow_fallback=True, owner=None,
+                            priority=PRIORITY_INTERACTIVE, replace_previous=True):
     """
     Generate a personalized review request using the local Kobold API.
     
@@ -19,6 +75,15 @@ def generate_review_request(company, template, use_cache=True):
         company (dict): Company information including name, products, category
         template (dict): Template content to be used as base for the request
         use_cache (bool): Whether to use caching for faster responses
+        allow_fallback (bool): If False, errors are raised instead of returning the
+                               template-based fallback (used by the job worker to retry)
+        owner (str, optional): Utente che ha chiesto la generazione; una sua nuova
+                               richiesta interattiva annulla quella ancora in corso
+        priority (str): Classe di priorità nello scheduler (interactive, batch, prewarm)
+        replace_previous (bool): Se False la generazione non annulla né può essere
+                                 annullata da altre dello stesso utente (job, il cui
+                                 risultato è salvato e non viene mai sostituito);
+                                 owner resta usato per il turno nello scheduler
         
     Returns:
         str: The generated review request message
@@ -28,80 +93,659 @@ def generate_review_request(company, template, use_cache=True):
     
     # Se il caching è abilitato, verifichiamo se esiste già una risposta in cache
     if use_cache:
-        cached_result = _get_cached_request(cache_key)
+        cached_result = _get_cached_request(cache_key, company, template)
         if cached_result:
             logging.info(f"Usando richiesta in cache per {company['name']}")
+            AI_REVIEW_REQUESTS.inc(source='cache')
             return cached_result
     
     try:
         logging.debug(f"Generating review request for company: {company['name']}")
         
-        # Verifica che l'API Kobold sia disponibile
-        start_time = time.time()
-        api_available = kobold_client.health_check()
-        check_time = time.time() - start_time
+        # Verifica l'ultimo stato noto dell'API Kobold (nessuna chiamata di rete)
+        api_available = kobold_health_monitor.is_available()
         
         if not api_available:
-            logging.warning(f"Kobold API non è disponibile (verificato in {check_time:.2f}s), utilizzo il fallback")
+            if not allow_fallback:
+                raise GenerationUnavailableError("Kobold API non disponibile secondo l'ultimo controllo")
+            logging.warning("Kobold API non è disponibile secondo l'ultimo controllo, utilizzo il fallback")
             result = generate_fallback_request(company, template)
             # Non salvare in cache i risultati fallback
+            AI_REVIEW_REQUESTS.inc(source='fallback')
             return result
         
-        # Prepara il prompt per Kobold
-        system_prompt = "Sei C-Recenzione, un assistente professionale per la generazione di richieste di recensioni di prodotti."
+        if not use_cache:
+            result = _generate_with_kobold(company, template, owner, priority, replace_previous=replace_previous)
+        else:
+            # Le richieste identiche in corso condividono un'unica generazione
+            result = _generation_flight.do(
+                cache_key,
+                lambda: _generate_and_cache(cache_key, company, template, owner, priority, replace_previous),
+                lookup=lambda: _get_cached_request(cache_key, peek=True)
+            )
+        AI_REVIEW_REQUESTS.inc(source='ai')
+        return result
         
-        prompt = f"""
-        Sei C-Recenzione, un sistema professionale di richiesta recensioni per prodotti.
+    except Exception as e:
+        logging.error(f"Error generating review request: {str(e)}")
+        if not allow_fallback:
+            raise
+        # Utilizzo del sistema di fallback se si verifica un errore
+        logging.info("Utilizzo del sistema di fallback per la generazione della richiesta")
+        AI_REVIEW_REQUESTS.inc(source='fallback')
+        return generate_fallback_request(company, template)
+
+def _generate_with_kobold(company, template, owner=None, priority=PRIORITY_INTERACTIVE, slots=None,
+                          replace_previous=True):
+    """
+    Genera il testo della richiesta tramite l'API Kobold, senza cache né fallback.
+    
+    Args:
+        company (dict): Dati dell'azienda
+        template (dict): Template da utilizzare come base
+        owner (str, optional): Utente che ha chiesto la generazione
+        priority (str): Classe di priorità nello scheduler
+        slots (list, optional): Segnaposto da lasciare nel testo (generazione per gruppi)
+        replace_previous (bool): Se annullare la generazione interattiva in corso dell'utente
         
-        Genera una richiesta di recensione personalizzata per un'azienda basandoti sui seguenti dati:
-        - Nome azienda: {company['name']}
-        - Prodotti: {company.get('products', 'prodotti vari')}
-        - Categoria: {company.get('category', 'generale')}
-        - Sito web: {company.get('website', '')}
+    Returns:
+        str: Testo generato (può essere vuoto)
+    """
+    # Limite di token adattato alle lunghezze osservate per il template
+    max_length = length_predictor.predict(template)
+    
+    # Prepara il prompt per Kobold
+    full_prompt = _build_prompt(company, template, max_length=max_length, slots=slots)
+    
+    # Utilizziamo il client Kobold per generare il testo
+    logging.info(f"Generazione richiesta per {company['name']} tramite API Kobold (max_length {max_length})")
+    with generation_scheduler.slot(priority, owner, timeout=_slot_timeout(priority)):
+        generation_start = time.time()
+        result = 'error'
+        # Senza sostituzione la generazione non viene registrata per l'utente
+        replace_owner = owner if replace_previous else None
+        genkey = _claim_generation(replace_owner, priority)
+        _track_generation(1)
+        try:
+            generated_text = kobold_client.generate_text(
+                prompt=full_prompt,
+                max_length=max_length,
+                temperature=0.7,
+                stop_sequence=STOP_SEQUENCES,
+                genkey=genkey,
+                deadline=GENERATION_DEADLINE
+            )
+            result = 'ok'
+        finally:
+            _track_generation(-1)
+            _release_generation(replace_owner, genkey)
+            AI_GENERATION_DURATION.observe(time.time() - generation_start, mode='sync', result=result)
+    generation_time = time.time() - generation_start
+    
+    # Pulisci la risposta da eventuali artefatti di formattazione e dalla riga dell'oggetto
+    generated_request = clean_generated_text(generated_text.replace(full_prompt, ""))
+    if generated_request:
+        length_predictor.record(template, max_length, text=generated_request, mode='sync')
+    
+    logging.debug(f"Richiesta generata in {generation_time:.2f}s: {generated_request[:100]}...")
+    return generated_request
+
+def _slot_timeout(priority):
+    """
+    Restituisce l'attesa massima di uno slot dello scheduler.
+    
+    Le richieste interattive non aspettano oltre la durata massima di una
+    generazione (poi si usa il fallback); batch e pre-warm attendono il loro turno.
+    """
+    return GENERATION_DEADLINE if priority == PRIORITY_INTERACTIVE else None
+
+def _claim_generation(owner, priority=PRIORITY_INTERACTIVE, flight_call=None):
+    """
+    Crea la genkey di una nuova generazione e, se l'utente ne ha già una
+    interattiva in corso nel processo, la annulla: il suo risultato non verrebbe
+    più letto. Le generazioni batch e di pre-warm dello stesso utente convivono.
+    
+    Se la generazione precedente è il leader di una chiamata di
+    _generation_flight con altre richieste in attesa, non viene annullata (le
+    altre riceverebbero l'errore): l'utente viene solo staccato da essa.
+    
+    Args:
+        owner (str|None): Utente che ha chiesto la generazione
+        priority (str): Classe di priorità della generazione
+        flight_call (optional): Chiamata di _generation_flight eseguita dalla
+            generazione; default quella del thread corrente
         
-        Utilizza il seguente template come base e personalizzalo in modo appropriato:
-        ---
-        {template['content']}
-        ---
+    Returns:
+        str: genkey della nuova generazione
+    """
+    genkey = kobold_client.new_genkey()
+    if owner is None or priority != PRIORITY_INTERACTIVE:
+        return genkey
+    
+    flight_call = flight_call or _generation_flight.current_call()
+    with _owner_generations_lock:
+        previous = _owner_generations.get(owner)
+        _owner_generations[owner] = (genkey, flight_call)
+    if previous is not None:
+        previous_genkey, previous_call = previous
+        if previous_call is None or _generation_flight.abandon(previous_call):
+            kobold_client.cancel_generation(previous_genkey, 'replaced')
+        else:
+            logging.debug(f"Generazione {previous_genkey} attesa da altre richieste: non viene annullata")
+    return genkey
+
+def _release_generation(owner, genkey):
+    """Rimuove la generazione conclusa dall'elenco di quelle in corso dell'utente."""
+    if owner is None:
+        return
+    with _owner_generations_lock:
+        current = _owner_generations.get(owner)
+        if current is not None and current[0] == genkey:
+            del _owner_generations[owner]
+
+def _track_generation(delta):
+    """Aggiorna il contatore delle generazioni Kobold in corso."""
+    global _active_generations
+    with _active_generations_lock:
+        _active_generations += delta
+
+def active_generations():
+    """
+    Restituisce il numero di generazioni Kobold in corso nel processo.
+    
+    Returns:
+        int: Generazioni in corso (sincrone e in streaming)
+    """
+    with _active_generations_lock:
+        return _active_generations
+
+def _generate_and_cache(cache_key, company, template, owner=None, priority=PRIORITY_INTERACTIVE,
+                        replace_previous=True):
+    """
+    Genera il testo tramite Kobold e lo salva in cache.
+    
+    Returns:
+        str: Testo generato (può essere vuoto)
+    """
+    generated_request = _generate_with_kobold(company, template, owner, priority, replace_previous=replace_previous)
+    
+    # Salva in cache per usi futuri
+    if generated_request:
+        _cache_request(cache_key, generated_request, company, template)
+    
+    return generated_request
+
+def generate_review_variants(company, template, count=3, use_cache=True, owner=None):
+    """
+    Genera più varianti alternative della richiesta di recensione.
+    
+    Il prompt viene elaborato una sola volta e le varianti sono prodotte dalla
+    stessa chiamata al backend (vedi KoboldClient.generate_variants); vengono
+    salvate in cache insieme, con una chiave distinta da quella del testo singolo.
+    
+    Args:
+        company (dict): Dati dell'azienda
+        template (dict): Template da utilizzare come base
+        count (int): Numero di varianti (limitato a MAX_VARIANTS)
+        use_cache (bool): Se usare la cache
+        owner (str, optional): Utente che ha chiesto le varianti (equità nello scheduler)
         
-        Requisiti:
-        1. La richiesta deve essere professionale, convincente e in italiano corretto
-        2. Personalizza il messaggio con i dettagli specifici dell'azienda
-        3. Aggiungi un'introduzione formale e una chiusura cordiale
-        4. Evidenzia il valore della recensione per entrambe le parti
-        5. Mantieni un tono rispettoso e professionale
-        6. Non includere placeholder o testo generico che deve essere sostituito
+    Returns:
+        dict: {'variants': lista di testi, 'source': 'cache'|'ai'|'fallback'}
+    """
+    count = max(1, min(int(count), MAX_VARIANTS))
+    cache_key = f"{_generate_cache_key(company, template)}:v{count}"
+    
+    if use_cache:
+        cached_result = _get_cached_variants(cache_key)
+        if cached_result:
+            logging.info(f"Usando varianti in cache per {company['name']}")
+            AI_REVIEW_REQUESTS.inc(source='cache')
+            return {'variants': cached_result, 'source': 'cache'}
+    
+    try:
+        if not kobold_health_monitor.is_available():
+            raise GenerationUnavailableError("Kobold API non disponibile secondo l'ultimo controllo")
+        
+        if use_cache:
+            variants = _generation_flight.do(
+                cache_key,
+                lambda: _generate_variants_and_cache(cache_key, company, template, count, owner),
+                lookup=lambda: _get_cached_variants(cache_key, peek=True)
+            )
+        else:
+            variants = _generate_variants_with_kobold(company, template, count, owner)
+        
+        if variants:
+            AI_REVIEW_REQUESTS.inc(source='ai')
+            return {'variants': variants, 'source': 'ai'}
+    except Exception as e:
+        logging.error(f"Errore nella generazione delle varianti: {str(e)}")
+    
+    AI_REVIEW_REQUESTS.inc(source='fallback')
+    return {'variants': [generate_fallback_request(company, template)], 'source': 'fallback'}
+
+def _generate_variants_with_kobold(company, template, count, owner=None):
+    """
+    Genera le varianti tramite l'API Kobold, senza cache né fallback.
+    
+    Returns:
+        list: Testi generati (possono essere meno di count)
+    """
+    max_length = length_predictor.predict(template)
+    full_prompt = _build_prompt(company, template, max_length=max_length)
+    
+    logging.info(f"Generazione di {count} varianti per {company['name']} tramite API Kobold")
+    with generation_scheduler.slot(PRIORITY_INTERACTIVE, owner, timeout=_slot_timeout(PRIORITY_INTERACTIVE)):
+        generation_start = time.time()
+        result = 'error'
+        _track_generation(1)
+        try:
+            generated_texts = kobold_client.generate_variants(
+                prompt=full_prompt,
+                count=count,
+                max_length=max_length,
+                temperature=0.7,
+                stop_sequence=STOP_SEQUENCES
+            )
+            result = 'ok'
+        finally:
+            _track_generation(-1)
+            AI_GENERATION_DURATION.observe(time.time() - generation_start, mode='variants', result=result)
+    
+    variants = [clean_generated_text(text.replace(full_prompt, "")) for text in generated_texts]
+    variants = [text for text in variants if text]
+    for text in variants:
+        length_predictor.record(template, max_length, text=text, mode='variants')
+    return variants
+
+def _generate_variants_and_cache(cache_key, company, template, count, owner=None):
+    """
+    Genera le varianti e le salva in cache come un'unica voce.
+    
+    Returns:
+        list: Testi generati
+    """
+    variants = _generate_variants_with_kobold(company, template, count, owner)
+    if variants:
+        _cache_request(cache_key, json.dumps(variants, ensure_ascii=False), company, template)
+    return variants
+
+def _get_cached_variants(cache_key, peek=False):
+    """
+    Recupera dalla cache le varianti salvate con _generate_variants_and_cache.
+    
+    Args:
+        cache_key (str): Chiave di cache
+        peek (bool): Lettura senza effetti su statistiche e LRU (controlli ripetuti)
+    
+    Returns:
+        list|None: Varianti in cache o None se non disponibili
+    """
+    entry = ai_cache.peek(cache_key) if peek else ai_cache.get(cache_key)
+    if not entry:
+        return None
+    try:
+        return json.loads(entry['value'])
+    except ValueError:
+        return None
+
+def _build_prompt(company, template, max_length=1000, slots=None):
+    """
+    Costruisce il prompt completo da inviare a Kobold.
+    
+    Args:
+        company (dict): Dati dell'azienda
+        template (dict): Template da utilizzare come base
+        max_length (int): Token riservati alla generazione
+        
+    Returns:
+        str: Prompt compatto, entro il contesto del modello
+    """
+    category_name = template_engine.category_name(company.get('category'), default=None)
+    return prompt_builder.build(company, template, max_length=max_length, category_name=category_name, slots=slots)
+
+def stream_review_request(company, template, use_cache=True, owner=None):
+    """
+    Generate a review request streaming the tokens as they are produced.
+    
+    Se la richiesta è in cache o l'API non è disponibile il testo completo viene
+    restituito in un unico evento. Al termine dello stream il testo generato
+    viene salvato nella cache come per generate_review_request.
+    
+    Args:
+        company (dict): Company information including name, products, category
+        template (dict): Template content to be used as base for the request
+        use_cache (bool): Whether to use caching for faster responses
+        owner (str, optional): Utente che ha chiesto la generazione; una sua nuova
+                               richiesta annulla quella ancora in corso
+        
+    Yields:
+        dict: Eventi {'type': 'token', 'text': ...} seguiti da un evento finale
+              {'type': 'done', 'message': ..., 'source': 'cache'|'ai'|'fallback'}
+    """
+    events = _stream_review_events(company, template, use_cache, owner)
+    try:
+        for event in events:
+            if event['type'] == 'done':
+                AI_REVIEW_REQUESTS.inc(source=event['source'])
+            yield event
+    finally:
+        # Chiude subito lo stream interno (e la connessione a Kobold) se il client si disconnette
+        events.close()
+
+def _stream_review_events(company, template, use_cache=True, owner=None):
+    """Produce gli eventi di stream_review_request."""
+    cache_key = _generate_cache_key(company, template)
+    
+    if use_cache:
+        cached_result = _get_cached_request(cache_key, company, template)
+        if cached_result:
+            logging.info(f"Usando richiesta in cache per {company['name']}")
+            yield {'type': 'done', 'message': cached_result, 'source': 'cache'}
+            return
+    
+    if not kobold_health_monitor.is_available():
+        logging.warning("Kobold API non è disponibile secondo l'ultimo controllo, utilizzo il fallback")
+        yield {'type': 'done', 'message': generate_fallback_request(company, template), 'source': 'fallback'}
+        return
+    
+    # Se una generazione identica è già in corso nel processo ne riutilizziamo il risultato
+    flight_call = None
+    if use_cache:
+        flight_call, leader = _generation_flight.begin(cache_key)
+        if not leader:
+            try:
+                shared_result = flight_call.wait()
+            except Exception:
+                shared_result = None
+            if shared_result:
+                logging.info(f"Riutilizzo della generazione in corso per {company['name']}")
+                yield {'type': 'done', 'message': shared_result, 'source': 'ai'}
+                return
+            flight_call = None
+    
+    generated_request = None
+    try:
+        generated_request = yield from _stream_with_kobold(company, template, cache_key if use_cache else None, owner,
+                                                           flight_call=flight_call)
+    finally:
+        # Risveglia le chiamate in attesa anche se il client si è disconnesso
+        if flight_call is not None:
+            _generation_flight.finish(cache_key, flight_call, generated_request)
+
+def _stream_with_kobold(company, template, cache_key=None, owner=None, flight_call=None):
+    """
+    Genera in streaming tramite Kobold, con fallback e salvataggio in cache.
+    
+    Se il consumatore chiude lo stream (client disconnesso) la generazione viene
+    interrotta anche sul backend (vedi KoboldClient.generate_text_stream).
+    
+    Args:
+        company (dict): Dati dell'azienda
+        template (dict): Template da utilizzare come base
+        cache_key (str, optional): Chiave con cui salvare il testo completo
+        owner (str, optional): Utente che ha chiesto la generazione
+        flight_call (optional): Chiamata di _generation_flight di cui lo stream è leader
         
-        Fornisci solo il testo della richiesta, senza commenti aggiuntivi.
-        """
+    Yields:
+        dict: Eventi di token ed evento finale, come stream_review_request
         
-        # Utilizziamo il client Kobold per generare il testo
-        logging.info(f"Generazione richiesta per {company['name']} tramite API Kobold")
+    Returns:
+        str|None: Testo generato completo, o None se non è stato possibile generarlo
+    """
+    max_length = length_predictor.predict(template)
+    full_prompt = _build_prompt(company, template, max_length=max_length)
+    tokens = []
+    
+    # Lo slot dello scheduler resta occupato per tutta la durata dello stream
+    try:
+        ticket = generation_scheduler.acquire(PRIORITY_INTERACTIVE, owner, timeout=_slot_timeout(PRIORITY_INTERACTIVE))
+    except SchedulerTimeoutError as e:
+        logging.warning(f"{str(e)}, utilizzo il fallback")
+        yield {'type': 'done', 'message': generate_fallback_request(company, template), 'source': 'fallback'}
+        return
+    
+    genkey = _claim_generation(owner, flight_call=flight_call)
+    _track_generation(1)
+    try:
+        logging.info(f"Generazione in streaming per {company['name']} tramite API Kobold")
         generation_start = time.time()
-        full_prompt = f"{system_prompt}\n\n{prompt}"
-        generated_text = kobold_client.generate_text(
-            prompt=full_prompt,
-            max_length=1000,
-            temperature=0.7
-        )
-        generation_time = time.time() - generation_start
+        first_token_time = None
         
-        # Pulisci la risposta da eventuali artefatti di formattazione
-        generated_request = generated_text.replace(full_prompt, "").strip()
+        for token in kobold_client.generate_text_stream(prompt=full_prompt, max_length=max_length, temperature=0.7,
+                                                        stop_sequence=STOP_SEQUENCES, genkey=genkey,
+                                                        deadline=GENERATION_DEADLINE):
+            if first_token_time is None:
+                first_token_time = time.time() - generation_start
+                AI_FIRST_TOKEN_DURATION.observe(first_token_time)
+                logging.debug(f"Primo token ricevuto in {first_token_time:.2f}s")
+            tokens.append(token)
+            yield {'type': 'token', 'text': token}
+        
+        generated_request = clean_generated_text("".join(tokens))
+        AI_GENERATION_DURATION.observe(time.time() - generation_start, mode='stream', result='ok')
+        logging.debug(f"Richiesta generata in streaming in {time.time() - generation_start:.2f}s")
+    except Exception as e:
+        AI_GENERATION_DURATION.observe(time.time() - generation_start, mode='stream', result='error')
+        logging.error(f"Error streaming review request: {str(e)}")
+        if tokens:
+            # Lo stream si è interrotto a metà: non salvare in cache un testo troncato
+            yield {'type': 'done', 'message': clean_generated_text("".join(tokens)), 'source': 'ai', 'truncated': True}
+        else:
+            yield {'type': 'done', 'message': generate_fallback_request(company, template), 'source': 'fallback'}
+        return
+    finally:
+        _track_generation(-1)
+        _release_generation(owner, genkey)
+        generation_scheduler.release(ticket)
+    
+    if not generated_request:
+        yield {'type': 'done', 'message': generate_fallback_request(company, template), 'source': 'fallback'}
+        return
+    
+    # Ogni evento dello streaming corrisponde a un token del modello
+    length_predictor.record(template, max_length, output_tokens=len(tokens), mode='stream')
+    
+    if cache_key:
+        _cache_request(cache_key, generated_request, company, template)
+    
+    yield {'type': 'done', 'message': generated_request, 'source': 'ai'}
+    return generated_request
+
+def prewarm_review_request(company, template):
+    """
+    Genera e salva in cache una richiesta in anticipo, senza usare il fallback.
+    
+    Args:
+        company (dict): Dati dell'azienda
+        template (dict): Dati del template
         
-        logging.debug(f"Richiesta generata in {generation_time:.2f}s: {generated_request[:100]}...")
+    Returns:
+        str: 'cached' se già presente in cache, 'generated' se generata,
+             'skipped' se l'API non è disponibile o non ha prodotto testo
+    """
+    cache_key = _generate_cache_key(company, template)
+    
+    if _get_cached_request(cache_key, company, template):
+        return 'cached'
+    
+    if not kobold_health_monitor.is_available():
+        return 'skipped'
+    
+    generated_request = _generation_flight.do(
+        cache_key,
+        lambda: _generate_and_cache(cache_key, company, template, priority=PRIORITY_PREWARM),
+        lookup=lambda: _get_cached_request(cache_key, peek=True)
+    )
+    return 'generated' if generated_request else 'skipped'
+
+def generate_cluster_requests(cluster, template, use_cache=True, owner=None, priority=PRIORITY_BATCH):
+    """
+    Genera un unico testo per un gruppo di aziende simili e lo personalizza per ciascuna.
+    
+    Il modello riceve l'azienda "modello" del gruppo (vedi CompanyCluster.slot_company)
+    e lascia nel testo i segnaposto di nome e sito web, che il motore di template
+    completa per ogni azienda. Il testo del gruppo viene salvato in cache con una
+    chiave propria, indicizzata per template.
+    
+    Args:
+        cluster (CompanyCluster): Gruppo di aziende
+        template (dict): Template da utilizzare come base
+        use_cache (bool): Se usare la cache
+        owner (str, optional): Utente che ha avviato la generazione (equità nello scheduler)
+        priority (str): Classe di priorità nello scheduler
         
-        # Salva in cache per usi futuri
-        if use_cache and generated_request:
-            _cache_request(cache_key, generated_request)
+    Returns:
+        dict: {'messages': testi nello stesso ordine di cluster.companies,
+               'source': 'cache'|'ai'|'fallback'}
+    """
+    cache_key = f"cluster:{_generate_cache_key(cluster.slot_company(), template)}"
+    count = len(cluster.companies)
+    
+    if use_cache:
+        cached_result = _get_cached_request(cache_key)
+        if cached_result:
+            logging.info(f"Usando testo in cache per il gruppo {cluster.key} ({count} aziende)")
+            AI_REVIEW_REQUESTS.inc(count, source='cache')
+            return {'messages': _render_cluster(cached_result, cluster), 'source': 'cache'}
+    
+    try:
+        if not kobold_health_monitor.is_available():
+            raise GenerationUnavailableError("Kobold API non disponibile secondo l'ultimo controllo")
         
-        return generated_request
+        if use_cache:
+            text = _generation_flight.do(
+                cache_key,
+                lambda: _generate_cluster_and_cache(cache_key, cluster, template, owner, priority),
+                lookup=lambda: _get_cached_request(cache_key, peek=True)
+            )
+        else:
+            text = _generate_cluster_with_kobold(cluster, template, owner, priority)
         
+        if text:
+            AI_REVIEW_REQUESTS.inc(count, source='ai')
+            return {'messages': _render_cluster(text, cluster), 'source': 'ai'}
     except Exception as e:
-        logging.error(f"Error generating review request: {str(e)}")
-        # Utilizzo del sistema di fallback se si verifica un errore
-        logging.info("Utilizzo del sistema di fallback per la generazione della richiesta")
-        return generate_fallback_request(company, template)
+        logging.error(f"Errore nella generazione per il gruppo {cluster.key}: {str(e)}")
+    
+    AI_REVIEW_REQUESTS.inc(count, source='fallback')
+    return {
+        'messages': [generate_fallback_request(company, template) for company in cluster.companies],
+        'source': 'fallback'
+    }
+
+def _generate_cluster_with_kobold(cluster, template, owner=None, priority=PRIORITY_BATCH):
+    """
+    Genera il testo con segnaposto di un gruppo tramite l'API Kobold.
+    
+    Returns:
+        str: Testo generato (può essere vuoto)
+        
+    Raises:
+        ValueError: Se il testo contiene segnaposto che il motore di template non sa completare
+    """
+    text = _generate_with_kobold(cluster.slot_company(), template, owner, priority, slots=cluster.slots())
+    unknown = sorted({match.group(1).strip() for match in PLACEHOLDER_RE.finditer(text)} - set(PLACEHOLDERS))
+    if unknown:
+        raise ValueError(f"Segnaposto non riconosciuti nel testo generato: {', '.join(unknown)}")
+    return text
+
+def _generate_cluster_and_cache(cache_key, cluster, template, owner=None, priority=PRIORITY_BATCH):
+    """
+    Genera il testo di un gruppo e lo salva in cache.
+    
+    Returns:
+        str: Testo generato (può essere vuoto)
+    """
+    text = _generate_cluster_with_kobold(cluster, template, owner, priority)
+    if text:
+        _cache_request(cache_key, text, cluster.slot_company(), template)
+    return text
+
+def _render_cluster(text, cluster):
+    """Completa il testo di un gruppo con i dati di ciascuna azienda."""
+    return template_engine.render_many({'id': None, 'content': text}, cluster.companies)
+
+def generate_review_requests_batch(companies, template, max_workers=2, owner=None, clustered=False):
+    """
+    Genera richieste di recensione per più aziende in parallelo.
+    
+    Le generazioni vengono eseguite da un pool di worker di dimensione limitata,
+    in modo da non superare il numero di slot paralleli del server Kobold, con
+    priorità batch: le richieste interattive vengono servite per prime.
+    I risultati vengono restituiti man mano che le singole generazioni terminano.
+    
+    Con clustered=True le aziende con stessa categoria e stessi prodotti vengono
+    raggruppate e ogni gruppo richiede una sola generazione (vedi
+    generate_cluster_requests); i risultati di un gruppo arrivano insieme.
+    
+    Args:
+        companies (list): Lista di dizionari con i dati delle aziende
+        template (dict): Template da utilizzare per tutte le aziende
+        max_workers (int): Numero massimo di generazioni concorrenti
+        owner (str, optional): Utente che ha avviato il batch (equità tra utenti)
+        clustered (bool): Se generare un solo testo per gruppo di aziende simili
+        
+    Yields:
+        dict: Risultato per ogni azienda, in ordine di completamento
+    """
+    from app import app
+    
+    def _generate_for_company(company):
+        # Ogni worker ha bisogno del proprio contesto applicativo per accedere al database
+        with app.app_context():
+            start_time = time.time()
+            try:
+                message = generate_review_request(company, template, owner=owner, priority=PRIORITY_BATCH)
+                return {
+                    'company_id': company['id'],
+                    'company_name': company['name'],
+                    'success': True,
+                    'message': message,
+                    'duration': round(time.time() - start_time, 3)
+                }
+            except Exception as e:
+                logging.error(f"Errore nella generazione batch per {company['name']}: {str(e)}")
+                return {
+                    'company_id': company['id'],
+                    'company_name': company['name'],
+                    'success': False,
+                    'error': str(e),
+                    'duration': round(time.time() - start_time, 3)
+                }
+    
+    def _generate_for_cluster(cluster):
+        with app.app_context():
+            start_time = time.time()
+            try:
+                result = generate_cluster_requests(cluster, template, owner=owner, priority=PRIORITY_BATCH)
+                outcomes = [{'success': True, 'message': message} for message in result['messages']]
+            except Exception as e:
+                logging.error(f"Errore nella generazione batch per il gruppo {cluster.key}: {str(e)}")
+                outcomes = [{'success': False, 'error': str(e)}] * len(cluster.companies)
+            duration = round(time.time() - start_time, 3)
+            return [
+                dict(outcome, company_id=company['id'], company_name=company['name'], cluster=cluster.key,
+                     cluster_size=len(cluster.companies), duration=duration)
+                for company, outcome in zip(cluster.companies, outcomes)
+            ]
+    
+    executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix='kobold-batch')
+    try:
+        if clustered:
+            clusters = cluster_companies(companies)
+            logging.info(f"Generazione per gruppi: {len(companies)} aziende in {len(clusters)} gruppi")
+            futures = [executor.submit(_generate_for_cluster, cluster) for cluster in clusters]
+            for future in as_completed(futures):
+                yield from future.result()
+        else:
+            futures = [executor.submit(_generate_for_company, company) for company in companies]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        # Se il client smette di leggere i risultati, annulla le generazioni non ancora avviate
+        executor.shutdown(wait=False, cancel_futures=True)
 
 def _generate_cache_key(company, template):
     """
@@ -131,60 +775,94 @@ def _generate_cache_key(company, template):
     combined_data = json.dumps({"company": company_data, "template": template_data}, sort_keys=True)
     return hashlib.md5(combined_data.encode()).hexdigest()
 
-def _get_cached_request(cache_key):
+def _get_cached_request(cache_key, company=None, template=None, peek=False):
     """
     Recupera una richiesta dalla cache se esiste e non è scaduta.
     
+    Se la voce è prossima alla scadenza viene comunque restituita e, quando sono
+    disponibili i dati di azienda e template, ne viene avviata la rigenerazione
+    in background.
+    
     Args:
         cache_key (str): Chiave di cache
+        company (dict, optional): Dati dell'azienda, per la rigenerazione
+        template (dict, optional): Dati del template, per la rigenerazione
+        peek (bool): Lettura senza effetti su statistiche e LRU (controlli ripetuti)
         
     Returns:
         str|None: Richiesta in cache o None se non disponibile
     """
-    CACHE_DIR.mkdir(parents=True, exist_ok=True)
-    cache_file = CACHE_DIR / f"{cache_key}.json"
-    
-    if not cache_file.exists():
+    entry = ai_cache.peek(cache_key) if peek else ai_cache.get(cache_key)
+    if not entry:
         return None
     
+    if entry['stale'] and company and template:
+        _schedule_refresh(cache_key, company, template)
+    
+    return entry['value']
+
+def _schedule_refresh(cache_key, company, template):
+    """
+    Pianifica la rigenerazione in background di una voce di cache.
+    
+    Ogni chiave viene rigenerata al massimo una volta alla volta per processo.
+    """
+    with _refreshing_lock:
+        if cache_key in _refreshing_keys:
+            return
+        _refreshing_keys.add(cache_key)
+    
+    logging.debug(f"Rigenerazione in background della cache per {company['name']}")
+    _refresh_executor.submit(_refresh_cached_request, cache_key, company, template)
+
+def _refresh_cached_request(cache_key, company, template):
+    """Rigenera una voce di cache; in caso di errore la voce esistente resta valida fino alla scadenza."""
+    from app import app
+    
     try:
-        with open(cache_file, 'r', encoding='utf-8') as f:
-            cache_data = json.load(f)
-        
-        # Verifica validità cache
-        if time.time() - cache_data['timestamp'] > CACHE_VALIDITY:
-            logging.debug(f"Cache scaduta per {cache_key}")
-            return None
-        
-        return cache_data['request']
+        with app.app_context():
+            if not kobold_health_monitor.is_available():
+                return
+            generated_request = _generate_with_kobold(company, template, priority=PRIORITY_PREWARM)
+            if generated_request:
+                _cache_request(cache_key, generated_request, company, template)
     except Exception as e:
-        logging.warning(f"Errore nel recupero cache: {e}")
-        return None
+        logging.warning(f"Errore nella rigenerazione della cache per {company['name']}: {str(e)}")
+    finally:
+        with _refreshing_lock:
+            _refreshing_keys.discard(cache_key)
 
-def _cache_request(cache_key, request_text):
+def _cache_request(cache_key, request_text, company, template):
     """
-    Salva una richiesta in cache.
+    Salva una richiesta in cache, indicizzata per template e azienda.
     
     Args:
         cache_key (str): Chiave di cache
         request_text (str): Testo della richiesta da salvare
+        company (dict): Dati dell'azienda
+        template (dict): Dati del template
+    """
+    ai_cache.set(cache_key, request_text, template_id=template.get('id'), company_id=company.get('id'))
+    logging.debug(f"Richiesta salvata in cache: {cache_key}")
+
+def invalidate_cached_requests(template_id=None, company_id=None):
     """
-    CACHE_DIR.mkdir(parents=True, exist_ok=True)
-    cache_file = CACHE_DIR / f"{cache_key}.json"
+    Elimina dalla cache le richieste generate per un template e/o un'azienda.
     
-    try:
-        cache_data = {
-            'timestamp': time.time(),
-            'request': request_text
-        }
-        
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(cache_data, f, ensure_ascii=False, indent=2)
+    Da chiamare quando template o azienda vengono modificati o eliminati: le
+    voci non più valide vengono rimosse subito invece di attendere la scadenza.
+    
+    Args:
+        template_id (str, optional): ID del template
+        company_id (str, optional): ID dell'azienda
         
-        logging.debug(f"Richiesta salvata in cache: {cache_key}")
-    except Exception as e:
-        logging.warning(f"Errore nel salvataggio in cache: {e}")
-        # Non solleviamo l'eccezione per non interrompere il flusso principale
+    Returns:
+        int: Numero di voci eliminate
+    """
+    removed = ai_cache.invalidate(template_id=template_id, company_id=company_id)
+    if removed:
+        logging.info(f"Cache AI: invalidate {removed} voci (template={template_id}, azienda={company_id})")
+    return removed
 
 def generate_fallback_request(company, template):
     """
@@ -198,28 +876,27 @@ def generate_fallback_request(company, template):
         str: The basic review request message
     """
     try:
-        # Base template with simple replacements
-        content = template['content']
-        content = content.replace("[Nome Azienda]", company['name'])
-        
-        # Get category name
-        from services.data_service import get_categories
-        categories = get_categories()
-        category_name = "prodotti"
-        
-        for category in categories:
-            if category['id'] == company.get('category'):
-                category_name = category['name']
-                break
-        
-        content = content.replace("[Categoria]", category_name)
-        content = content.replace("[Nome]", "Team C-Recenzione")
-        
-        return content
+        # Template precompilato: nessuna query, la categoria viene dalla mappa in memoria
+        return template_engine.render(template, company)
     except Exception as e:
         logging.error(f"Error generating fallback request: {str(e)}")
         return template['content']
 
+def _collect_cache_metrics():
+    """Metriche istantanee della cache AI per /metrics."""
+    stats = ai_cache.stats()
+    return [
+        ('ai_cache_entries', 'gauge', "Voci presenti nella cache AI per livello", [
+            ({'tier': stats['backend']}, stats['entries']),
+            ({'tier': 'memory'}, stats['memory']['entries'])
+        ]),
+        ('ai_generations_in_progress', 'gauge', "Generazioni Kobold in corso nel processo che risponde", [
+            ({}, active_generations())
+        ])
+    ]
+
+metrics.register_collector(_collect_cache_metrics)
+
 def generate_company_suggestions(category_id, search_term=None):
     """
     Generate company suggestions for a given category using AI.
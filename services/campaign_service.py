@@ -0,0 +1,173 @@
+"""
+Campaign Service
+
+Questo modulo accoda una campagna di richieste di recensione: le coppie
+(azienda, messaggio) diventano righe Request in stato 'queued' con il
+relativo messaggio dell'outbox, inserite a blocchi con un unico commit. Le
+email vengono poi spedite dal worker dell'outbox (worker.py), che rispetta un
+limite di invii al secondo per trasporto (token bucket per Mailtrap, SMTP e
+salvataggio locale, definiti qui); con Mailtrap i messaggi partono a blocchi
+tramite l'endpoint batch e il limite vale per richiesta HTTP.
+
+I limiti di frequenza valgono per processo.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import insert
+
+# Invii (richieste al provider) al secondo per trasporto (0 = nessun limite)
+TRANSPORT_RATES = {
+    'mailtrap': float(os.environ.get("EMAIL_RATE_MAILTRAP", 2)),
+    'smtp': float(os.environ.get("EMAIL_RATE_SMTP", 10)),
+    'local': float(os.environ.get("EMAIL_RATE_LOCAL", 0))
+}
+
+# Righe Request (e messaggi dell'outbox) inserite con una sola istruzione
+REQUEST_INSERT_BATCH = int(os.environ.get("CAMPAIGN_INSERT_BATCH", 50))
+
+# Numero massimo di messaggi in una campagna
+MAX_CAMPAIGN_SIZE = int(os.environ.get("CAMPAIGN_MAX_SIZE", 1000))
+
+class TokenBucket:
+    """Limite di frequenza: `rate` operazioni al secondo con raffiche fino a `burst`."""
+
+    def __init__(self, rate, burst=None):
+        """
+        Inizializza il bucket pieno.
+
+        Args:
+            rate (float): Token aggiunti al secondo
+            burst (float, optional): Capienza del bucket (default: un secondo di token, almeno 1)
+        """
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Attende un token e lo consuma.
+
+        Returns:
+            float: Secondi di attesa
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class TransportRateLimiter:
+    """Token bucket per trasporto, condivisi da tutte le campagne del processo."""
+
+    def __init__(self, rates=None):
+        """
+        Inizializza il limitatore.
+
+        Args:
+            rates (dict, optional): Invii al secondo per trasporto (default TRANSPORT_RATES)
+        """
+        self.rates = dict(rates or TRANSPORT_RATES)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, transport):
+        """
+        Attende il turno di un invio sul trasporto indicato.
+
+        Args:
+            transport (str): 'mailtrap', 'smtp' o 'local'
+
+        Returns:
+            float: Secondi di attesa
+        """
+        rate = self.rates.get(transport, 0)
+        if rate <= 0:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(transport)
+            if bucket is None:
+                bucket = self._buckets[transport] = TokenBucket(rate)
+        return bucket.acquire()
+
+# Istanza globale del limitatore
+rate_limiter = TransportRateLimiter()
+
+def enqueue_campaign(items, subject, template_id=None, user_id=None):
+    """
+    Accoda una campagna nell'outbox: le righe Request (stato 'queued') e i
+    relativi OutboxMessage vengono inseriti a blocchi di REQUEST_INSERT_BATCH
+    con istruzioni INSERT multiple e un unico commit. L'invio è a carico del
+    worker (vedi services/outbox_service.py).
+
+    Va eseguita in un contesto applicativo.
+
+    Args:
+        items (list): Dizionari con 'company_id', 'email' e 'message'
+        subject (str): Oggetto delle email
+        template_id (str, optional): Template usato per i messaggi
+        user_id (str, optional): Utente che invia la campagna
+
+    Returns:
+        list: ID delle richieste accodate, nello stesso ordine dei messaggi
+    """
+    from app import db
+    from models import Request, OutboxMessage
+    from services.outbox_service import OUTBOX_MAX_ATTEMPTS
+
+    now = datetime.utcnow()
+    request_rows = []
+    outbox_rows = []
+    for item in items:
+        request_id = str(uuid.uuid4())
+        request_rows.append({
+            'id': request_id,
+            'company_id': item['company_id'],
+            'template_id': template_id,
+            'user_id': user_id,
+            'subject': subject,
+            'message': item['message'],
+            'date_sent': now,
+            'status': 'queued',
+            'opened': False,
+            'responded': False,
+            'opened_count': 0
+        })
+        outbox_rows.append({
+            'id': str(uuid.uuid4()),
+            'request_id': request_id,
+            'recipient': item['email'],
+            'status': 'pending',
+            'attempts': 0,
+            'max_attempts': OUTBOX_MAX_ATTEMPTS,
+            'next_attempt_at': now,
+            'created_at': now,
+            'updated_at': now
+        })
+
+    try:
+        for start in range(0, len(items), max(1, REQUEST_INSERT_BATCH)):
+            end = start + max(1, REQUEST_INSERT_BATCH)
+            db.session.execute(insert(Request), request_rows[start:end])
+            db.session.execute(insert(OutboxMessage), outbox_rows[start:end])
+        # Tutta la campagna nella stessa transazione: o viene accodata per intero o per niente
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logging.info(f"Campagna di {len(items)} messaggi accodata per l'invio")
+    return [row['id'] for row in request_rows]
@@ -0,0 +1,108 @@
+"""
+Cluster Service
+
+Questo modulo raggruppa le aziende di una campagna che hanno la stessa
+categoria e lo stesso profilo di prodotti (elenco normalizzato: minuscole,
+spazi e punteggiatura uniformati, ordine ignorato). Per ogni gruppo viene
+generato un solo testo con i segnaposto [Nome Azienda] e [Sito Web], che il
+motore di template (vedi template_engine) completa per ciascuna azienda senza
+altre chiamate al modello: le chiamate passano da N aziende a K gruppi.
+"""
+
+import re
+import hashlib
+from collections import OrderedDict
+
+# Segnaposto lasciati dal modello nel testo di un gruppo
+NAME_SLOT = '[Nome Azienda]'
+WEBSITE_SLOT = '[Sito Web]'
+
+# Separatori degli elementi dell'elenco prodotti
+_PRODUCT_SEPARATORS_RE = re.compile(r'[,;\n/|]+|\s+e\s+|\s+ed\s+')
+# Caratteri ignorati nel confronto dei prodotti (punteggiatura)
+_PUNCTUATION_RE = re.compile(r'[^\w\s\'-]')
+_SPACES_RE = re.compile(r'\s+')
+
+def normalize_products(products):
+    """
+    Normalizza un elenco di prodotti per il confronto tra aziende.
+
+    Args:
+        products (str): Prodotti come inseriti nell'anagrafica
+
+    Returns:
+        tuple: Prodotti distinti, in minuscolo e in ordine alfabetico
+    """
+    items = set()
+    for item in _PRODUCT_SEPARATORS_RE.split((products or '').casefold()):
+        item = _SPACES_RE.sub(' ', _PUNCTUATION_RE.sub(' ', item)).strip()
+        if item:
+            items.add(item)
+    return tuple(sorted(items))
+
+class CompanyCluster:
+    """Gruppo di aziende per cui viene generato un unico testo con segnaposto."""
+
+    __slots__ = ('key', 'category', 'profile', 'has_website', 'companies')
+
+    def __init__(self, category, profile, has_website):
+        """
+        Inizializza un gruppo vuoto.
+
+        Args:
+            category (str): ID della categoria delle aziende
+            profile (tuple): Prodotti normalizzati (vedi normalize_products)
+            has_website (bool): Se tutte le aziende del gruppo hanno un sito web
+        """
+        self.category = category
+        self.profile = profile
+        self.has_website = has_website
+        signature = '\n'.join((category or '', str(has_website)) + profile)
+        self.key = hashlib.md5(signature.encode('utf-8')).hexdigest()[:12]
+        self.companies = []
+
+    def slot_company(self):
+        """
+        Restituisce l'azienda "modello" del gruppo, da usare nel prompt.
+
+        Nome e sito web sono segnaposto; prodotti e categoria sono quelli comuni
+        a tutte le aziende del gruppo.
+
+        Returns:
+            dict: Dati dell'azienda con segnaposto
+        """
+        return {
+            'id': None,
+            'name': NAME_SLOT,
+            'products': ', '.join(self.profile),
+            'category': self.category,
+            'website': WEBSITE_SLOT if self.has_website else ''
+        }
+
+    def slots(self):
+        """Segnaposto che il modello deve lasciare nel testo."""
+        return [NAME_SLOT, WEBSITE_SLOT] if self.has_website else [NAME_SLOT]
+
+def cluster_companies(companies):
+    """
+    Raggruppa le aziende per categoria, profilo dei prodotti e presenza del sito.
+
+    Il sito web fa parte della chiave perché un testo che lo cita non può
+    essere usato per un'azienda che non ne ha uno.
+
+    Args:
+        companies (list): Lista di dizionari delle aziende
+
+    Returns:
+        list: CompanyCluster nell'ordine di prima apparizione
+    """
+    clusters = OrderedDict()
+    for company in companies:
+        profile = normalize_products(company.get('products'))
+        has_website = bool((company.get('website') or '').strip())
+        key = (company.get('category'), profile, has_website)
+        cluster = clusters.get(key)
+        if cluster is None:
+            cluster = clusters[key] = CompanyCluster(*key)
+        cluster.companies.append(company)
+    return list(clusters.values())
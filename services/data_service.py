@@ -43,6 +43,9 @@ def add_category(category_data):
         )
         db.session.add(category)
         db.session.commit()
+        # Il nuovo nome deve comparire subito nei messaggi generati
+        from services.template_engine import template_engine
+        template_engine.invalidate_categories()
         return category.to_dict()
     except Exception as e:
         logging.error(f"Error adding category: {str(e)}")
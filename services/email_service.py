@@ -1,17 +1,51 @@
 import os
 import logging
-import smtplib
-import json
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from datetime import datetime
-from pathlib import Path
+from services.metrics import EMAIL_SEND_DURATION
+from services.smtp_pool import smtp_pools
+from services.local_mail_store import local_mail_store
 
-# Cartella per salvare le email in modalità locale
-LOCAL_EMAIL_DIR = Path('data/local_emails')
+# URL base dell'API Mailtrap (sandbox); per i test può puntare a tools/fake_mailtrap.py
+MAILTRAP_API_BASE = os.environ.get("MAILTRAP_API_BASE", "https://sandbox.api.mailtrap.io").rstrip('/')
 
-def send_email(recipient_email, subject, message_body):
+# Timeout (connessione, lettura) in secondi delle richieste all'API Mailtrap
+MAILTRAP_TIMEOUT = (
+    float(os.environ.get("MAILTRAP_CONNECT_TIMEOUT", 5)),
+    float(os.environ.get("MAILTRAP_READ_TIMEOUT", 30))
+)
+
+# Messaggi inviati al massimo con una richiesta all'endpoint batch (limite dell'API: 500)
+MAILTRAP_BATCH_SIZE = int(os.environ.get("MAILTRAP_BATCH_SIZE", 500))
+
+# Connessioni HTTP mantenute aperte per host dalla sessione condivisa
+EMAIL_HTTP_POOL_SIZE = int(os.environ.get("EMAIL_HTTP_POOL_SIZE", 10))
+
+def _create_http_session(pool_size):
+    """
+    Crea la sessione HTTP condivisa dai trasporti via API.
+    
+    Args:
+        pool_size (int): Dimensione massima del pool per host
+        
+    Returns:
+        requests.Session: Sessione configurata
+    """
+    session = requests.Session()
+    # Nessun tentativo automatico: un POST ripetuto potrebbe inviare due volte la stessa email
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Sessione HTTP globale: le connessioni (e l'handshake TLS) vengono riutilizzate tra gli invii
+http_session = _create_http_session(EMAIL_HTTP_POOL_SIZE)
+
+def send_email(recipient_email, subject, message_body, allow_local_fallback=True):
     """
     Send an email using Mailtrap API, SMTP or save locally in development mode.
     
@@ -19,6 +53,8 @@ def send_email(recipient_email, subject, message_body):
         recipient_email (str): The recipient's email address
         subject (str): The email subject
         message_body (str): The email body content
+        allow_local_fallback (bool): Se False un invio fallito solleva l'eccezione
+            invece di salvare l'email localmente (l'outbox la ritenta)
         
     Returns:
         dict: Result of the sending operation including status and timestamp
@@ -31,17 +67,16 @@ def send_email(recipient_email, subject, message_body):
     
     # Determina la modalità di invio
     use_local_storage = os.environ.get("EMAIL_LOCAL_STORAGE", "true").lower() == "true"
-    use_test_mode = os.environ.get("EMAIL_TEST_MODE", "false").lower() == "true"
-    use_mailtrap = os.environ.get("USE_MAILTRAP", "true").lower() == "true"
+    transport = select_transport()
     
     try:
         # Se è richiesto l'uso di Mailtrap e l'API token è disponibile
-        if use_mailtrap and os.environ.get("MAILTRAP_API_TOKEN"):
-            return send_via_mailtrap(sender_email, sender_name, recipient_email, subject, message_body, timestamp)
+        if transport == 'mailtrap':
+            return _timed('mailtrap', send_via_mailtrap, sender_email, sender_name, recipient_email, subject, message_body, timestamp)
         
         # Se è richiesto il salvataggio locale o attiva la modalità test
-        if use_local_storage or use_test_mode:
-            return save_email_locally(recipient_email, subject, message_body, timestamp)
+        if transport == 'local':
+            return _timed('local', save_email_locally, recipient_email, subject, message_body, timestamp)
         
         # Altrimenti tenta di inviare tramite SMTP
         # Creazione messaggio SMTP
@@ -51,19 +86,56 @@ def send_email(recipient_email, subject, message_body):
         msg['Subject'] = subject
         msg.attach(MIMEText(message_body, 'html'))
         
-        return send_via_smtp(msg, recipient_email, timestamp)
+        return _timed('smtp', send_via_smtp, msg, recipient_email, timestamp)
         
     except Exception as e:
         logging.error(f"Errore nell'invio dell'email: {str(e)}")
         
         # In caso di errore, fallback al salvataggio locale
-        if use_local_storage:
+        if use_local_storage and allow_local_fallback:
             logging.info("Fallback al salvataggio locale dell'email")
-            return save_email_locally(recipient_email, subject, message_body, timestamp)
+            return _timed('local', save_email_locally, recipient_email, subject, message_body, timestamp)
         
         # Se il fallback non è abilitato, alza l'eccezione
         raise Exception(f"Errore nell'invio dell'email: {str(e)}")
 
+def select_transport():
+    """
+    Restituisce il trasporto usato da send_email con la configurazione corrente.
+    
+    Returns:
+        str: 'mailtrap', 'local' o 'smtp'
+    """
+    use_local_storage = os.environ.get("EMAIL_LOCAL_STORAGE", "true").lower() == "true"
+    use_test_mode = os.environ.get("EMAIL_TEST_MODE", "false").lower() == "true"
+    use_mailtrap = os.environ.get("USE_MAILTRAP", "true").lower() == "true"
+    
+    if use_mailtrap and os.environ.get("MAILTRAP_API_TOKEN"):
+        return 'mailtrap'
+    if use_local_storage or use_test_mode:
+        return 'local'
+    return 'smtp'
+
+def _timed(transport, send_function, *args):
+    """
+    Esegue una funzione di invio registrandone la durata per trasporto.
+    
+    Args:
+        transport (str): Nome del trasporto (mailtrap, smtp, local)
+        send_function (callable): Funzione di invio
+        
+    Returns:
+        dict: Risultato della funzione di invio
+    """
+    start_time = time.time()
+    result = 'error'
+    try:
+        response = send_function(*args)
+        result = 'ok'
+        return response
+    finally:
+        EMAIL_SEND_DURATION.observe(time.time() - start_time, transport=transport, result=result)
+
 def send_via_mailtrap(sender_email, sender_name, recipient_email, subject, message_body, timestamp):
     """
     Invia un'email tramite Mailtrap API.
@@ -79,19 +151,9 @@ def send_via_mailtrap(sender_email, sender_name, recipient_email, subject, messa
     Returns:
         dict: Risultato dell'operazione
     """
-    mailtrap_token = os.environ.get("MAILTRAP_API_TOKEN")
-    mailtrap_inbox_id = os.environ.get("MAILTRAP_INBOX_ID", "3626747")  # ID della inbox Mailtrap
-    
-    if not mailtrap_token:
-        raise ValueError("Mailtrap API token non configurato")
-    
     logging.debug(f"Invio email tramite Mailtrap a {recipient_email} con oggetto: {subject}")
     
-    url = f"https://sandbox.api.mailtrap.io/api/send/{mailtrap_inbox_id}"
-    headers = {
-        "Authorization": f"Bearer {mailtrap_token}",
-        "Content-Type": "application/json"
-    }
+    url, headers = _mailtrap_endpoint('send')
     
     # Preparazione del payload
     payload = {
@@ -111,7 +173,7 @@ def send_via_mailtrap(sender_email, sender_name, recipient_email, subject, messa
     }
     
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = http_session.post(url, json=payload, headers=headers, timeout=MAILTRAP_TIMEOUT)
         response.raise_for_status()  # Solleva un'eccezione se la risposta non è 2xx
         
         result = response.json()
@@ -120,17 +182,163 @@ def send_via_mailtrap(sender_email, sender_name, recipient_email, subject, messa
         return {
             "status": "delivered",
             "date": timestamp,
-            "mailtrap_id": result.get("id", "unknown"),
+            "mailtrap_id": _mailtrap_message_id(result),
             "mailtrap_status": response.status_code
         }
     except Exception as e:
         logging.error(f"Errore nell'invio dell'email tramite Mailtrap: {str(e)}")
         raise
 
+def _mailtrap_endpoint(action):
+    """
+    Restituisce URL e intestazioni di un endpoint dell'API Mailtrap.
+    
+    Args:
+        action (str): 'send' o 'batch'
+        
+    Returns:
+        tuple: (url, headers)
+    """
+    mailtrap_token = os.environ.get("MAILTRAP_API_TOKEN")
+    mailtrap_inbox_id = os.environ.get("MAILTRAP_INBOX_ID", "3626747")  # ID della inbox Mailtrap
+    
+    if not mailtrap_token:
+        raise ValueError("Mailtrap API token non configurato")
+    
+    url = f"{MAILTRAP_API_BASE}/api/{action}/{mailtrap_inbox_id}"
+    headers = {
+        "Authorization": f"Bearer {mailtrap_token}",
+        "Content-Type": "application/json"
+    }
+    return url, headers
+
+def _mailtrap_message_id(result):
+    """Estrae l'ID del messaggio dalla risposta di Mailtrap."""
+    message_ids = result.get("message_ids") or []
+    return message_ids[0] if message_ids else result.get("id", "unknown")
+
+def send_email_batch(messages, subject, allow_local_fallback=True):
+    """
+    Invia più email con lo stesso oggetto.
+    
+    Con Mailtrap i messaggi vengono inviati all'endpoint batch, fino a
+    MAILTRAP_BATCH_SIZE per richiesta HTTP; con gli altri trasporti vengono
+    inviati uno alla volta con send_email. Un messaggio rifiutato non blocca
+    gli altri: l'esito è restituito per ciascun messaggio.
+    
+    Args:
+        messages (list): Coppie (destinatario, corpo HTML)
+        subject (str): Oggetto delle email
+        allow_local_fallback (bool): Se False i messaggi non inviati risultano
+            "failed" invece di essere salvati localmente
+        
+    Returns:
+        list: Per ogni messaggio, nello stesso ordine, il risultato dell'invio
+              (come send_email) oppure {"status": "failed", "error": ...}
+    """
+    if select_transport() != 'mailtrap':
+        results = []
+        for recipient_email, message_body in messages:
+            try:
+                results.append(send_email(recipient_email, subject, message_body, allow_local_fallback))
+            except Exception as e:
+                results.append({"status": "failed", "error": str(e)})
+        return results
+    
+    sender_email = os.environ.get("EMAIL_SENDER", "c-recenzione@example.com")
+    sender_name = os.environ.get("EMAIL_SENDER_NAME", "C-Recenzione")
+    batch_size = max(1, MAILTRAP_BATCH_SIZE)
+    
+    results = []
+    for start in range(0, len(messages), batch_size):
+        chunk = messages[start:start + batch_size]
+        timestamp = datetime.now().isoformat()
+        try:
+            chunk_results = _timed('mailtrap_batch', send_batch_via_mailtrap, sender_email, sender_name, chunk, subject, timestamp)
+        except Exception as e:
+            logging.error(f"Errore nell'invio del blocco di {len(chunk)} email tramite Mailtrap: {str(e)}")
+            chunk_results = [{"status": "failed", "error": str(e)}] * len(chunk)
+        
+        for (recipient_email, message_body), result in zip(chunk, chunk_results):
+            if result["status"] == "failed" and allow_local_fallback:
+                result = _fallback_locally(recipient_email, subject, message_body, timestamp, result)
+            results.append(result)
+    return results
+
+def _fallback_locally(recipient_email, subject, message_body, timestamp, failed_result):
+    """Salva localmente un'email non inviata, se il fallback è abilitato (come send_email)."""
+    if os.environ.get("EMAIL_LOCAL_STORAGE", "true").lower() != "true":
+        return failed_result
+    logging.info(f"Fallback al salvataggio locale dell'email per {recipient_email}")
+    return _timed('local', save_email_locally, recipient_email, subject, message_body, timestamp)
+
+def send_batch_via_mailtrap(sender_email, sender_name, messages, subject, timestamp):
+    """
+    Invia un blocco di email con una sola richiesta all'endpoint batch di Mailtrap.
+    
+    Mittente, oggetto e testo alternativo sono comuni ("base"); ogni richiesta
+    del blocco contiene solo destinatario e corpo HTML.
+    
+    Args:
+        sender_email: Email del mittente
+        sender_name: Nome del mittente
+        messages: Coppie (destinatario, corpo HTML), al massimo MAILTRAP_BATCH_SIZE
+        subject: Oggetto delle email
+        timestamp: Timestamp dell'operazione
+        
+    Returns:
+        list: Risultato di ciascun messaggio, nello stesso ordine
+    """
+    url, headers = _mailtrap_endpoint('batch')
+    payload = {
+        "base": {
+            "from": {
+                "email": sender_email,
+                "name": sender_name
+            },
+            "subject": subject,
+            "text": "Questo è un messaggio generato da C-Recenzione.",
+            "category": "C-Recenzione"
+        },
+        "requests": [
+            {
+                "to": [{"email": recipient_email}],
+                "html": message_body
+            }
+            for recipient_email, message_body in messages
+        ]
+    }
+    
+    response = http_session.post(url, json=payload, headers=headers, timeout=MAILTRAP_TIMEOUT)
+    response.raise_for_status()
+    responses = response.json().get("responses") or []
+    
+    results = []
+    for index, (recipient_email, _) in enumerate(messages):
+        item = responses[index] if index < len(responses) else {"success": False, "errors": ["Risposta mancante"]}
+        if item.get("success"):
+            results.append({
+                "status": "delivered",
+                "date": timestamp,
+                "mailtrap_id": _mailtrap_message_id(item),
+                "mailtrap_status": response.status_code
+            })
+        else:
+            error = "; ".join(str(err) for err in item.get("errors") or []) or "Invio rifiutato"
+            logging.warning(f"Mailtrap ha rifiutato l'email per {recipient_email}: {error}")
+            results.append({"status": "failed", "error": error})
+    
+    delivered = sum(1 for result in results if result["status"] == "delivered")
+    logging.info(f"Blocco di email inviato tramite Mailtrap: {delivered}/{len(messages)} accettate (status: {response.status_code})")
+    return results
+
 def send_via_smtp(msg, recipient_email, timestamp):
     """
     Invia un'email tramite SMTP.
     
+    La connessione (con STARTTLS e login già eseguiti) viene presa dal pool del
+    server e delle credenziali configurati e riutilizzata dagli invii successivi.
+    
     Args:
         msg: Messaggio email da inviare
         recipient_email: Email del destinatario
@@ -143,30 +351,26 @@ def send_via_smtp(msg, recipient_email, timestamp):
     smtp_port = int(os.environ.get("SMTP_PORT", 587))
     smtp_username = os.environ.get("SMTP_USERNAME", "")
     smtp_password = os.environ.get("SMTP_PASSWORD", "")
+    smtp_starttls = os.environ.get("SMTP_STARTTLS", "true").lower() == "true"
     
     logging.debug(f"Invio email a {recipient_email} con oggetto: {msg['Subject']}")
     
-    # Connect to server and send email
-    with smtplib.SMTP(smtp_server, smtp_port) as server:
-        server.starttls()  # Secure the connection
-        
-        # Login if credentials are provided
-        if smtp_username and smtp_password:
-            server.login(smtp_username, smtp_password)
-        
-        # Send email
-        server.send_message(msg)
-        logging.info(f"Email inviata con successo a {recipient_email}")
-        
-        return {
-            "status": "delivered",
-            "date": timestamp
-        }
+    pool = smtp_pools.get(smtp_server, smtp_port, smtp_username, smtp_password, smtp_starttls)
+    pool.send_message(msg)
+    logging.info(f"Email inviata con successo a {recipient_email}")
+    
+    return {
+        "status": "delivered",
+        "date": timestamp
+    }
 
 def save_email_locally(recipient_email, subject, message_body, timestamp):
     """
     Salva l'email localmente per lo sviluppo/testing.
     
+    L'email viene aggiunta in coda al log delle email locali (vedi
+    services/local_mail_store.py), consultabile dalla pagina /emails.
+    
     Args:
         recipient_email: Email del destinatario
         subject: Oggetto dell'email
@@ -176,13 +380,6 @@ def save_email_locally(recipient_email, subject, message_body, timestamp):
     Returns:
         dict: Risultato dell'operazione
     """
-    # Crea la directory se non esiste
-    LOCAL_EMAIL_DIR.mkdir(parents=True, exist_ok=True)
-    
-    # Genera un nome file univoco
-    filename = LOCAL_EMAIL_DIR / f"email_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{recipient_email.replace('@', '_at_')}.json"
-    
-    # Salva l'email come JSON
     email_data = {
         "to": recipient_email,
         "subject": subject,
@@ -190,13 +387,13 @@ def save_email_locally(recipient_email, subject, message_body, timestamp):
         "date": timestamp
     }
     
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(email_data, f, indent=2, ensure_ascii=False)
+    stored = local_mail_store.append(email_data)
     
-    logging.info(f"Email salvata localmente: {filename}")
+    logging.info(f"Email salvata localmente: {stored['file']} (id {stored['id']})")
     
     return {
         "status": "delivered",
         "date": timestamp,
-        "local_file": str(filename)
-    }
\ No newline at end of file
+        "local_file": stored['file'],
+        "local_id": stored['id']
+    }
@@ -0,0 +1,183 @@
+"""
+Kobold Health Monitor
+
+Questo modulo mantiene in memoria l'ultimo stato noto dell'API Kobold
+(di tutti i backend del pool).
+Lo stato viene aggiornato periodicamente da un thread in background, così che
+il percorso di generazione possa consultarlo senza effettuare chiamate di rete.
+"""
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from services.kobold_api import kobold_client, CircuitBreaker
+from services.metrics import metrics
+
+class KoboldHealthMonitor:
+    """Monitora lo stato dell'API Kobold con una cache a scadenza (TTL)."""
+
+    def __init__(self, client, ttl=None, interval=None):
+        """
+        Inizializza il monitor.
+
+        Args:
+            client (KoboldClient): Client da utilizzare per i controlli
+            ttl (float, optional): Secondi dopo i quali lo stato è considerato scaduto.
+                                   Default da KOBOLD_HEALTH_TTL o 30
+            interval (float, optional): Intervallo in secondi tra i controlli in background.
+                                        Default da KOBOLD_HEALTH_INTERVAL o 10
+        """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.ttl = ttl or float(os.environ.get("KOBOLD_HEALTH_TTL", 30))
+        self.interval = interval or float(os.environ.get("KOBOLD_HEALTH_INTERVAL", 10))
+
+        # Ultimo stato noto (None finché non è stato eseguito alcun controllo)
+        self._available = None
+        self._checked_at = None
+        self._latency = None
+        self._last_error = None
+
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._thread = None
+        self._wakeup = threading.Event()
+
+    def start(self):
+        """Avvia il thread di aggiornamento in background, se non è già attivo."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            # Il thread viene creato in modo pigro: in gunicorn ogni worker avvia il proprio dopo il fork
+            self._thread = threading.Thread(target=self._run, name='kobold-health-monitor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Ciclo del thread in background."""
+        while True:
+            self.refresh()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def refresh(self):
+        """
+        Esegue un controllo sincrono dello stato dell'API e aggiorna la cache.
+
+        Returns:
+            bool: True se l'API è disponibile
+        """
+        with self._lock:
+            if self._refreshing:
+                return bool(self._available)
+            self._refreshing = True
+
+        start_time = time.time()
+        error = None
+        try:
+            available = self.client.health_check()
+            if not available:
+                error = "API non raggiungibile o stato non valido"
+        except Exception as e:
+            available = False
+            error = str(e)
+        latency = time.time() - start_time
+
+        with self._lock:
+            if available != self._available:
+                self.logger.info(f"Stato API Kobold cambiato: {'disponibile' if available else 'non disponibile'}")
+            self._available = available
+            self._checked_at = time.time()
+            self._latency = latency
+            self._last_error = error
+            self._refreshing = False
+
+        self.logger.debug(f"Controllo stato Kobold completato in {latency:.2f}s: {available}")
+        return available
+
+    def request_refresh(self):
+        """Richiede un aggiornamento immediato in background, senza attenderne l'esito."""
+        self.start()
+        self._wakeup.set()
+
+    def is_available(self):
+        """
+        Restituisce l'ultimo stato noto dell'API senza effettuare I/O.
+
+        Se lo stato è scaduto viene richiesto un aggiornamento in background e
+        nel frattempo si usa comunque l'ultimo valore noto. Prima del primo
+        controllo l'API è considerata disponibile: un eventuale errore verrà
+        gestito dal fallback della generazione.
+
+        Returns:
+            bool: True se l'API è considerata disponibile
+        """
+        self.start()
+
+        with self._lock:
+            available = self._available
+            checked_at = self._checked_at
+
+        if checked_at is None or time.time() - checked_at > self.ttl:
+            self._wakeup.set()
+
+        # Se tutti i backend sono esclusi (circuito aperto o controllo fallito)
+        # le richieste verrebbero comunque rifiutate
+        if not self.client.has_available_backend():
+            return False
+
+        return available is not False
+
+    def get_status(self):
+        """
+        Restituisce un riepilogo dello stato corrente, da mostrare nell'interfaccia.
+
+        Returns:
+            dict: Stato, data dell'ultimo controllo, latenza ed eventuale errore
+        """
+        self.start()
+
+        with self._lock:
+            checked_at = self._checked_at
+            status = {
+                'available': self._available,
+                'checked_at': datetime.fromtimestamp(checked_at).strftime('%Y-%m-%d %H:%M:%S') if checked_at else None,
+                'age': round(time.time() - checked_at, 1) if checked_at else None,
+                'stale': checked_at is None or time.time() - checked_at > self.ttl,
+                'latency': round(self._latency, 3) if self._latency is not None else None,
+                'error': self._last_error,
+                'base_url': self.client.base_url
+            }
+
+        status['circuit_state'] = CircuitBreaker.OPEN if self.client.circuits_open() else CircuitBreaker.CLOSED
+        status['backends'] = self.client.backend_stats()
+        status['hedging'] = self.client.hedge_stats()
+        return status
+
+# Istanza globale del monitor
+kobold_health_monitor = KoboldHealthMonitor(kobold_client)
+
+def _collect_kobold_metrics():
+    """Metriche istantanee dello stato dell'API Kobold per /metrics."""
+    status = kobold_health_monitor.get_status()
+    backends = status['backends']
+    return [
+        ('kobold_up', 'gauge', "1 se l'API Kobold è disponibile secondo l'ultimo controllo", [
+            ({}, None if status['available'] is None else int(status['available']))
+        ]),
+        ('kobold_health_check_age_seconds', 'gauge', "Secondi dall'ultimo controllo di stato", [
+            ({}, status['age'])
+        ]),
+        ('kobold_health_check_latency_seconds', 'gauge', "Durata dell'ultimo controllo di stato", [
+            ({}, status['latency'])
+        ]),
+        ('kobold_backend_available', 'gauge', "1 se il backend riceve richieste (non escluso)", [
+            ({'backend': b['url']}, int(b['available'])) for b in backends
+        ]),
+        ('kobold_backend_in_flight', 'gauge', "Richieste in corso verso il backend dal processo che risponde", [
+            ({'backend': b['url']}, b['in_flight']) for b in backends
+        ])
+    ]
+
+metrics.register_collector(_collect_kobold_metrics)
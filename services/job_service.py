@@ -0,0 +1,300 @@
+"""
+Job Service
+
+Questo modulo gestisce la coda persistente dei job di generazione. Le route web
+accodano un job e restituiscono subito il suo identificativo; un processo
+separato (worker.py) preleva i job dal database, esegue la generazione e ne
+salva il risultato. I job falliti vengono ritentati con attesa crescente e,
+esauriti i tentativi, completati con il testo di fallback.
+"""
+
+import os
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import func, case
+from app import db
+from models import GenerationJob
+from services.metrics import metrics
+from services.llm_scheduler import PRIORITIES, PRIORITY_INTERACTIVE
+
+# Numero massimo di tentativi per job
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+
+# Attesa di base (secondi) prima di ritentare un job, raddoppiata ad ogni tentativo
+JOB_RETRY_BASE = float(os.environ.get("JOB_RETRY_BASE", 5))
+
+# Dopo questo intervallo (secondi) un job in esecuzione è considerato abbandonato (worker terminato)
+JOB_LEASE_TIMEOUT = int(os.environ.get("JOB_LEASE_TIMEOUT", 300))
+
+# Intervallo (secondi) con cui il worker rinnova il lease di un job in esecuzione
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", JOB_LEASE_TIMEOUT / 3))
+
+# Stati di un job
+JOB_STATUSES = ('queued', 'running', 'completed', 'failed')
+
+def enqueue_generation_job(company_id, template_id, user_id=None, max_attempts=None,
+                           priority=PRIORITY_INTERACTIVE):
+    """
+    Accoda un job di generazione.
+
+    Args:
+        company_id (str): ID dell'azienda
+        template_id (str): ID del template
+        user_id (str, optional): ID dell'utente che ha richiesto la generazione
+        max_attempts (int, optional): Tentativi massimi (default JOB_MAX_ATTEMPTS)
+        priority (str): Classe di priorità della generazione nello scheduler
+
+    Returns:
+        GenerationJob: Il job accodato
+    """
+    job = GenerationJob(
+        company_id=company_id,
+        template_id=template_id,
+        user_id=user_id,
+        max_attempts=max_attempts or JOB_MAX_ATTEMPTS,
+        priority=priority,
+        run_after=datetime.utcnow()
+    )
+    db.session.add(job)
+    db.session.commit()
+    logging.info(f"Job di generazione {job.id} accodato")
+    return job
+
+def get_job(job_id):
+    """
+    Recupera un job per ID.
+
+    Returns:
+        GenerationJob: Il job o None se non esiste
+    """
+    return GenerationJob.query.get(job_id)
+
+def get_queue_stats():
+    """
+    Restituisce il numero di job per stato.
+
+    Returns:
+        dict: Conteggi per stato, più il totale
+    """
+    counts = dict(
+        db.session.query(GenerationJob.status, func.count(GenerationJob.id))
+        .group_by(GenerationJob.status)
+        .all()
+    )
+    stats = {status: counts.get(status, 0) for status in JOB_STATUSES}
+    stats['total'] = sum(counts.values())
+    return stats
+
+def get_recent_jobs(limit=50, status=None):
+    """
+    Restituisce gli ultimi job, dal più recente.
+
+    Args:
+        limit (int): Numero massimo di job
+        status (str, optional): Filtra per stato
+
+    Returns:
+        list: Lista di GenerationJob
+    """
+    query = GenerationJob.query
+    if status:
+        query = query.filter_by(status=status)
+    return query.order_by(GenerationJob.created_at.desc()).limit(limit).all()
+
+def default_worker_id():
+    """Identificativo del worker corrente (host e PID)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_next_job(worker_id):
+    """
+    Preleva il prossimo job pronto e lo assegna al worker.
+
+    I job pronti sono prelevati per priorità (interattivi, poi batch, poi
+    pre-warm) e, a parità, per run_after: i thread del worker sono tanti quanti
+    gli slot dello scheduler, quindi l'ordine di prelievo è quello di esecuzione.
+
+    L'assegnazione è un UPDATE condizionato allo stato 'queued': se più worker
+    selezionano lo stesso job, solo uno ottiene la riga aggiornata e gli altri
+    passano al candidato successivo. Funziona sia su SQLite sia su PostgreSQL.
+
+    Args:
+        worker_id (str): Identificativo del worker
+
+    Returns:
+        GenerationJob: Il job assegnato o None se la coda è vuota
+    """
+    now = datetime.utcnow()
+    # Job senza priorità (creati prima della colonna) valgono come interattivi
+    priority_rank = case(
+        {priority: rank for rank, priority in enumerate(PRIORITIES)},
+        value=GenerationJob.priority,
+        else_=0
+    )
+    candidates = (
+        db.session.query(GenerationJob.id)
+        .filter(GenerationJob.status == 'queued', GenerationJob.run_after <= now)
+        .order_by(priority_rank, GenerationJob.run_after, GenerationJob.created_at)
+        .limit(5)
+        .all()
+    )
+
+    for (job_id,) in candidates:
+        claimed = (
+            GenerationJob.query
+            .filter_by(id=job_id, status='queued')
+            .update({
+                'status': 'running',
+                'locked_by': worker_id,
+                'locked_at': now,
+                'attempts': GenerationJob.attempts + 1,
+                'updated_at': now
+            }, synchronize_session=False)
+        )
+        db.session.commit()
+        if claimed:
+            return GenerationJob.query.get(job_id)
+
+    return None
+
+def requeue_stale_jobs():
+    """
+    Rimette in coda i job rimasti in esecuzione oltre JOB_LEASE_TIMEOUT.
+
+    Returns:
+        int: Numero di job rimessi in coda
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_LEASE_TIMEOUT)
+    requeued = (
+        GenerationJob.query
+        .filter(GenerationJob.status == 'running', GenerationJob.locked_at < cutoff)
+        .update({
+            'status': 'queued',
+            'locked_by': None,
+            'locked_at': None,
+            'error': 'Worker terminato durante l\'esecuzione',
+            'run_after': datetime.utcnow()
+        }, synchronize_session=False)
+    )
+    db.session.commit()
+    if requeued:
+        logging.warning(f"{requeued} job abbandonati rimessi in coda")
+    return requeued
+
+def run_job(job):
+    """
+    Esegue un job assegnato e ne salva l'esito.
+
+    Fino al penultimo tentativo il fallback è disattivato, così un errore
+    dell'API Kobold porta a un nuovo tentativo; all'ultimo tentativo il job
+    viene completato con il testo di fallback. La generazione usa la priorità
+    salvata nel job e, finché è in corso, il lease viene rinnovato ogni
+    JOB_HEARTBEAT_INTERVAL secondi, così un job lungo non viene rimesso in coda.
+
+    Args:
+        job (GenerationJob): Job in stato 'running'
+
+    Returns:
+        GenerationJob: Il job aggiornato
+    """
+    from services.ai_service import generate_review_request
+
+    company = job.company
+    template = job.template
+    if company is None or template is None:
+        _fail_job(job, 'Azienda o template non trovato', retry=False)
+        return job
+
+    last_attempt = job.attempts >= job.max_attempts
+    heartbeat = _start_lease_heartbeat(job.id, job.locked_by)
+    try:
+        result = generate_review_request(
+            company.to_dict(),
+            template.to_dict(),
+            allow_fallback=last_attempt,
+            owner=job.user_id,
+            priority=job.priority or PRIORITY_INTERACTIVE,
+            # Il risultato di un job viene salvato: un altro job dello stesso utente non lo sostituisce
+            replace_previous=False
+        )
+        if not result:
+            raise ValueError("La generazione ha restituito un testo vuoto")
+    except Exception as e:
+        logging.warning(f"Job {job.id} fallito al tentativo {job.attempts}: {str(e)}")
+        _fail_job(job, str(e), retry=not last_attempt)
+        return job
+    finally:
+        heartbeat.set()
+
+    job.status = 'completed'
+    job.result = result
+    job.error = None
+    job.completed_at = datetime.utcnow()
+    job.locked_by = None
+    job.locked_at = None
+    db.session.commit()
+    logging.info(f"Job {job.id} completato al tentativo {job.attempts}")
+    return job
+
+def _start_lease_heartbeat(job_id, worker_id):
+    """
+    Avvia un thread che rinnova il lease (locked_at) di un job in esecuzione.
+
+    Il rinnovo usa un contesto applicativo, e quindi una sessione, propri e si
+    interrompe se il job non è più in esecuzione per questo worker.
+
+    Args:
+        job_id (str): ID del job
+        worker_id (str): Worker a cui è assegnato il job
+
+    Returns:
+        threading.Event: Da impostare al termine del job per fermare il rinnovo
+    """
+    from app import app
+
+    stop_event = threading.Event()
+
+    def _renew():
+        while not stop_event.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                with app.app_context():
+                    renewed = (
+                        GenerationJob.query
+                        .filter_by(id=job_id, status='running', locked_by=worker_id)
+                        .update({'locked_at': datetime.utcnow()}, synchronize_session=False)
+                    )
+                    db.session.commit()
+            except Exception as e:
+                logging.warning(f"Rinnovo del lease del job {job_id} non riuscito: {str(e)}")
+                continue
+            if not renewed:
+                return
+
+    threading.Thread(target=_renew, name=f'job-lease-{job_id[:8]}', daemon=True).start()
+    return stop_event
+
+def _fail_job(job, error, retry=True):
+    """Registra l'errore e rimette il job in coda con backoff esponenziale, se previsto."""
+    job.error = error
+    job.locked_by = None
+    job.locked_at = None
+    if retry and job.attempts < job.max_attempts:
+        delay = JOB_RETRY_BASE * (2 ** (job.attempts - 1))
+        job.status = 'queued'
+        job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+    else:
+        job.status = 'failed'
+        job.completed_at = datetime.utcnow()
+    db.session.commit()
+
+def _collect_job_metrics():
+    """Numero di job di generazione per stato, per /metrics."""
+    stats = get_queue_stats()
+    return [
+        ('generation_jobs', 'gauge', "Job di generazione per stato", [
+            ({'status': status}, stats[status]) for status in JOB_STATUSES
+        ])
+    ]
+
+metrics.register_collector(_collect_job_metrics)
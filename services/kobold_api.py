@@ -7,23 +7,326 @@ eseguire modelli di linguaggio localmente.
 """
 
 import os
+import re
+import json
+import time
+import uuid
+import random
 import logging
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
+from services.metrics import KOBOLD_REQUEST_DURATION, AI_GENERATION_CANCELLATIONS
 
 # Non importiamo settings_service qui per evitare importazioni circolari
 # Ogni volta che avremo bisogno di impostazioni, le recupereremo direttamente
 
+# Timeout (connessione, lettura) in secondi per ciascun endpoint
+ENDPOINT_TIMEOUTS = {
+    'health': (2, 5),
+    'v1/model': (2, 5),
+    'v1/generate': (3, 30),
+    # Per lo streaming il timeout di lettura vale tra un token e il successivo
+    'extra/generate/stream': (3, 30),
+    'extra/tokencount': (1, 3),
+    'extra/abort': (1, 3),
+    'extra/true_max_context_length': (1, 3)
+}
+DEFAULT_TIMEOUT = (3, 30)
+
+# Lunghezza del contesto usata se il server non la comunica
+DEFAULT_CONTEXT_LENGTH = 2048
+# Validità in secondi della lunghezza del contesto letta dal server
+CONTEXT_LENGTH_TTL = 600
+
+# Sequenze di fine turno usate se il chiamante non ne indica altre
+DEFAULT_STOP_SEQUENCES = ["</s>", "User:", "System:"]
+
+# Codici HTTP per cui ha senso ripetere la richiesta (server temporaneamente occupato)
+RETRYABLE_STATUS_CODES = (502, 503, 504)
+
+# Generazioni annullate di cui si conserva la chiave in attesa della loro conclusione
+MAX_TRACKED_CANCELLATIONS = 1000
+
+# Campioni di latenza di generazione conservati per ciascun backend
+LATENCY_WINDOW = 100
+
+# Campioni minimi prima di usare il percentile di latenza per le richieste "hedged"
+HEDGE_MIN_SAMPLES = int(os.environ.get("KOBOLD_HEDGE_MIN_SAMPLES", 20))
+
+# Budget delle richieste di riserva: ogni generazione che potrebbe essere "hedged"
+# ne accumula questa frazione (0.05 = al massimo una riserva ogni 20 generazioni)
+HEDGE_MAX_RATIO = float(os.environ.get("KOBOLD_HEDGE_MAX_RATIO", 0.05))
+
+# Richieste di riserva in corso contemporaneamente, al massimo
+HEDGE_MAX_OUTSTANDING = int(os.environ.get("KOBOLD_HEDGE_MAX_OUTSTANDING", 1))
+
+# Generazioni parallele per backend se le impostazioni non sono leggibili
+# (impostazione generation_concurrency, vedi settings_service)
+DEFAULT_SLOTS_PER_BACKEND = 2
+
+# Secondi di validità delle impostazioni lette dal database nel percorso di generazione
+SETTINGS_TTL = float(os.environ.get("KOBOLD_SETTINGS_TTL", 30))
+
+def parse_backend_spec(spec):
+    """
+    Interpreta l'elenco dei backend Kobold configurato.
+    
+    Gli indirizzi sono separati da virgole, spazi o a capo; ciascuno può avere
+    un peso con la sintassi "url|peso" (es. "http://gpu1:5001/api|3").
+    
+    Args:
+        spec (str): Elenco dei backend
+        
+    Returns:
+        list: Lista di tuple (url, peso)
+    """
+    backends = []
+    for entry in re.split(r'[\s,]+', spec or ''):
+        if not entry:
+            continue
+        url, _, weight = entry.partition('|')
+        try:
+            weight = max(1, int(weight)) if weight else 1
+        except ValueError:
+            weight = 1
+        backends.append((url, weight))
+    return backends
+
+class CircuitOpenError(Exception):
+    """Sollevata quando il circuit breaker è aperto e le richieste a Kobold vengono rifiutate."""
+    pass
+
+class GenerationCancelledError(Exception):
+    """Sollevata quando una generazione è stata interrotta (abort) prima del termine."""
+    pass
+
+class CircuitBreaker:
+    """
+    Circuit breaker per le chiamate all'API Kobold.
+    
+    Dopo un numero di fallimenti consecutivi il circuito si apre e le richieste
+    vengono rifiutate immediatamente. Trascorso il tempo di recupero viene lasciata
+    passare una sola richiesta di prova (stato semi-aperto): se ha successo il
+    circuito si richiude, altrimenti si riapre.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        """
+        Inizializza il circuit breaker.
+        
+        Args:
+            failure_threshold (int): Fallimenti consecutivi prima dell'apertura
+            recovery_timeout (float): Secondi di attesa prima della richiesta di prova
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self):
+        """Stato corrente del circuito."""
+        with self._lock:
+            return self._state
+    
+    def allow_request(self):
+        """
+        Verifica se una richiesta può essere inoltrata all'API.
+        
+        Returns:
+            bool: True se la richiesta può procedere
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.recovery_timeout:
+                    return False
+                # Tempo di recupero trascorso: lascia passare una richiesta di prova
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = True
+                return True
+            
+            # Semi-aperto: una sola richiesta di prova alla volta
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+    
+    def record_success(self):
+        """Registra una richiesta riuscita e richiude il circuito."""
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+    
+    def record_failure(self):
+        """Registra una richiesta fallita ed eventualmente apre il circuito."""
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+    
+    def rejects_requests(self):
+        """
+        Indica se una richiesta verrebbe rifiutata, senza modificare lo stato.
+        
+        Returns:
+            bool: True se il circuito è aperto (e il tempo di recupero non è trascorso)
+                  o se una richiesta di prova è già in corso
+        """
+        with self._lock:
+            if self._state == self.OPEN:
+                return time.monotonic() - self._opened_at < self.recovery_timeout
+            return self._state == self.HALF_OPEN and self._probe_in_flight
+
+class KoboldBackend:
+    """Singola istanza Kobold/KoboldCpp del pool, con statistiche e circuit breaker propri."""
+    
+    def __init__(self, url, weight=1):
+        """
+        Inizializza il backend.
+        
+        Args:
+            url (str): URL base dell'API
+            weight (int): Peso relativo nella distribuzione del carico
+        """
+        self.url = url
+        self.weight = weight
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=int(os.environ.get("KOBOLD_BREAKER_THRESHOLD", 5)),
+            recovery_timeout=float(os.environ.get("KOBOLD_BREAKER_RECOVERY", 30))
+        )
+        
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+        # Esito dell'ultimo controllo di stato (None finché non è stato controllato)
+        self.healthy = None
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Registra l'avvio di una richiesta verso il backend."""
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+    
+    def release(self, latency=None, error=None):
+        """
+        Registra la conclusione di una richiesta.
+        
+        Args:
+            latency (float, optional): Durata in secondi da includere nelle statistiche
+            error (Exception, optional): Errore che ha interrotto la richiesta
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if error is not None:
+                self.errors += 1
+                self.last_error = str(error)
+            elif latency is not None:
+                self._latencies.append(latency)
+    
+    def mark_health(self, healthy, error=None):
+        """Registra l'esito di un controllo di stato."""
+        with self._lock:
+            self.healthy = healthy
+            if error:
+                self.last_error = error
+    
+    def is_available(self):
+        """
+        Indica se il backend può ricevere richieste.
+        
+        Un backend è escluso se l'ultimo controllo di stato è fallito o se il suo
+        circuit breaker è aperto; rientra dopo un controllo riuscito o una
+        richiesta di prova andata a buon fine.
+        
+        Returns:
+            bool: True se il backend è utilizzabile
+        """
+        return self.healthy is not False and not self.circuit_breaker.rejects_requests()
+    
+    def load(self):
+        """Carico relativo al peso: richieste in corso (inclusa la prossima) diviso il peso."""
+        with self._lock:
+            return (self.in_flight + 1) / self.weight
+    
+    def latency_percentile(self, percentile, min_samples=1):
+        """
+        Calcola un percentile della latenza di generazione.
+        
+        Args:
+            percentile (float): Percentile da calcolare (0-100)
+            min_samples (int): Campioni minimi richiesti
+            
+        Returns:
+            float|None: Latenza in secondi, o None se i campioni sono insufficienti
+        """
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < max(1, min_samples):
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+    
+    def stats(self):
+        """
+        Restituisce le statistiche del backend, da mostrare nell'interfaccia.
+        
+        Returns:
+            dict: URL, peso, stato, richieste, errori e latenze
+        """
+        p50 = self.latency_percentile(50)
+        p95 = self.latency_percentile(95)
+        with self._lock:
+            return {
+                'url': self.url,
+                'weight': self.weight,
+                'healthy': self.healthy,
+                'circuit_state': self.circuit_breaker.state,
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'errors': self.errors,
+                'error_rate': round(self.errors / self.requests, 3) if self.requests else None,
+                'latency_p50': round(p50, 3) if p50 is not None else None,
+                'latency_p95': round(p95, 3) if p95 is not None else None,
+                'samples': len(self._latencies),
+                'last_error': self.last_error,
+                'available': self.is_available()
+            }
+
 class KoboldClient:
-    """Client per interagire con l'API di Kobold."""
+    """Client per interagire con l'API di Kobold, su uno o più backend."""
     
-    def __init__(self, base_url=None):
+    def __init__(self, base_url=None, pool_size=None, max_retries=None):
         """
         Inizializza il client Kobold.
         
         Args:
-            base_url (str, optional): URL base dell'API Kobold.
+            base_url (str, optional): URL base dell'API Kobold, o elenco di backend
+                                     con pesi (vedi parse_backend_spec).
                                      Default dalle impostazioni o localhost:5001/api
+            pool_size (int, optional): Numero massimo di connessioni keep-alive per backend.
+                                      Default da KOBOLD_POOL_SIZE o 10
+            max_retries (int, optional): Tentativi aggiuntivi per richiesta.
+                                        Default da KOBOLD_MAX_RETRIES o 2
         """
         self.logger = logging.getLogger(__name__)
         
@@ -35,14 +338,103 @@ class KoboldClient:
         # Aggiorna se viene fornito un URL
         if base_url:
             self.base_url = base_url
+        
+        # Pool di backend (un solo elemento se è configurato un solo URL)
+        self.backends = []
+        self._backends_lock = threading.Lock()
+        self._set_backends(self.base_url)
+        
+        # Parametri per i tentativi con backoff esponenziale e jitter
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("KOBOLD_MAX_RETRIES", 2))
+        self.backoff_base = float(os.environ.get("KOBOLD_BACKOFF_BASE", 0.25))
+        self.backoff_max = float(os.environ.get("KOBOLD_BACKOFF_MAX", 4))
+        
+        # Sessione HTTP condivisa con pool di connessioni keep-alive
+        self.pool_size = pool_size or int(os.environ.get("KOBOLD_POOL_SIZE", 10))
+        self.session = self._create_session(self.pool_size)
+        
+        # Richieste "hedged": se la generazione supera questo percentile di latenza del
+        # backend, viene inviata una seconda richiesta a un altro backend (0 = disattivato)
+        self.hedge_percentile = float(os.environ.get("KOBOLD_HEDGE_PERCENTILE", 0))
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.hedges_skipped = 0
+        self._hedge_budget = 1.0
+        self._hedges_outstanding = 0
+        self._hedge_lock = threading.Lock()
+        self._executor = None
+        
+        # Generazioni che ciascun backend esegue in parallelo (slot del server)
+        self.slots_per_backend = DEFAULT_SLOTS_PER_BACKEND
+        
+        # Scheduler delle generazioni: le richieste di riserva ne occupano uno slot
+        self.scheduler = None
+        
+        # Ultima lettura delle impostazioni (vedi refresh_settings)
+        self._settings_loaded_at = float('-inf')
+        
+        # Lunghezza massima del contesto del modello (letta dal server e memorizzata)
+        self._context_length = None
+        self._context_length_checked_at = 0
+        self._tokencount_supported = True
+        
+        # Chiavi (genkey) delle generazioni annullate e non ancora concluse
+        self._cancelled = {}
+        self._cancelled_lock = threading.Lock()
+        # Richieste di riserva in corso: genkey della generazione → (backend, genkey della riserva)
+        self._hedge_legs = {}
+    
+    @staticmethod
+    def _create_session(pool_size):
+        """
+        Crea una sessione HTTP con pool di connessioni riutilizzabili.
+        
+        Args:
+            pool_size (int): Dimensione massima del pool per host
+            
+        Returns:
+            requests.Session: Sessione configurata
+        """
+        session = requests.Session()
+        # I tentativi sono gestiti da _make_request, non dall'adapter.
+        # pool_connections è il numero di host (backend) con un pool dedicato.
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+    
+    def _set_backends(self, spec):
+        """
+        Ricostruisce il pool di backend, mantenendo le statistiche di quelli già presenti.
+        
+        Args:
+            spec (str): Elenco dei backend (vedi parse_backend_spec)
+        """
+        parsed = parse_backend_spec(spec) or [('http://localhost:5001/api', 1)]
+        with self._backends_lock:
+            existing = {backend.url: backend for backend in self.backends}
+            backends = []
+            for url, weight in parsed:
+                backend = existing.get(url) or KoboldBackend(url, weight)
+                backend.weight = weight
+                backends.append(backend)
+            self.backends = backends
+    
+    def _get_executor(self):
+        """Thread pool per le richieste hedged e i controlli di stato paralleli."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='kobold-pool')
+        return self._executor
     
     def update_settings(self, base_url=None):
         """
         Aggiorna le impostazioni del client.
         
         Args:
-            base_url (str, optional): URL base dell'API Kobold.
+            base_url (str, optional): URL base dell'API Kobold, o elenco di backend.
         """
+        previous_url = self.base_url
+        
         if base_url:
             self.base_url = base_url
         else:
@@ -50,20 +442,22 @@ class KoboldClient:
             kobold_api_url = os.environ.get("KOBOLD_API_URL")
             if kobold_api_url:
                 self.base_url = kobold_api_url
-            else:
-                # Tenta di recuperare dalle impostazioni
-                try:
-                    from flask import current_app
-                    from app import app
-                    
-                    with app.app_context():
-                        from services import settings_service
+            # Tenta di recuperare dalle impostazioni (gli slot anche con l'URL da ambiente)
+            try:
+                from flask import current_app
+                from app import app
+                
+                with app.app_context():
+                    from services import settings_service
+                    if not kobold_api_url:
                         settings = settings_service.get_settings()
                         self.base_url = settings.get('kobold_api_url', self.base_url)
                         self.temperature = settings.get('temperature', 0.7)
                         self.max_length = settings.get('max_length', 1000)
-                except Exception as e:
-                    self.logger.debug(f"Non è stato possibile recuperare le impostazioni dal database: {e}")
+                    # Stessa impostazione che dimensiona il pool batch e lo scheduler
+                    self.slots_per_backend = settings_service.get_generation_concurrency()
+            except Exception as e:
+                self.logger.debug(f"Non è stato possibile recuperare le impostazioni dal database: {e}")
         
         # Le impostazioni sono già state aggiornate sopra
         # Valori di default per altri parametri
@@ -71,87 +465,725 @@ class KoboldClient:
         self.top_k = 40
         self.use_fallback = True
         
+        if self.base_url != previous_url:
+            self._set_backends(self.base_url)
+            # Le capacità del server vanno rilette per il nuovo indirizzo
+            self._context_length = None
+            self._tokencount_supported = True
+        
+        self._settings_loaded_at = time.monotonic()
         self.logger.debug(f"Impostazioni Kobold aggiornate: URL={self.base_url}, temp={self.temperature}")
     
-    def _make_request(self, endpoint, method="GET", data=None, timeout=30):
+    def refresh_settings(self):
+        """
+        Rilegge le impostazioni se sono più vecchie di KOBOLD_SETTINGS_TTL secondi.
+        
+        Usata nel percorso di generazione al posto di update_settings, che legge il
+        database: il salvataggio delle impostazioni aggiorna subito il client del
+        processo, gli altri processi le rileggono entro KOBOLD_SETTINGS_TTL.
+        """
+        if time.monotonic() - self._settings_loaded_at >= SETTINGS_TTL:
+            self.update_settings()
+    
+    def _select_backend(self, exclude=()):
+        """
+        Sceglie il backend con meno richieste in corso in rapporto al peso.
+        
+        I backend esclusi (controllo di stato fallito o circuito aperto) vengono
+        scartati; se nessun backend è disponibile si sceglie comunque tra tutti,
+        lasciando decidere al circuit breaker.
+        
+        Args:
+            exclude (iterable): Backend da non considerare (es. già tentati)
+            
+        Returns:
+            KoboldBackend|None: Backend scelto, o None se sono tutti esclusi
+        """
+        with self._backends_lock:
+            backends = [b for b in self.backends if b not in exclude]
+        if not backends:
+            return None
+        
+        candidates = [b for b in backends if b.is_available()] or backends
+        loads = [(b.load(), b) for b in candidates]
+        best = min(load for load, _ in loads)
+        return random.choice([b for load, b in loads if load == best])
+    
+    def has_available_backend(self):
+        """
+        Indica se almeno un backend può ricevere richieste (nessun I/O).
+        
+        Returns:
+            bool: True se almeno un backend è disponibile
+        """
+        with self._backends_lock:
+            backends = list(self.backends)
+        return any(b.is_available() for b in backends)
+    
+    def circuits_open(self):
+        """
+        Indica se i circuit breaker di tutti i backend rifiutano le richieste.
+        
+        Returns:
+            bool: True se nessun backend accetterebbe una richiesta
+        """
+        with self._backends_lock:
+            backends = list(self.backends)
+        return all(b.circuit_breaker.rejects_requests() for b in backends)
+    
+    def backend_stats(self):
+        """
+        Restituisce le statistiche di ciascun backend del pool.
+        
+        Returns:
+            list: Un dizionario per backend (vedi KoboldBackend.stats)
+        """
+        with self._backends_lock:
+            backends = list(self.backends)
+        return [b.stats() for b in backends]
+    
+    def hedge_stats(self):
+        """
+        Restituisce la configurazione e i contatori delle richieste hedged.
+        
+        Returns:
+            dict: Percentile di soglia, richieste inviate e vinte
+        """
+        return {
+            'enabled': self.hedge_percentile > 0 and len(self.backends) > 1,
+            'percentile': self.hedge_percentile,
+            'max_ratio': HEDGE_MAX_RATIO,
+            'max_outstanding': HEDGE_MAX_OUTSTANDING,
+            'outstanding': self._hedges_outstanding,
+            'sent': self.hedges_sent,
+            'won': self.hedges_won,
+            'skipped': self.hedges_skipped
+        }
+    
+    def _earn_hedge_budget(self):
+        """Accumula il budget di una generazione che potrebbe richiedere una riserva."""
+        with self._hedge_lock:
+            self._hedge_budget = min(max(1.0, HEDGE_MAX_OUTSTANDING), self._hedge_budget + HEDGE_MAX_RATIO)
+    
+    def _reserve_hedge(self, backend):
+        """
+        Riserva una richiesta di riserva verso un backend, se il budget lo consente.
+        
+        La riserva è negata se il budget è esaurito, se sono già in corso
+        HEDGE_MAX_OUTSTANDING riserve, se il backend ha tutti gli slot occupati
+        o se lo scheduler non ha uno slot libero: una riserva raddoppia il
+        carico proprio quando i backend sono lenti.
+        
+        Args:
+            backend (KoboldBackend): Backend che riceverebbe la riserva
+            
+        Returns:
+            tuple: (True se la riserva può essere inviata, ticket dello scheduler o None);
+                va rilasciata con _release_hedge(ticket)
+        """
+        with self._hedge_lock:
+            allowed = (
+                self._hedge_budget >= 1
+                and self._hedges_outstanding < HEDGE_MAX_OUTSTANDING
+                and backend.in_flight < self.slots_per_backend
+            )
+            if allowed and self.scheduler is not None:
+                # La riserva occupa uno slot dello scheduler come ogni generazione
+                ticket = self.scheduler.try_acquire_hedge()
+                allowed = ticket is not None
+            else:
+                ticket = None
+            if allowed:
+                self._hedge_budget -= 1
+                self._hedges_outstanding += 1
+            else:
+                self.hedges_skipped += 1
+            return allowed, ticket
+    
+    def _release_hedge(self, ticket=None):
+        """Registra la conclusione di una richiesta di riserva e ne libera lo slot."""
+        with self._hedge_lock:
+            self._hedges_outstanding -= 1
+        if ticket is not None:
+            self.scheduler.release(ticket)
+    
+    def _backoff_delay(self, attempt):
+        """
+        Calcola l'attesa prima del prossimo tentativo (backoff esponenziale con full jitter).
+        
+        Args:
+            attempt (int): Numero del tentativo fallito (da 0)
+            
+        Returns:
+            float: Secondi di attesa
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+    
+    def _make_request(self, endpoint, method="GET", data=None, timeout=None, backend=None):
         """
         Effettua una richiesta all'API di Kobold.
         
+        Gli errori di connessione e le risposte 502/503/504 vengono ritentati fino a
+        max_retries volte, preferendo ad ogni tentativo un backend diverso. Se il
+        circuit breaker del backend scelto è aperto la richiesta viene rifiutata
+        immediatamente con CircuitOpenError.
+        
         Args:
             endpoint (str): Endpoint API relativo
             method (str): Metodo HTTP (GET, POST)
             data (dict, optional): Dati da inviare (per POST)
-            timeout (int): Timeout in secondi
+            timeout (float|tuple, optional): Timeout in secondi; default da ENDPOINT_TIMEOUTS
+            backend (KoboldBackend, optional): Backend da usare; default scelto dal pool
             
         Returns:
             dict: Risposta JSON dall'API
         """
-        url = urljoin(self.base_url, endpoint)
+        method = method.upper()
+        if method not in ("GET", "POST"):
+            raise ValueError(f"Metodo non supportato: {method}")
         
-        try:
-            if method.upper() == "GET":
-                response = requests.get(url, timeout=timeout)
-            elif method.upper() == "POST":
-                response = requests.post(url, json=data, timeout=timeout)
-            else:
-                raise ValueError(f"Metodo non supportato: {method}")
+        timeout = timeout or ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        pinned = backend
+        backend = None
+        tried = []
+        
+        attempt = 0
+        while True:
+            candidate = pinned or self._select_backend(exclude=tried) or backend
+            if candidate is not backend:
+                if backend is not None:
+                    # Si passa a un altro backend: il tentativo su quello precedente è fallito
+                    backend.circuit_breaker.record_failure()
+                if not candidate.circuit_breaker.allow_request():
+                    raise CircuitOpenError(f"Circuit breaker aperto: backend Kobold {candidate.url} temporaneamente escluso")
+                backend = candidate
+                tried.append(backend)
             
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Errore nella richiesta a Kobold API ({method} {url}): {str(e)}")
-            raise
+            url = urljoin(backend.url, endpoint)
+            backend.acquire()
+            start_time = time.time()
+            try:
+                response = self.session.request(method, url, json=data if method == "POST" else None, timeout=timeout)
+                
+                if response.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                    raise requests.exceptions.RetryError(f"Risposta HTTP {response.status_code}")
+                
+                response.raise_for_status()
+                result = response.json()
+            except (requests.exceptions.ConnectionError, requests.exceptions.RetryError) as e:
+                backend.release(error=e)
+                KOBOLD_REQUEST_DURATION.observe(time.time() - start_time, endpoint=endpoint, backend=backend.url, result='error')
+                # Le ConnectTimeout ricadono qui; i ReadTimeout no, per non duplicare generazioni lunghe
+                if attempt < self.max_retries:
+                    delay = self._backoff_delay(attempt)
+                    attempt += 1
+                    self.logger.debug(f"Tentativo {attempt}/{self.max_retries} per {method} {url} tra {delay:.2f}s: {str(e)}")
+                    time.sleep(delay)
+                    continue
+                backend.circuit_breaker.record_failure()
+                self.logger.error(f"Errore nella richiesta a Kobold API ({method} {url}): {str(e)}")
+                raise
+            except requests.exceptions.HTTPError as e:
+                backend.release(error=e)
+                KOBOLD_REQUEST_DURATION.observe(time.time() - start_time, endpoint=endpoint, backend=backend.url, result='error')
+                # Un errore 4xx indica che il server risponde: non conta per il circuit breaker
+                if e.response is not None and e.response.status_code < 500:
+                    backend.circuit_breaker.record_success()
+                else:
+                    backend.circuit_breaker.record_failure()
+                self.logger.error(f"Errore nella richiesta a Kobold API ({method} {url}): {str(e)}")
+                raise
+            except (requests.exceptions.RequestException, ValueError) as e:
+                backend.release(error=e)
+                KOBOLD_REQUEST_DURATION.observe(time.time() - start_time, endpoint=endpoint, backend=backend.url, result='error')
+                backend.circuit_breaker.record_failure()
+                self.logger.error(f"Errore nella richiesta a Kobold API ({method} {url}): {str(e)}")
+                raise
+            
+            elapsed = time.time() - start_time
+            KOBOLD_REQUEST_DURATION.observe(elapsed, endpoint=endpoint, backend=backend.url, result='ok')
+            # Le statistiche di latenza riguardano solo le generazioni, usate per l'hedging
+            backend.release(latency=elapsed if endpoint == "v1/generate" else None)
+            backend.circuit_breaker.record_success()
+            return result
+    
+    def _check_backend(self, backend):
+        """
+        Controlla lo stato di un singolo backend e ne aggiorna la disponibilità.
+        
+        Returns:
+            bool: True se il backend è disponibile
+        """
+        try:
+            response = self._make_request("health", backend=backend)
+            healthy = response.get("status") == "ok"
+            backend.mark_health(healthy, None if healthy else "Stato non valido")
+        except Exception as e:
+            healthy = False
+            backend.mark_health(False, str(e))
+        return healthy
     
     def health_check(self):
         """
-        Verifica lo stato dell'API Kobold.
+        Verifica lo stato dell'API Kobold, controllando in parallelo tutti i backend.
+        
+        I backend che non rispondono vengono esclusi dalla distribuzione del carico
+        fino al successivo controllo riuscito.
         
         Returns:
-            bool: True se l'API è disponibile
+            bool: True se almeno un backend è disponibile
         """
         try:
             # Aggiorna le impostazioni prima del controllo
             self.update_settings()
             
-            response = self._make_request("health", timeout=5)
-            return response.get("status") == "ok"
+            with self._backends_lock:
+                backends = list(self.backends)
+            if len(backends) == 1:
+                return self._check_backend(backends[0])
+            return any(list(self._get_executor().map(self._check_backend, backends)))
         except:
             return False
     
-    def generate_text(self, prompt, max_length=None, temperature=None, top_p=None, top_k=None):
+    def generate_text(self, prompt, max_length=None, temperature=None, top_p=None, top_k=None, stop_sequence=None,
+                      genkey=None, deadline=None):
         """
         Genera testo usando l'API di Kobold.
         
+        La richiesta è identificata da una chiave (genkey): se la risposta non arriva
+        entro la scadenza, o se la generazione viene annullata con cancel_generation,
+        il backend viene fermato con l'endpoint di abort invece di continuare a
+        generare token che nessuno leggerà.
+        
         Args:
             prompt (str): Prompt iniziale per la generazione
             max_length (int, optional): Lunghezza massima della generazione
             temperature (float, optional): Temperatura per la generazione (0.1-1.0)
             top_p (float, optional): Parametro top_p per la generazione
             top_k (int, optional): Parametro top_k per la generazione
+            stop_sequence (list, optional): Sequenze che terminano la generazione
+            genkey (str, optional): Chiave della generazione; default generata
+            deadline (float, optional): Secondi massimi di attesa della risposta
             
         Returns:
             str: Testo generato
+            
+        Raises:
+            GenerationCancelledError: Se la generazione è stata annullata
+        """
+        # Impostazioni rilette al più ogni KOBOLD_SETTINGS_TTL secondi
+        self.refresh_settings()
+        
+        genkey = genkey or self.new_genkey()
+        data = self._build_generation_payload(prompt, max_length, temperature, top_p, top_k, stop_sequence)
+        data["genkey"] = genkey
+        timeout = (ENDPOINT_TIMEOUTS["v1/generate"][0], deadline) if deadline else None
+        
+        try:
+            if self.hedge_percentile > 0 and len(self.backends) > 1:
+                result = self._generate_hedged(data, timeout, genkey)
+            else:
+                result = self._make_request("v1/generate", method="POST", data=data, timeout=timeout)
+            text = self._extract_text(result)
+        except requests.exceptions.ReadTimeout as e:
+            # Il backend sta ancora generando: lo fermiamo per liberare lo slot
+            self.cancel_generation(genkey, 'deadline')
+            self.logger.error(f"Generazione oltre la scadenza di {deadline}s: {str(e)}")
+            raise GenerationCancelledError(f"Generazione oltre la scadenza ({genkey})")
+        except Exception as e:
+            self.logger.error(f"Errore nella generazione del testo: {str(e)}")
+            raise Exception(f"Errore nella generazione del testo: {str(e)}")
+        finally:
+            cancelled = self._forget_generation(genkey)
+            with self._cancelled_lock:
+                self._hedge_legs.pop(genkey, None)
+        
+        if cancelled:
+            # Dopo l'abort KoboldCpp restituisce il testo parziale: non va usato come completo
+            raise GenerationCancelledError(f"Generazione annullata ({genkey})")
+        return text
+    
+    @staticmethod
+    def new_genkey():
+        """Restituisce una nuova chiave di generazione (genkey di KoboldCpp)."""
+        return f"KCPP{uuid.uuid4().hex[:12]}"
+    
+    def cancel_generation(self, genkey, reason):
+        """
+        Annulla una generazione in corso chiamando l'endpoint di abort di KoboldCpp.
+        
+        La richiesta viene inviata a tutti i backend disponibili (per quelli che
+        non eseguono la generazione una genkey sconosciuta non ha effetto); se è
+        in corso una richiesta di riserva, anche questa viene fermata sul suo backend.
+        
+        Args:
+            genkey (str): Chiave della generazione
+            reason (str): Motivo (disconnect, deadline, replaced), per le metriche
+            
+        Returns:
+            bool: True se almeno un backend ha confermato l'interruzione
         """
-        # Aggiorna le impostazioni prima della generazione
-        self.update_settings()
+        with self._cancelled_lock:
+            if genkey in self._cancelled:
+                return False
+            self._cancelled[genkey] = reason
+            # Generazioni annullate dopo la loro conclusione non verrebbero mai rimosse
+            while len(self._cancelled) > MAX_TRACKED_CANCELLATIONS:
+                self._cancelled.pop(next(iter(self._cancelled)))
+            hedge_leg = self._hedge_legs.get(genkey)
         
+        AI_GENERATION_CANCELLATIONS.inc(reason=reason)
+        aborted = False
+        for backend in list(self.backends):
+            if backend.is_available():
+                aborted = self._abort_on_backend(backend, genkey) or aborted
+        if hedge_leg is not None:
+            aborted = self._abort_on_backend(*hedge_leg) or aborted
+        
+        self.logger.info(f"Generazione {genkey} annullata ({reason}){'' if aborted else ', senza conferma dai backend'}")
+        return aborted
+    
+    def _abort_on_backend(self, backend, genkey):
+        """
+        Chiede a un backend di fermare la generazione con la genkey indicata.
+        
+        Returns:
+            bool: True se il backend ha confermato l'interruzione
+        """
+        try:
+            result = self._make_request("extra/abort", method="POST", data={"genkey": genkey}, backend=backend)
+            return str(result.get("success", "")).lower() == "true"
+        except Exception as e:
+            self.logger.debug(f"Abort di {genkey} non riuscito su {backend.url}: {str(e)}")
+            return False
+    
+    def _cancel_detached(self, genkey, reason):
+        """Annulla una generazione che nessuno attende più (non verrà conclusa altrove)."""
+        self.cancel_generation(genkey, reason)
+        self._forget_generation(genkey)
+    
+    def _forget_generation(self, genkey):
+        """
+        Rimuove una generazione conclusa dall'elenco di quelle annullate.
+        
+        Returns:
+            bool: True se la generazione era stata annullata
+        """
+        with self._cancelled_lock:
+            return self._cancelled.pop(genkey, None) is not None
+    
+    def generate_variants(self, prompt, count, max_length=None, temperature=None, top_p=None, top_k=None, stop_sequence=None):
+        """
+        Genera più completamenti alternativi dello stesso prompt.
+        
+        Tutte le varianti vengono richieste allo stesso backend: con il parametro
+        "n" il server le produce in un'unica chiamata; se ne restituisce meno del
+        richiesto (versioni di KoboldCpp senza supporto di "n"), le mancanti sono
+        chieste con chiamate successive con lo stesso prompt, che KoboldCpp
+        riutilizza dalla cache KV senza rielaborarlo.
+        
+        Args:
+            prompt (str): Prompt iniziale per la generazione
+            count (int): Numero di varianti richieste
+            max_length (int, optional): Lunghezza massima di ciascuna variante
+            temperature (float, optional): Temperatura per la generazione
+            top_p (float, optional): Parametro top_p per la generazione
+            top_k (int, optional): Parametro top_k per la generazione
+            stop_sequence (list, optional): Sequenze che terminano la generazione
+            
+        Returns:
+            list: Testi generati (al massimo count, senza duplicati né testi vuoti)
+        """
+        self.refresh_settings()
+        
+        data = self._build_generation_payload(prompt, max_length, temperature, top_p, top_k, stop_sequence)
+        backend = self._select_backend()
+        connect_timeout, read_timeout = ENDPOINT_TIMEOUTS["v1/generate"]
+        
+        variants = []
+        calls = 0
+        try:
+            # Ogni chiamata chiede le sole varianti mancanti; il limite evita cicli con
+            # server che restituiscono sempre lo stesso testo
+            while len(variants) < count and calls < count:
+                missing = count - len(variants)
+                data["n"] = missing
+                result = self._make_request(
+                    "v1/generate", method="POST", data=data,
+                    timeout=(connect_timeout, read_timeout * missing), backend=backend
+                )
+                calls += 1
+                for text in self._extract_texts(result):
+                    if text and text not in variants:
+                        variants.append(text)
+        except Exception as e:
+            if variants:
+                self.logger.warning(f"Generazione delle varianti interrotta dopo {len(variants)}/{count}: {str(e)}")
+                return variants[:count]
+            self.logger.error(f"Errore nella generazione delle varianti: {str(e)}")
+            raise Exception(f"Errore nella generazione delle varianti: {str(e)}")
+        
+        self.logger.debug(f"Generate {len(variants)}/{count} varianti con {calls} chiamate a {backend.url}")
+        return variants[:count]
+    
+    @classmethod
+    def _extract_texts(cls, result):
+        """
+        Estrae tutti i testi generati dalla risposta di v1/generate.
+        
+        Returns:
+            list: Testi generati, nell'ordine della risposta
+        """
+        results = result.get("results")
+        if results:
+            return [(item.get("text") or "").strip() for item in results]
+        return [cls._extract_text(result)]
+    
+    @staticmethod
+    def _extract_text(result):
+        """
+        Estrae il testo generato dalla risposta di v1/generate.
+        
+        KoboldCpp e KoboldAI rispondono con {"results": [{"text": ...}]};
+        è accettato anche il formato semplificato {"text": ...}.
+        
+        Returns:
+            str: Testo generato
+        """
+        results = result.get("results")
+        if results:
+            return (results[0].get("text") or "").strip()
+        return (result.get("text") or "").strip()
+    
+    def _generate_hedged(self, data, timeout=None, genkey=None):
+        """
+        Esegue una generazione con eventuale richiesta di riserva (hedged request).
+        
+        Se il backend scelto non risponde entro il percentile di latenza configurato,
+        la stessa richiesta viene inviata a un secondo backend e si usa la prima
+        risposta riuscita, nei limiti del budget delle riserve (vedi
+        _reserve_hedge). La riserva ha una genkey propria, così la richiesta
+        più lenta viene fermata con l'abort sul solo backend che la esegue, senza
+        toccare quella vincente.
+        
+        Args:
+            data (dict): Payload di generazione
+            timeout (tuple, optional): Timeout (connessione, lettura) delle richieste
+            genkey (str, optional): Chiave della generazione principale
+            
+        Returns:
+            dict: Risposta JSON del backend più veloce
+        """
+        primary = self._select_backend()
+        threshold = primary.latency_percentile(self.hedge_percentile, HEDGE_MIN_SAMPLES)
+        if threshold is None:
+            # Statistiche insufficienti per stimare la soglia
+            return self._make_request("v1/generate", method="POST", data=data, timeout=timeout, backend=primary)
+        
+        self._earn_hedge_budget()
+        executor = self._get_executor()
+        first = executor.submit(self._make_request, "v1/generate", "POST", data, timeout, primary)
+        done, _ = wait([first], timeout=threshold)
+        if done:
+            return first.result()
+        
+        secondary = self._select_backend(exclude=[primary])
+        if secondary is None or not secondary.is_available():
+            return first.result()
+        allowed, ticket = self._reserve_hedge(secondary)
+        if not allowed:
+            return first.result()
+        
+        genkey = genkey or data.get("genkey") or self.new_genkey()
+        hedge_genkey = f"{genkey}H"
+        with self._cancelled_lock:
+            self._hedge_legs[genkey] = (secondary, hedge_genkey)
+        self.hedges_sent += 1
+        self.logger.debug(f"Generazione su {primary.url} oltre {threshold:.2f}s: richiesta di riserva a {secondary.url}")
+        second = executor.submit(self._make_request, "v1/generate", "POST", dict(data, genkey=hedge_genkey), timeout, secondary)
+        second.add_done_callback(lambda future: self._release_hedge(ticket))
+        legs = {first: (primary, genkey), second: (secondary, hedge_genkey)}
+        
+        error = None
+        for future in as_completed(legs):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is second:
+                self.hedges_won += 1
+            with self._cancelled_lock:
+                self._hedge_legs.pop(genkey, None)
+            # La richiesta perdente genererebbe token che nessuno legge: viene fermata
+            loser = second if future is first else first
+            if not loser.done():
+                AI_GENERATION_CANCELLATIONS.inc(reason='hedge_lost')
+                executor.submit(self._abort_on_backend, *legs[loser])
+            return result
+        raise error
+    
+    def _build_generation_payload(self, prompt, max_length=None, temperature=None, top_p=None, top_k=None, stop_sequence=None):
+        """
+        Prepara il payload per gli endpoint di generazione.
+        
+        Se stop_sequence non è indicato si usano le sequenze generiche di fine turno.
+        
+        Returns:
+            dict: Parametri di generazione, con i valori predefiniti dalle impostazioni
+        """
         # Usa i parametri forniti o quelli predefiniti dalle impostazioni
-        data = {
+        return {
             "prompt": prompt,
             "max_length": max_length or self.max_length,
             "temperature": temperature or self.temperature,
             "top_p": top_p or self.top_p,
             "top_k": top_k or self.top_k,
             "rep_pen": 1.1,
-            "stop_sequence": ["</s>", "User:", "System:"]
+            "stop_sequence": stop_sequence or DEFAULT_STOP_SEQUENCES
         }
+    
+    def generate_text_stream(self, prompt, max_length=None, temperature=None, top_p=None, top_k=None, stop_sequence=None,
+                             genkey=None, deadline=None):
+        """
+        Genera testo in streaming usando l'endpoint SSE di KoboldCpp.
+        
+        Se il chiamante smette di leggere (chiusura del generatore, ad esempio per
+        la disconnessione del client) o la scadenza viene superata, la generazione
+        viene interrotta sul backend con l'endpoint di abort.
+        
+        Args:
+            prompt (str): Prompt iniziale per la generazione
+            max_length (int, optional): Lunghezza massima della generazione
+            temperature (float, optional): Temperatura per la generazione (0.1-1.0)
+            top_p (float, optional): Parametro top_p per la generazione
+            top_k (int, optional): Parametro top_k per la generazione
+            stop_sequence (list, optional): Sequenze che terminano la generazione
+            genkey (str, optional): Chiave della generazione; default generata
+            deadline (float, optional): Secondi massimi per l'intera generazione
+            
+        Yields:
+            str: Token generati, nell'ordine in cui vengono prodotti
+            
+        Raises:
+            GenerationCancelledError: Se la generazione è stata annullata o è scaduta
+        """
+        self.refresh_settings()
+        
+        genkey = genkey or self.new_genkey()
+        deadline_at = time.time() + deadline if deadline else None
+        data = self._build_generation_payload(prompt, max_length, temperature, top_p, top_k, stop_sequence)
+        data["genkey"] = genkey
+        endpoint = "extra/generate/stream"
+        backend = self._select_backend()
+        url = urljoin(backend.url, endpoint)
+        
+        if not backend.circuit_breaker.allow_request():
+            raise CircuitOpenError(f"Circuit breaker aperto: backend Kobold {backend.url} temporaneamente escluso")
+        
+        backend.acquire()
+        try:
+            response = self.session.post(url, json=data, stream=True, timeout=ENDPOINT_TIMEOUTS[endpoint])
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            backend.release(error=e)
+            backend.circuit_breaker.record_failure()
+            self.logger.error(f"Errore nell'avvio dello streaming da Kobold API ({url}): {str(e)}")
+            raise
+        
+        backend.circuit_breaker.record_success()
+        # Gli eventi SSE sono sempre UTF-8, anche se il server non dichiara il charset
+        response.encoding = response.encoding or 'utf-8'
+        
+        error = None
+        try:
+            # Formato SSE: righe "event: message" seguite da "data: {"token": "..."}"
+            for line in response.iter_lines(decode_unicode=True):
+                if deadline_at is not None and time.time() > deadline_at:
+                    self.cancel_generation(genkey, 'deadline')
+                    raise GenerationCancelledError(f"Generazione in streaming oltre la scadenza di {deadline}s ({genkey})")
+                if not line or not line.startswith("data:"):
+                    continue
+                try:
+                    payload = json.loads(line[len("data:"):].strip())
+                except ValueError:
+                    self.logger.debug(f"Evento SSE non valido ignorato: {line[:100]}")
+                    continue
+                
+                token = payload.get("token")
+                if token:
+                    yield token
+        except GeneratorExit:
+            # Il chiamante ha smesso di leggere: l'abort parte in background per non
+            # trattenere il worker che sta chiudendo la risposta
+            self._get_executor().submit(self._cancel_detached, genkey, 'disconnect')
+            raise
+        except requests.exceptions.RequestException as e:
+            error = e
+            raise
+        finally:
+            # Chiude la connessione anche se il chiamante interrompe la lettura
+            response.close()
+            # Il backend resta occupato per tutta la durata dello streaming
+            backend.release(error=error)
+            cancelled = self._forget_generation(genkey)
+        
+        if cancelled:
+            # Stream terminato da un abort (es. generazione sostituita): il testo è parziale
+            raise GenerationCancelledError(f"Generazione in streaming annullata ({genkey})")
+    
+    def count_tokens(self, text):
+        """
+        Conta i token di un testo con il tokenizer del modello (endpoint tokencount di KoboldCpp).
+        
+        Args:
+            text (str): Testo da analizzare
+            
+        Returns:
+            int|None: Numero di token, o None se il server non supporta il conteggio
+        """
+        if not self._tokencount_supported:
+            return None
         
         try:
-            result = self._make_request("v1/generate", method="POST", data=data)
-            return result.get("text", "").strip()
+            result = self._make_request("extra/tokencount", method="POST", data={"prompt": text})
+            return int(result["value"])
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code in (404, 405):
+                # Backend diverso da KoboldCpp: non riproviamo ad ogni prompt
+                self._tokencount_supported = False
+            self.logger.debug(f"Conteggio token non disponibile: {str(e)}")
+            return None
         except Exception as e:
-            self.logger.error(f"Errore nella generazione del testo: {str(e)}")
-            raise Exception(f"Errore nella generazione del testo: {str(e)}")
+            self.logger.debug(f"Conteggio token non disponibile: {str(e)}")
+            return None
+    
+    def get_context_length(self):
+        """
+        Ottiene la lunghezza massima del contesto del modello caricato.
+        
+        Il valore viene memorizzato per CONTEXT_LENGTH_TTL secondi. La variabile
+        d'ambiente KOBOLD_CONTEXT_LENGTH ha la precedenza sul valore del server.
+        
+        Returns:
+            int: Numero massimo di token del contesto
+        """
+        env_value = os.environ.get("KOBOLD_CONTEXT_LENGTH")
+        if env_value:
+            return int(env_value)
+        
+        if self._context_length and time.time() - self._context_length_checked_at < CONTEXT_LENGTH_TTL:
+            return self._context_length
+        
+        try:
+            result = self._make_request("extra/true_max_context_length")
+            self._context_length = int(result["value"])
+        except Exception as e:
+            self.logger.debug(f"Lunghezza del contesto non disponibile, uso {DEFAULT_CONTEXT_LENGTH}: {str(e)}")
+            self._context_length = self._context_length or DEFAULT_CONTEXT_LENGTH
+        
+        self._context_length_checked_at = time.time()
+        return self._context_length
     
     def get_model_info(self):
         """
@@ -173,18 +1205,51 @@ class KoboldClient:
         """
         Testa la connessione a un URL specifico dell'API Kobold.
         
+        Se viene indicato un elenco di backend, ciascuno viene testato separatamente.
+        
         Args:
-            api_url (str, optional): URL da testare, usa l'URL corrente se non specificato
+            api_url (str, optional): URL (o elenco di backend) da testare,
+                                     usa la configurazione corrente se non specificato
             
         Returns:
             dict: Risultato del test con stato e messaggio
         """
-        temp_url = api_url or self.base_url
+        backends = parse_backend_spec(api_url or self.base_url)
+        if len(backends) <= 1:
+            return self._test_single_connection(backends[0][0] if backends else self.base_url)
+        
+        results = []
+        for url, _ in backends:
+            result = self._test_single_connection(url)
+            result['url'] = url
+            results.append(result)
         
+        reachable = [r for r in results if r['success']]
+        summary = {
+            "success": bool(reachable),
+            "message": f"{len(reachable)} backend su {len(results)} raggiungibili",
+            "backends": results
+        }
+        if not reachable:
+            summary["error"] = "; ".join(f"{r['url']}: {r.get('error')}" for r in results)
+        elif reachable[0].get("model_info"):
+            summary["model_info"] = reachable[0]["model_info"]
+        return summary
+    
+    def _test_single_connection(self, temp_url):
+        """
+        Testa la connessione a un singolo backend.
+        
+        Args:
+            temp_url (str): URL base dell'API da testare
+            
+        Returns:
+            dict: Risultato del test con stato e messaggio
+        """
         try:
             # Prima verifica un semplice ping all'endpoint health
             url = urljoin(temp_url, "health")
-            response = requests.get(url, timeout=5)
+            response = self.session.get(url, timeout=ENDPOINT_TIMEOUTS['health'])
             
             # Se riusciamo a ottenere una risposta HTTP OK, controlliamo il contenuto
             if response.status_code == 200:
@@ -193,7 +1258,7 @@ class KoboldClient:
                     if result.get("status") == "ok":
                         # Se l'API è sana, prova a ottenere info sul modello
                         model_url = urljoin(temp_url, "v1/model")
-                        model_response = requests.get(model_url, timeout=5)
+                        model_response = self.session.get(model_url, timeout=ENDPOINT_TIMEOUTS['v1/model'])
                         
                         if model_response.status_code == 200:
                             model_info = model_response.json()
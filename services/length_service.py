@@ -0,0 +1,211 @@
+"""
+Length Service
+
+Questo modulo adatta il parametro max_length delle generazioni alla lunghezza
+effettivamente osservata dei testi prodotti. Per ogni generazione vengono
+registrati i token richiesti e quelli ottenuti (modello GenerationLength); il
+valore successivo è il percentile configurato delle lunghezze recenti del
+template (o, con pochi campioni, della categoria) più un margine.
+Se molte generazioni raggiungono il limite, il limite viene raddoppiato.
+"""
+
+import os
+import math
+import time
+import logging
+import threading
+from services.prompt_builder import estimate_tokens
+
+# Limite usato finché non ci sono abbastanza campioni (valore storico)
+DEFAULT_MAX_LENGTH = int(os.environ.get("AI_DEFAULT_MAX_LENGTH", 1000))
+
+# Limiti entro cui viene scelto il valore adattivo
+MIN_MAX_LENGTH = int(os.environ.get("AI_MIN_MAX_LENGTH", 96))
+MAX_MAX_LENGTH = int(os.environ.get("AI_MAX_MAX_LENGTH", 1000))
+
+# Percentile delle lunghezze osservate e margine moltiplicativo sopra di esso
+LENGTH_PERCENTILE = float(os.environ.get("AI_LENGTH_PERCENTILE", 95))
+LENGTH_HEADROOM = float(os.environ.get("AI_LENGTH_HEADROOM", 1.25))
+
+# Campioni minimi per usare le statistiche e campioni recenti considerati
+MIN_SAMPLES = int(os.environ.get("AI_LENGTH_MIN_SAMPLES", 20))
+SAMPLE_WINDOW = int(os.environ.get("AI_LENGTH_WINDOW", 200))
+
+# Frazione di generazioni troncate oltre la quale il limite viene raddoppiato
+TRUNCATION_THRESHOLD = 0.05
+
+# Validità (secondi) delle previsioni in memoria
+PREDICTION_TTL = 60
+
+def _percentile(values, percentile):
+    """Percentile (nearest-rank) di una lista di valori non vuota."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(percentile / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+class OutputLengthPredictor:
+    """Registra le lunghezze delle generazioni e stima il max_length da richiedere."""
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._predictions = {}
+        self._lock = threading.Lock()
+
+    def predict(self, template):
+        """
+        Restituisce il max_length da usare per un template.
+
+        Args:
+            template (dict): Template con 'id' e 'category'
+
+        Returns:
+            int: Token da richiedere al modello
+        """
+        key = (template.get('id'), template.get('category'))
+        with self._lock:
+            cached = self._predictions.get(key)
+        if cached is not None and time.time() - cached[1] < PREDICTION_TTL:
+            return cached[0]['max_length']
+
+        prediction = self._compute(*key)
+        with self._lock:
+            self._predictions[key] = (prediction, time.time())
+        return prediction['max_length']
+
+    def _compute(self, template_id, category_id):
+        """
+        Calcola la previsione dai campioni recenti del template o della categoria.
+
+        Returns:
+            dict: max_length, origine dei campioni e loro numero
+        """
+        for scope, column_value in (('template', template_id), ('category', category_id)):
+            if not column_value:
+                continue
+            samples = self._recent_samples(scope, column_value)
+            if len(samples) >= MIN_SAMPLES:
+                return dict(self._limit_from_samples(samples), scope=scope)
+        return {'max_length': DEFAULT_MAX_LENGTH, 'scope': 'default', 'samples': 0}
+
+    @staticmethod
+    def _limit_from_samples(samples):
+        """
+        Applica percentile, margine e correzione per i troncamenti ai campioni.
+
+        Args:
+            samples (list): Tuple (token ottenuti, troncata)
+
+        Returns:
+            dict: max_length, percentile osservato e frazione di troncamenti
+        """
+        lengths = [output_tokens for output_tokens, _ in samples]
+        truncation_rate = sum(1 for _, truncated in samples if truncated) / len(samples)
+        observed = _percentile(lengths, LENGTH_PERCENTILE)
+
+        limit = math.ceil(observed * LENGTH_HEADROOM)
+        if truncation_rate > TRUNCATION_THRESHOLD:
+            # I testi troncati nascondono la lunghezza reale: il percentile la sottostima
+            limit *= 2
+        return {
+            'max_length': max(MIN_MAX_LENGTH, min(MAX_MAX_LENGTH, limit)),
+            'observed': observed,
+            'truncation_rate': round(truncation_rate, 3),
+            'samples': len(samples)
+        }
+
+    def _recent_samples(self, scope, value):
+        """Restituisce gli ultimi campioni (token, troncata) di un template o di una categoria."""
+        from app import app
+        from models import GenerationLength
+
+        column = GenerationLength.template_id if scope == 'template' else GenerationLength.category_id
+        try:
+            with app.app_context():
+                return GenerationLength.query.with_entities(
+                    GenerationLength.output_tokens, GenerationLength.truncated
+                ).filter(column == value).order_by(
+                    GenerationLength.created_at.desc()
+                ).limit(SAMPLE_WINDOW).all()
+        except Exception as e:
+            self.logger.warning(f"Statistiche di lunghezza non disponibili: {str(e)}")
+            return []
+
+    def record(self, template, requested_tokens, text=None, output_tokens=None, mode='sync'):
+        """
+        Registra la lunghezza di una generazione completata.
+
+        Args:
+            template (dict): Template usato
+            requested_tokens (int): max_length richiesto al modello
+            text (str, optional): Testo generato, se il numero di token non è noto
+            output_tokens (int, optional): Token generati (es. eventi dello streaming)
+            mode (str): Tipo di generazione (sync, stream, variants)
+        """
+        from app import app, db
+        from models import GenerationLength
+
+        if output_tokens is None:
+            output_tokens = estimate_tokens(text or '')
+        # Con la stima locale il conteggio è approssimato: si considera troncato un testo vicino al limite
+        truncated = output_tokens >= requested_tokens * 0.95
+
+        try:
+            # Contesto e sessione separati: il campione non interferisce con la transazione del chiamante
+            with app.app_context():
+                db.session.add(GenerationLength(
+                    template_id=template.get('id'),
+                    category_id=template.get('category'),
+                    mode=mode,
+                    requested_tokens=requested_tokens,
+                    output_tokens=output_tokens,
+                    truncated=truncated
+                ))
+                db.session.commit()
+        except Exception as e:
+            self.logger.warning(f"Impossibile registrare la lunghezza della generazione: {str(e)}")
+
+    def report(self):
+        """
+        Confronta, per ogni template, il limite previsto con le lunghezze ottenute.
+
+        Returns:
+            list: Dizionari con nome del template, campioni, lunghezze osservate
+                  (media, p50, p95), limite richiesto in media, limite previsto e troncamenti
+        """
+        from models import Template, GenerationLength
+
+        report = []
+        for template in Template.query.all():
+            samples = GenerationLength.query.with_entities(
+                GenerationLength.output_tokens, GenerationLength.truncated, GenerationLength.requested_tokens
+            ).filter(GenerationLength.template_id == template.id).order_by(
+                GenerationLength.created_at.desc()
+            ).limit(SAMPLE_WINDOW).all()
+
+            prediction = self._compute(template.id, template.category_id)
+            entry = {
+                'template_id': template.id,
+                'template_name': template.name,
+                'samples': len(samples),
+                'predicted': prediction['max_length'],
+                'scope': prediction['scope'],
+                'avg_tokens': None,
+                'p50_tokens': None,
+                'p95_tokens': None,
+                'avg_requested': None,
+                'truncation_rate': None
+            }
+            if samples:
+                lengths = [output_tokens for output_tokens, _, _ in samples]
+                entry.update({
+                    'avg_tokens': round(sum(lengths) / len(lengths)),
+                    'p50_tokens': _percentile(lengths, 50),
+                    'p95_tokens': _percentile(lengths, 95),
+                    'avg_requested': round(sum(requested for _, _, requested in samples) / len(samples)),
+                    'truncation_rate': round(sum(1 for _, truncated, _ in samples if truncated) / len(samples), 3)
+                })
+            report.append(entry)
+        return report
+
+# Istanza globale del predittore
+length_predictor = OutputLengthPredictor()
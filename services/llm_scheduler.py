@@ -0,0 +1,270 @@
+"""
+LLM Scheduler
+
+Questo modulo regola l'accesso alla capacità dei backend Kobold. Ogni
+generazione chiede uno slot con una classe di priorità (interattiva, batch,
+pre-warm); quando uno slot si libera viene assegnato alla richiesta in attesa
+con la priorità più alta e, a parità di priorità, a turno tra gli utenti, così
+che una campagna numerosa di un utente non blocchi quelle degli altri.
+
+Gli slot sono limitati, per ogni backend disponibile, al numero di generazioni
+parallele configurato (impostazione generation_concurrency, letta dal client
+Kobold): il lavoro a bassa priorità cede quindi il passo a una richiesta
+interattiva entro la durata di una generazione. Anche le richieste di riserva
+(hedged) occupano uno slot, ottenuto solo se libero (vedi try_acquire_hedge).
+
+Il limite vale per processo: server web (per ogni worker gunicorn) e
+worker.py hanno ciascuno i propri slot, quindi un backend condiviso può
+ricevere fino a "processi × slot" generazioni.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from services.metrics import metrics
+
+# Classi di priorità, dalla più alta alla più bassa
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BATCH = 'batch'
+PRIORITY_PREWARM = 'prewarm'
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH, PRIORITY_PREWARM)
+
+# Slot occupati dalle richieste di riserva (non hanno una coda di attesa)
+HEDGE = 'hedge'
+
+# Intervallo (secondi) con cui le richieste in attesa ricontrollano la capacità,
+# che cambia quando un backend torna disponibile o viene escluso
+CAPACITY_RECHECK_INTERVAL = 1.0
+
+SCHEDULER_WAIT = metrics.histogram(
+    'llm_scheduler_wait_seconds', "Attesa di uno slot di generazione per classe di priorità",
+    ('priority',)
+)
+
+class SchedulerTimeoutError(Exception):
+    """Sollevata quando uno slot di generazione non si libera entro il tempo massimo."""
+    pass
+
+class _Ticket:
+    """Richiesta di uno slot in attesa di assegnazione."""
+
+    __slots__ = ('priority', 'owner', 'granted')
+
+    def __init__(self, priority, owner):
+        self.priority = priority
+        self.owner = owner
+        self.granted = False
+
+class GenerationScheduler:
+    """Assegna gli slot di generazione per priorità e, a parità, a turno tra gli utenti."""
+
+    def __init__(self, client, max_in_flight_per_backend=None):
+        """
+        Inizializza lo scheduler.
+
+        Args:
+            client (KoboldClient): Client di cui si considerano i backend disponibili
+            max_in_flight_per_backend (int, optional): Generazioni contemporanee per
+                backend; default gli slot configurati nel client (slots_per_backend)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.max_in_flight_per_backend = max_in_flight_per_backend
+        self._cond = threading.Condition()
+        # priorità → utente → coda FIFO dei ticket; l'ordine degli utenti è il turno
+        self._waiting = {priority: OrderedDict() for priority in PRIORITIES}
+        self._in_flight = {priority: 0 for priority in PRIORITIES + (HEDGE,)}
+
+    def slots_per_backend(self):
+        """Generazioni contemporanee ammesse per backend (almeno una)."""
+        slots = self.max_in_flight_per_backend or self.client.slots_per_backend
+        return max(1, int(slots))
+
+    def capacity(self):
+        """
+        Restituisce il numero massimo di generazioni contemporanee.
+
+        Returns:
+            int: Slot per backend moltiplicati per i backend disponibili (almeno uno)
+        """
+        available = sum(1 for backend in self.client.backends if backend.is_available())
+        return self.slots_per_backend() * max(1, available)
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_INTERACTIVE, owner=None, timeout=None):
+        """
+        Attende uno slot di generazione e lo rilascia all'uscita dal blocco.
+
+        Args:
+            priority (str): Classe di priorità (vedi PRIORITIES)
+            owner (str, optional): Utente per cui si genera, per l'equità tra utenti
+            timeout (float, optional): Secondi massimi di attesa
+
+        Raises:
+            SchedulerTimeoutError: Se lo slot non si libera entro il timeout
+        """
+        ticket = self.acquire(priority, owner, timeout)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, owner=None, timeout=None):
+        """
+        Attende uno slot di generazione; va restituito con release().
+
+        Args:
+            priority (str): Classe di priorità (vedi PRIORITIES)
+            owner (str, optional): Utente per cui si genera, per l'equità tra utenti
+            timeout (float, optional): Secondi massimi di attesa
+
+        Returns:
+            _Ticket: Ticket assegnato
+
+        Raises:
+            SchedulerTimeoutError: Se lo slot non si libera entro il timeout
+        """
+        if priority not in self._waiting:
+            raise ValueError(f"Priorità sconosciuta: {priority}")
+
+        ticket = _Ticket(priority, owner)
+        start_time = time.time()
+        self._wait_for_grant(ticket, timeout)
+        waited = time.time() - start_time
+        SCHEDULER_WAIT.observe(waited, priority=priority)
+        if waited > 1:
+            self.logger.debug(f"Slot {priority} assegnato dopo {waited:.2f}s")
+        return ticket
+
+    def try_acquire_hedge(self):
+        """
+        Riserva uno slot per una richiesta di riserva, senza attendere.
+
+        Lo slot viene concesso solo se c'è capacità libera e nessuna richiesta
+        è in attesa: una riserva non deve mai ritardare una generazione.
+
+        Returns:
+            _Ticket|None: Ticket da restituire con release(), o None se non c'è posto
+        """
+        with self._cond:
+            if any(self._waiting[priority] for priority in PRIORITIES):
+                return None
+            if sum(self._in_flight.values()) >= self.capacity():
+                return None
+            ticket = _Ticket(HEDGE, None)
+            ticket.granted = True
+            self._in_flight[HEDGE] += 1
+            return ticket
+
+    def release(self, ticket):
+        """Restituisce lo slot di un ticket e lo assegna alla prossima richiesta in attesa."""
+        with self._cond:
+            self._in_flight[ticket.priority] -= 1
+            self._dispatch()
+
+    def _wait_for_grant(self, ticket, timeout):
+        """Accoda il ticket e attende che venga assegnato."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            self._waiting[ticket.priority].setdefault(ticket.owner, deque()).append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                wait = CAPACITY_RECHECK_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._withdraw(ticket)
+                        raise SchedulerTimeoutError(
+                            f"Nessuno slot di generazione libero entro {timeout}s (priorità {ticket.priority})"
+                        )
+                    wait = min(wait, remaining)
+                self._cond.wait(wait)
+                if not ticket.granted:
+                    self._dispatch()
+
+    def _withdraw(self, ticket):
+        """Rimuove un ticket non assegnato dalla sua coda (da chiamare con il lock)."""
+        owners = self._waiting[ticket.priority]
+        queue = owners.get(ticket.owner)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            pass
+        if not queue:
+            del owners[ticket.owner]
+
+    def _dispatch(self):
+        """Assegna gli slot liberi ai ticket in attesa (da chiamare con il lock)."""
+        capacity = self.capacity()
+        granted = False
+        while sum(self._in_flight.values()) < capacity:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            ticket.granted = True
+            self._in_flight[ticket.priority] += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _next_ticket(self):
+        """
+        Estrae il prossimo ticket: priorità più alta, poi l'utente di turno.
+
+        Returns:
+            _Ticket|None: Ticket da servire, o None se non c'è nessuno in attesa
+        """
+        for priority in PRIORITIES:
+            owners = self._waiting[priority]
+            if not owners:
+                continue
+            owner, queue = next(iter(owners.items()))
+            ticket = queue.popleft()
+            if queue:
+                # L'utente ha altre richieste: torna in fondo al turno
+                owners.move_to_end(owner)
+            else:
+                del owners[owner]
+            return ticket
+        return None
+
+    def stats(self):
+        """
+        Restituisce lo stato dello scheduler.
+
+        Returns:
+            dict: Capacità, generazioni in corso e richieste in attesa per priorità
+        """
+        with self._cond:
+            return {
+                'capacity': self.capacity(),
+                'in_flight': dict(self._in_flight),
+                'waiting': {
+                    priority: sum(len(queue) for queue in owners.values())
+                    for priority, owners in self._waiting.items()
+                },
+                'waiting_owners': {priority: len(owners) for priority, owners in self._waiting.items()}
+            }
+
+def _collect_scheduler_metrics():
+    """Generazioni in corso e in attesa per priorità, per /metrics."""
+    from services.ai_service import generation_scheduler
+
+    stats = generation_scheduler.stats()
+    return [
+        ('llm_scheduler_capacity', 'gauge', "Slot di generazione disponibili nel processo", [
+            ({}, stats['capacity'])
+        ]),
+        ('llm_scheduler_in_flight', 'gauge', "Generazioni in corso per classe di priorità", [
+            ({'priority': priority}, count) for priority, count in stats['in_flight'].items()
+        ]),
+        ('llm_scheduler_waiting', 'gauge', "Generazioni in attesa di uno slot per classe di priorità", [
+            ({'priority': priority}, count) for priority, count in stats['waiting'].items()
+        ])
+    ]
+
+metrics.register_collector(_collect_scheduler_metrics)
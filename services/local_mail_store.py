@@ -0,0 +1,298 @@
+"""
+Local Mail Store
+
+Questo modulo conserva le email del trasporto locale in un log append-only:
+ogni email è una riga JSON aggiunta in coda al segmento corrente
+(segment-000001.jsonl, ...), che viene ruotato quando supera
+LOCAL_MAIL_SEGMENT_SIZE byte. Un indice binario (index.bin) contiene, per ogni
+email in ordine di scrittura, un record a dimensione fissa con segmento,
+offset e lunghezza: il numero di email è la dimensione dell'indice divisa per
+la dimensione del record e la pagina N (dalla più recente) si legge con un
+solo accesso all'indice più una lettura per email mostrata.
+
+Le scritture di processi diversi (server web e worker) sono serializzate con
+un lock sul file LOCK; la lettura non richiede lock, perché un record
+dell'indice viene scritto solo dopo la riga a cui punta.
+"""
+
+import os
+import json
+import uuid
+import struct
+import logging
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: il lock vale solo tra i thread del processo
+    fcntl = None
+
+# Cartella del log delle email in modalità locale
+LOCAL_EMAIL_DIR = Path('data/local_emails')
+
+# Dimensione (byte) oltre la quale il segmento corrente viene chiuso e se ne apre uno nuovo
+LOCAL_MAIL_SEGMENT_SIZE = int(os.environ.get("LOCAL_MAIL_SEGMENT_SIZE", 8 * 1024 * 1024))
+
+# Record dell'indice: numero del segmento, offset e lunghezza della riga
+INDEX_RECORD = struct.Struct('<IQI')
+
+INDEX_FILENAME = 'index.bin'
+LOCK_FILENAME = 'LOCK'
+
+class LocalMailStore:
+    """Log append-only delle email salvate localmente, con indice degli offset."""
+
+    def __init__(self, directory=LOCAL_EMAIL_DIR, segment_size=LOCAL_MAIL_SEGMENT_SIZE):
+        """
+        Inizializza l'archivio (la cartella viene creata alla prima scrittura).
+
+        Args:
+            directory (Path): Cartella di segmenti e indice
+            segment_size (int): Dimensione massima di un segmento in byte
+        """
+        self.directory = Path(directory)
+        self.segment_size = max(1, segment_size)
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    @property
+    def index_path(self):
+        """Percorso dell'indice degli offset."""
+        return self.directory / INDEX_FILENAME
+
+    def segment_path(self, segment):
+        """Percorso del segmento con il numero indicato."""
+        return self.directory / f"segment-{segment:06d}.jsonl"
+
+    def append(self, record):
+        """
+        Aggiunge un'email in coda al log.
+
+        Args:
+            record (dict): Dati dell'email (to, subject, body, date); l'ID viene
+                aggiunto se assente
+
+        Returns:
+            dict: Record salvato, con 'id' e 'file' (segmento che lo contiene)
+        """
+        self._ensure_initialized()
+        with self._write_lock():
+            return self._append_locked(record)
+
+    def _append_locked(self, record):
+        """Scrive la riga e il suo record dell'indice; va chiamata con il lock di scrittura."""
+        record = dict(record)
+        record.setdefault('id', uuid.uuid4().hex)
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+        index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            segment, end = self._tail(index_fd)
+            if end >= self.segment_size:
+                segment, end = segment + 1, 0
+            path = self.segment_path(segment)
+            segment_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                # Righe orfane di una scrittura interrotta restano nel segmento ma non nell'indice
+                offset = os.fstat(segment_fd).st_size
+                _write_all(segment_fd, line)
+            finally:
+                os.close(segment_fd)
+            _write_all(index_fd, INDEX_RECORD.pack(segment, offset, len(line)))
+        finally:
+            os.close(index_fd)
+
+        record['file'] = path.name
+        return record
+
+    def count(self):
+        """Numero di email nel log."""
+        try:
+            return self.index_path.stat().st_size // INDEX_RECORD.size
+        except FileNotFoundError:
+            return 0
+
+    def page(self, page=1, per_page=20):
+        """
+        Restituisce una pagina di email, dalla più recente.
+
+        Vengono letti solo i record dell'indice e le righe della pagina richiesta.
+
+        Args:
+            page (int): Numero di pagina (da 1)
+            per_page (int): Email per pagina
+
+        Returns:
+            tuple: (lista dei record, numero totale di email)
+        """
+        self._ensure_initialized()
+        total = self.count()
+        per_page = max(1, per_page)
+        newest = total - (max(1, page) - 1) * per_page
+        if newest <= 0:
+            return [], total
+        oldest = max(0, newest - per_page)
+
+        with open(self.index_path, 'rb') as index_file:
+            index_file.seek(oldest * INDEX_RECORD.size)
+            raw = index_file.read((newest - oldest) * INDEX_RECORD.size)
+        entries = list(INDEX_RECORD.iter_unpack(raw[:len(raw) - len(raw) % INDEX_RECORD.size]))
+        entries.reverse()
+
+        records = []
+        files = {}
+        try:
+            for position, (segment, offset, length) in zip(range(newest - 1, -1, -1), entries):
+                record = self._read_record(files, segment, offset, length)
+                if record is not None:
+                    record['position'] = position
+                    records.append(record)
+        finally:
+            for segment_file in files.values():
+                segment_file.close()
+        return records, total
+
+    def _read_record(self, files, segment, offset, length):
+        """Legge e decodifica una riga, riusando i file di segmento già aperti."""
+        try:
+            segment_file = files.get(segment)
+            if segment_file is None:
+                segment_file = files[segment] = open(self.segment_path(segment), 'rb')
+            segment_file.seek(offset)
+            record = json.loads(segment_file.read(length))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Email illeggibile nel segmento {segment} all'offset {offset}: {e}")
+            return None
+        record['file'] = self.segment_path(segment).name
+        return record
+
+    def _tail(self, index_fd):
+        """
+        Restituisce segmento corrente e sua dimensione, dall'ultimo record dell'indice.
+
+        Un record incompleto in coda (scrittura interrotta) viene rimosso.
+        """
+        size = os.fstat(index_fd).st_size
+        if size % INDEX_RECORD.size:
+            size -= size % INDEX_RECORD.size
+            os.ftruncate(index_fd, size)
+        if not size:
+            return 1, 0
+        os.lseek(index_fd, size - INDEX_RECORD.size, os.SEEK_SET)
+        segment, offset, length = INDEX_RECORD.unpack(os.read(index_fd, INDEX_RECORD.size))
+        return segment, offset + length
+
+    def _write_lock(self):
+        """Lock di scrittura tra thread e, dove disponibile, tra processi."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return _DirectoryLock(self._lock, self.directory / LOCK_FILENAME)
+
+    def _ensure_initialized(self):
+        """
+        Prepara l'indice alla prima apertura della cartella.
+
+        Se l'indice manca viene ricostruito dai segmenti; se non ci sono
+        nemmeno segmenti, le email salvate in precedenza come file JSON singoli
+        vengono importate nel log (i file restano nella cartella, ma non sono più letti).
+        """
+        if self._initialized:
+            return
+        if not self.directory.is_dir():
+            # Niente da importare: la cartella viene creata alla prima scrittura
+            self._initialized = True
+            return
+
+        with self._write_lock():
+            if not self.index_path.exists():
+                if any(self.directory.glob('segment-*.jsonl')):
+                    self._rebuild_index_locked()
+                else:
+                    self._import_legacy_files()
+            self._initialized = True
+
+    def _import_legacy_files(self):
+        """Importa i file JSON del vecchio formato, dal meno recente; va chiamata con il lock."""
+        self.index_path.touch()
+        legacy_files = sorted(self.directory.glob('*.json'), key=lambda path: path.stat().st_mtime)
+        imported = 0
+        for legacy_file in legacy_files:
+            try:
+                with open(legacy_file, 'r', encoding='utf-8') as f:
+                    self._append_locked(json.load(f))
+                imported += 1
+            except Exception as e:
+                logging.warning(f"Impossibile importare il file email {legacy_file}: {e}")
+        if imported:
+            logging.info(f"{imported} email locali importate nel log di {self.directory}")
+
+    def rebuild_index(self):
+        """
+        Ricostruisce l'indice leggendo tutti i segmenti (es. dopo la perdita di index.bin).
+
+        Returns:
+            int: Numero di email indicizzate
+        """
+        with self._write_lock():
+            return self._rebuild_index_locked()
+
+    def _rebuild_index_locked(self):
+        """Scansione dei segmenti e sostituzione atomica dell'indice; va chiamata con il lock."""
+        entries = bytearray()
+        segments = sorted(
+            int(path.stem.split('-', 1)[1]) for path in self.directory.glob('segment-*.jsonl')
+        )
+        for segment in segments:
+            offset = 0
+            with open(self.segment_path(segment), 'rb') as segment_file:
+                for line in segment_file:
+                    # Una riga senza "a capo" finale è una scrittura interrotta
+                    if line.endswith(b'\n'):
+                        entries += INDEX_RECORD.pack(segment, offset, len(line))
+                    offset += len(line)
+        temp_path = self.index_path.with_suffix('.tmp')
+        temp_path.write_bytes(bytes(entries))
+        os.replace(temp_path, self.index_path)
+        count = len(entries) // INDEX_RECORD.size
+        logging.info(f"Indice delle email locali ricostruito: {count} email in {len(segments)} segmenti")
+        return count
+
+class _DirectoryLock:
+    """Context manager: lock del processo più flock sul file di lock della cartella."""
+
+    def __init__(self, thread_lock, path):
+        self._thread_lock = thread_lock
+        self._path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if fcntl is not None:
+            try:
+                self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except Exception:
+                self._release_file()
+                self._thread_lock.release()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._release_file()
+        self._thread_lock.release()
+        return False
+
+    def _release_file(self):
+        if self._fd is not None:
+            os.close(self._fd)  # la chiusura rilascia anche il flock
+            self._fd = None
+
+def _write_all(fd, data):
+    """Scrive tutti i byte con os.write (con O_APPEND ogni chiamata va in coda al file)."""
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+# Istanza globale dell'archivio delle email locali
+local_mail_store = LocalMailStore()
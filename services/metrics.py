@@ -0,0 +1,468 @@
+"""
+Metrics
+
+Questo modulo raccoglie metriche applicative (contatori e istogrammi) e le
+espone nel formato testuale di Prometheus. Ogni processo mantiene i propri
+valori in memoria e li scrive periodicamente in un file SQLite condiviso;
+l'endpoint /metrics somma i valori di tutti i processi, così il risultato è
+corretto anche con più worker gunicorn. I valori istantanei (es. stato
+dell'API Kobold, job in coda) sono calcolati al momento della lettura da
+funzioni "collector" registrate dai singoli servizi.
+"""
+
+import os
+import json
+import time
+import atexit
+import socket
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+# File condiviso tra i processi
+DEFAULT_DB_PATH = Path('data/metrics.sqlite3')
+
+# Intervallo (secondi) tra le scritture dei valori del processo nel file condiviso
+FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 10))
+
+# Dopo questo intervallo (secondi) senza aggiornamenti i valori di un processo terminato
+# vengono sommati in quelli di RETIRED_PROCESS e le sue righe rimosse
+RETENTION = float(os.environ.get("METRICS_RETENTION", 86400))
+
+# Processo fittizio che accumula i valori dei processi terminati: i contatori
+# (e gli istogrammi) aggregati non diminuiscono quando le loro righe vengono rimosse
+RETIRED_PROCESS = 'retired'
+
+# Limiti dei bucket predefiniti per le durate (secondi)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_value(value):
+    """Formatta un valore numerico per il formato di esposizione."""
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _format_labels(labels):
+    """Formatta le etichette come {nome="valore",...}."""
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+class Metric:
+    """Metrica con etichette; i valori sono per combinazione di etichette."""
+
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        """
+        Inizializza la metrica.
+
+        Args:
+            registry (MetricsRegistry): Registro di appartenenza
+            name (str): Nome della metrica
+            documentation (str): Descrizione (riga HELP)
+            labelnames (tuple): Nomi delle etichette
+        """
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        """Tupla dei valori delle etichette, nell'ordine di labelnames."""
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def reset(self):
+        """Azzera i valori del processo corrente."""
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """
+        Restituisce i campioni correnti del processo.
+
+        Returns:
+            list: Tuple (suffisso, etichette come lista di coppie, valore)
+        """
+        raise NotImplementedError
+
+class Counter(Metric):
+    """Contatore monotono."""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Incrementa il contatore per le etichette indicate."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self.registry.start()
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [('', list(zip(self.labelnames, key)), value) for key, value in items]
+
+class Histogram(Metric):
+    """Istogramma a bucket cumulativi, con somma e conteggio delle osservazioni."""
+
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Registra un'osservazione per le etichette indicate."""
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][index] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+        self.registry.start()
+
+    @contextmanager
+    def time(self, **labels):
+        """Misura la durata del blocco with e la registra come osservazione."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, dict(state, buckets=list(state['buckets']))) for key, state in self._values.items()]
+
+        samples = []
+        for key, state in items:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['buckets']):
+                cumulative += count
+                samples.append(('_bucket', labels + [('le', _format_value(bound))], cumulative))
+            samples.append(('_bucket', labels + [('le', '+Inf')], state['count']))
+            samples.append(('_sum', labels, state['sum']))
+            samples.append(('_count', labels, state['count']))
+        return samples
+
+class MetricsRegistry:
+    """Registro delle metriche del processo, con persistenza condivisa tra processi."""
+
+    def __init__(self, db_path=None, flush_interval=FLUSH_INTERVAL):
+        """
+        Inizializza il registro.
+
+        Args:
+            db_path (str|Path, optional): File SQLite condiviso. Default da METRICS_DB_PATH
+                                          o data/metrics.sqlite3
+            flush_interval (float): Secondi tra le scritture in background
+        """
+        self.logger = logging.getLogger(__name__)
+        self.db_path = Path(db_path or os.environ.get("METRICS_DB_PATH", DEFAULT_DB_PATH))
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._process_key = self._new_process_key()
+        self._schema_ready = False
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _new_process_key():
+        """Identificativo univoco del processo (il PID da solo può essere riutilizzato)."""
+        return f"{socket.gethostname()}:{os.getpid()}:{time.time():.3f}"
+
+    def _after_fork(self):
+        """Nel processo figlio i valori ereditati appartengono al padre: si riparte da zero."""
+        self._process_key = self._new_process_key()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._lock = threading.Lock()
+            metric.reset()
+
+    def counter(self, name, documentation, labelnames=()):
+        """Crea (o restituisce) un contatore."""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Crea (o restituisce) un istogramma."""
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, documentation, labelnames, **kwargs)
+            return metric
+
+    def register_collector(self, collector):
+        """
+        Registra una funzione che calcola metriche istantanee al momento della lettura.
+
+        La funzione restituisce una lista di tuple
+        (nome, tipo, descrizione, [(dizionario etichette, valore), ...]).
+
+        Args:
+            collector (callable): Funzione senza argomenti
+        """
+        self._collectors.append(collector)
+
+    def start(self):
+        """Avvia il thread di scrittura periodica, se non è già attivo."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            # Creato in modo pigro: in gunicorn ogni worker avvia il proprio dopo il fork
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Ciclo del thread di scrittura."""
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _connect(self):
+        """Apre il file condiviso, creando la tabella se necessario."""
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.db_path), timeout=5)
+        if not self._schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metric_samples (
+                    process TEXT NOT NULL,
+                    family TEXT NOT NULL,
+                    sample TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (process, sample, labels)
+                )
+            """)
+            conn.commit()
+            self._schema_ready = True
+        return conn
+
+    def _local_rows(self):
+        """Campioni del processo come righe (famiglia, nome campione, etichette JSON, valore)."""
+        rows = []
+        for metric in list(self._metrics.values()):
+            for suffix, labels, value in metric.samples():
+                rows.append((metric.name, metric.name + suffix, json.dumps(labels), value))
+        return rows
+
+    def flush(self):
+        """Scrive i valori del processo nel file condiviso."""
+        rows = self._local_rows()
+        if not rows:
+            return
+        now = time.time()
+        with self._flush_lock:
+            try:
+                conn = self._connect()
+                try:
+                    with conn:
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO metric_samples (process, family, sample, labels, value, updated_at) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            [(self._process_key, family, sample, labels, value, now) for family, sample, labels, value in rows]
+                        )
+                        self._retire_stale_processes(conn, now)
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                self.logger.warning(f"Impossibile salvare le metriche: {str(e)}")
+
+    def _retire_stale_processes(self, conn, now):
+        """Somma i valori dei processi non più aggiornati in RETIRED_PROCESS e ne rimuove le righe."""
+        cutoff = now - RETENTION
+        conn.execute(
+            "INSERT INTO metric_samples (process, family, sample, labels, value, updated_at) "
+            "SELECT ?, family, sample, labels, SUM(value), ? FROM metric_samples "
+            "WHERE updated_at < ? AND process != ? GROUP BY family, sample, labels "
+            "ON CONFLICT (process, sample, labels) DO UPDATE SET value = value + excluded.value, "
+            "updated_at = excluded.updated_at",
+            (RETIRED_PROCESS, now, cutoff, RETIRED_PROCESS)
+        )
+        conn.execute("DELETE FROM metric_samples WHERE updated_at < ? AND process != ?", (cutoff, RETIRED_PROCESS))
+
+    def _aggregated_rows(self):
+        """Somma dei campioni di tutti i processi (solo quelli locali se il file non è disponibile)."""
+        self.flush()
+        try:
+            conn = self._connect()
+            try:
+                return conn.execute(
+                    "SELECT family, sample, labels, SUM(value) FROM metric_samples GROUP BY family, sample, labels"
+                ).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            self.logger.warning(f"Metriche condivise non disponibili, uso quelle del processo: {str(e)}")
+            return self._local_rows()
+
+    def render(self):
+        """
+        Restituisce tutte le metriche nel formato testuale di Prometheus.
+
+        Returns:
+            str: Testo da servire con Content-Type text/plain; version=0.0.4
+        """
+        by_family = {}
+        for family, sample, labels, value in self._aggregated_rows():
+            by_family.setdefault(family, []).append((sample, json.loads(labels), value))
+
+        lines = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for sample, labels, value in sorted(by_family.get(name, []), key=self._sample_order):
+                lines.append(f"{sample}{_format_labels(labels)} {_format_value(value)}")
+
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                self.logger.warning(f"Collector di metriche fallito: {str(e)}")
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _sample_order(item):
+        """Ordina i campioni per etichette (senza 'le'), poi bucket crescenti, somma e conteggio."""
+        sample, labels, _ = item
+        base = [pair for pair in labels if pair[0] != 'le']
+        le = next((pair[1] for pair in labels if pair[0] == 'le'), None)
+        bound = float('inf') if le in (None, '+Inf') else float(le)
+        suffix_order = {'_bucket': 0, '_sum': 1, '_count': 2}
+        suffix = next((order for s, order in suffix_order.items() if sample.endswith(s)), 0)
+        return (json.dumps(base), suffix, bound)
+
+# Istanza globale del registro
+metrics = MetricsRegistry()
+
+# Metriche HTTP e database
+HTTP_REQUEST_DURATION = metrics.histogram(
+    'http_request_duration_seconds', "Durata delle richieste HTTP per route",
+    ('method', 'endpoint', 'status')
+)
+HTTP_REQUEST_DB_QUERIES = metrics.histogram(
+    'http_request_db_queries', "Query al database eseguite per richiesta HTTP",
+    ('endpoint',), buckets=(1, 2, 5, 10, 20, 50, 100, 250)
+)
+DB_QUERIES = metrics.counter(
+    'db_queries_total', "Query eseguite sul database per tipo di istruzione",
+    ('operation',)
+)
+
+# Metriche dell'API Kobold e della generazione
+KOBOLD_REQUEST_DURATION = metrics.histogram(
+    'kobold_request_duration_seconds', "Durata delle chiamate all'API Kobold per endpoint e backend",
+    ('endpoint', 'backend', 'result')
+)
+AI_GENERATION_DURATION = metrics.histogram(
+    'ai_generation_duration_seconds', "Durata delle generazioni AI (sincrone o in streaming)",
+    ('mode', 'result')
+)
+AI_FIRST_TOKEN_DURATION = metrics.histogram(
+    'ai_first_token_seconds', "Attesa del primo token nelle generazioni in streaming"
+)
+AI_REVIEW_REQUESTS = metrics.counter(
+    'ai_review_requests_total', "Richieste di recensione prodotte per origine (cache, kobold, fallback)",
+    ('source',)
+)
+AI_GENERATION_CANCELLATIONS = metrics.counter(
+    'ai_generation_cancellations_total', "Generazioni interrotte con l'abort di Kobold, per motivo",
+    ('reason',)
+)
+AI_CACHE_EVENTS = metrics.counter(
+    'ai_cache_events_total', "Eventi della cache AI per livello (hit, miss, eviction, scrittura)",
+    ('tier', 'event')
+)
+
+# Metriche di invio email
+EMAIL_SEND_DURATION = metrics.histogram(
+    'email_send_duration_seconds', "Durata dell'invio di un'email per trasporto",
+    ('transport', 'result')
+)
+SMTP_CONNECTION_EVENTS = metrics.counter(
+    'smtp_connection_events_total', "Eventi del pool SMTP (apertura, riuso, probe fallito, riconnessione, chiusura)",
+    ('event',)
+)
+
+def _statement_operation(statement):
+    """Tipo di istruzione SQL (select, insert, update, delete, other)."""
+    keyword = statement.lstrip().split(None, 1)[0].lower() if statement and statement.strip() else ''
+    return keyword if keyword in ('select', 'insert', 'update', 'delete') else 'other'
+
+def init_metrics(app):
+    """
+    Registra sull'applicazione Flask la misura delle richieste e delle query.
+
+    Per le risposte in streaming la durata misurata arriva fino all'invio delle
+    intestazioni, non fino alla fine dello stream.
+
+    Args:
+        app (Flask): Applicazione
+    """
+    from flask import g, request, has_request_context
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_start = time.perf_counter()
+        g._metrics_queries = 0
+
+    @app.after_request
+    def _record_request_metrics(response):
+        start = g.pop('_metrics_start', None)
+        if start is not None:
+            endpoint = request.endpoint or 'unmatched'
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start,
+                method=request.method, endpoint=endpoint, status=response.status_code
+            )
+            HTTP_REQUEST_DB_QUERIES.observe(g.pop('_metrics_queries', 0), endpoint=endpoint)
+        return response
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERIES.inc(operation=_statement_operation(statement))
+        if has_request_context() and '_metrics_queries' in g:
+            g._metrics_queries += 1
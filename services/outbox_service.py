@@ -0,0 +1,307 @@
+"""
+Outbox Service
+
+Questo modulo gestisce l'outbox delle email: le route di invio (singolo e
+campagna, vedi services/campaign_service.py) salvano la Request in stato
+'queued' e il messaggio da spedire (OutboxMessage) con un unico commit e
+rispondono subito. Un processo separato (worker.py) preleva i messaggi a
+blocchi, li invia e aggiorna lo stato di entrambe le righe; gli invii falliti
+vengono ritentati con attesa crescente.
+
+La consegna è "almeno una volta": se il worker termina tra l'invio e il
+commit, il messaggio torna in coda alla scadenza del lease e viene reinviato.
+"""
+
+import os
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func, select, update
+from app import db
+from models import Request, OutboxMessage
+from services.email_service import send_email_batch, select_transport, MAILTRAP_BATCH_SIZE
+from services.campaign_service import rate_limiter
+from services.metrics import metrics
+
+# Numero massimo di tentativi di invio per messaggio
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 5))
+
+# Attesa di base (secondi) prima di ritentare un invio, raddoppiata ad ogni tentativo
+OUTBOX_RETRY_BASE = float(os.environ.get("OUTBOX_RETRY_BASE", 30))
+
+# Messaggi prelevati da un worker con una sola query (con Mailtrap almeno MAILTRAP_BATCH_SIZE)
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 20))
+
+# Dopo questo intervallo (secondi) un messaggio in invio è considerato abbandonato (worker terminato)
+OUTBOX_LEASE_TIMEOUT = int(os.environ.get("OUTBOX_LEASE_TIMEOUT", 300))
+
+# Stati di un messaggio dell'outbox
+OUTBOX_STATUSES = ('pending', 'sending', 'sent', 'failed')
+
+def enqueue_email(company, subject, message, template_id=None, user_id=None):
+    """
+    Registra una richiesta di recensione e la accoda per l'invio.
+
+    Args:
+        company (Company): Azienda destinataria
+        subject (str): Oggetto dell'email
+        message (str): Testo dell'email
+        template_id (str, optional): Template usato per il messaggio
+        user_id (str, optional): Utente che ha chiesto l'invio
+
+    Returns:
+        Request: La richiesta accodata
+    """
+    request_obj = Request(
+        company_id=company.id,
+        template_id=template_id,
+        user_id=user_id,
+        subject=subject,
+        message=message,
+        status='queued',
+        opened=False,
+        responded=False
+    )
+    db.session.add(request_obj)
+    db.session.flush()
+    db.session.add(OutboxMessage(
+        request_id=request_obj.id,
+        recipient=company.email,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        next_attempt_at=datetime.utcnow()
+    ))
+    # Richiesta e messaggio nella stessa transazione: non possono divergere
+    db.session.commit()
+    logging.info(f"Richiesta {request_obj.id} accodata per l'invio a {company.email}")
+    return request_obj
+
+def claim_outbox_batch(worker_id, limit=OUTBOX_BATCH_SIZE):
+    """
+    Preleva un blocco di messaggi pronti e li assegna al worker.
+
+    Un unico UPDATE ... WHERE id IN (SELECT ... LIMIT n) porta i messaggi in
+    stato 'sending'. Su PostgreSQL la sottoquery usa FOR UPDATE SKIP LOCKED,
+    così worker concorrenti prelevano blocchi diversi senza attendersi; su
+    SQLite la clausola viene omessa e l'istruzione è serializzata dal lock di
+    scrittura del database. La condizione sullo stato evita in entrambi i casi
+    che un messaggio venga assegnato due volte.
+
+    Args:
+        worker_id (str): Identificativo del worker
+        limit (int): Numero massimo di messaggi
+
+    Returns:
+        list: OutboxMessage assegnati al worker
+    """
+    now = datetime.utcnow()
+    ready = (
+        select(OutboxMessage.id)
+        .where(OutboxMessage.status == 'pending', OutboxMessage.next_attempt_at <= now)
+        .order_by(OutboxMessage.next_attempt_at)
+        .limit(limit)
+    )
+    if db.engine.dialect.name == 'postgresql':
+        ready = ready.with_for_update(skip_locked=True)
+
+    claimed = db.session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.id.in_(ready.scalar_subquery()), OutboxMessage.status == 'pending')
+        .values(
+            status='sending',
+            claimed_by=worker_id,
+            claimed_at=now,
+            attempts=OutboxMessage.attempts + 1,
+            updated_at=now
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return []
+
+    return OutboxMessage.query.filter_by(status='sending', claimed_by=worker_id).all()
+
+def deliver_outbox_messages(messages, subject):
+    """
+    Invia un blocco di messaggi assegnati con lo stesso oggetto e ne salva l'esito.
+
+    L'invio usa send_email_batch (endpoint batch con Mailtrap); gli esiti di
+    tutto il blocco vengono salvati con un solo commit.
+
+    Args:
+        messages (list): OutboxMessage in stato 'sending' con la relativa richiesta
+        subject (str): Oggetto comune delle email
+
+    Returns:
+        int: Numero di email inviate
+    """
+    try:
+        # Niente salvataggio locale al posto dell'invio: un errore deve portare a un nuovo tentativo
+        results = send_email_batch(
+            [(message.recipient, message.request.message) for message in messages],
+            subject,
+            allow_local_fallback=False
+        )
+    except Exception as e:
+        results = [{'status': 'failed', 'error': str(e)}] * len(messages)
+
+    delivered = 0
+    now = datetime.utcnow()
+    for message, result in zip(messages, results):
+        request_obj = message.request
+        if result['status'] == 'failed':
+            logging.warning(f"Invio del messaggio {message.id} fallito al tentativo {message.attempts}: {result.get('error')}")
+            _fail_message(message, result.get('error'), retry=message.attempts < message.max_attempts)
+            continue
+
+        message.status = 'sent'
+        message.sent_at = now
+        message.last_error = None
+        message.claimed_by = None
+        request_obj.status = 'delivered'
+        if isinstance(result.get('date'), str):
+            request_obj.date_sent = datetime.fromisoformat(result['date'])
+        else:
+            request_obj.date_sent = now
+        delivered += 1
+        logging.info(f"Richiesta {request_obj.id} inviata a {message.recipient}")
+    db.session.commit()
+    return delivered
+
+def _fail_message(message, error, retry=True):
+    """
+    Registra l'errore e ripianifica l'invio con backoff esponenziale, se previsto.
+
+    Il commit è a carico del chiamante.
+    """
+    message.last_error = error
+    message.claimed_by = None
+    message.claimed_at = None
+    if retry:
+        delay = OUTBOX_RETRY_BASE * (2 ** max(0, message.attempts - 1))
+        message.status = 'pending'
+        message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        logging.info(f"Messaggio {message.id} ripianificato tra {delay:.0f}s")
+    else:
+        message.status = 'failed'
+        if message.request is not None:
+            message.request.status = 'failed'
+
+def process_outbox_batch(worker_id, limit=None):
+    """
+    Preleva e invia un blocco di messaggi.
+
+    I messaggi vengono raggruppati per oggetto e inviati a blocchi
+    (MAILTRAP_BATCH_SIZE per richiesta con Mailtrap, uno alla volta con gli
+    altri trasporti), rispettando il limite di invii al secondo del trasporto.
+
+    Args:
+        worker_id (str): Identificativo del worker
+        limit (int, optional): Numero massimo di messaggi; se omesso
+            OUTBOX_BATCH_SIZE, o MAILTRAP_BATCH_SIZE se maggiore quando il
+            trasporto è Mailtrap, così da riempire una richiesta batch
+
+    Returns:
+        int: Numero di messaggi elaborati (0 se l'outbox è vuota)
+    """
+    transport = select_transport()
+    chunk_size = max(1, MAILTRAP_BATCH_SIZE) if transport == 'mailtrap' else 1
+    if limit is None:
+        limit = max(OUTBOX_BATCH_SIZE, chunk_size)
+
+    messages = claim_outbox_batch(worker_id, limit)
+    by_subject = {}
+    for message in messages:
+        if message.request is None:
+            _fail_message(message, 'Richiesta non trovata', retry=False)
+            db.session.commit()
+            continue
+        by_subject.setdefault(message.request.subject, []).append(message)
+
+    for subject, group in by_subject.items():
+        for start in range(0, len(group), chunk_size):
+            rate_limiter.acquire(transport)
+            deliver_outbox_messages(group[start:start + chunk_size], subject)
+    return len(messages)
+
+def requeue_stale_outbox():
+    """
+    Rimette in coda i messaggi rimasti in invio oltre OUTBOX_LEASE_TIMEOUT.
+
+    Returns:
+        int: Numero di messaggi rimessi in coda
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=OUTBOX_LEASE_TIMEOUT)
+    requeued = (
+        OutboxMessage.query
+        .filter(OutboxMessage.status == 'sending', OutboxMessage.claimed_at < cutoff)
+        .update({
+            'status': 'pending',
+            'claimed_by': None,
+            'claimed_at': None,
+            'last_error': 'Worker terminato durante l\'invio',
+            'next_attempt_at': datetime.utcnow()
+        }, synchronize_session=False)
+    )
+    db.session.commit()
+    if requeued:
+        logging.warning(f"{requeued} messaggi dell'outbox abbandonati rimessi in coda")
+    return requeued
+
+def get_outbox_stats():
+    """
+    Restituisce il numero di messaggi dell'outbox per stato.
+
+    Returns:
+        dict: Conteggi per stato, più il totale
+    """
+    counts = dict(
+        db.session.query(OutboxMessage.status, func.count(OutboxMessage.id))
+        .group_by(OutboxMessage.status)
+        .all()
+    )
+    stats = {status: counts.get(status, 0) for status in OUTBOX_STATUSES}
+    stats['total'] = sum(counts.values())
+    return stats
+
+def get_campaign_progress(request_ids):
+    """
+    Restituisce lo stato di invio di una campagna, dai messaggi dell'outbox
+    delle sue richieste.
+
+    Args:
+        request_ids (list): Identificativi delle richieste della campagna
+
+    Returns:
+        dict: Conteggi per stato, messaggi in attesa di un nuovo tentativo
+              ('retrying'), inviati o falliti ('done') e totale
+    """
+    rows = (
+        db.session.query(
+            OutboxMessage.status,
+            OutboxMessage.attempts > 0,
+            func.count(OutboxMessage.id)
+        )
+        .filter(OutboxMessage.request_id.in_(set(request_ids)))
+        .group_by(OutboxMessage.status, OutboxMessage.attempts > 0)
+        .all()
+    )
+    progress = {status: 0 for status in OUTBOX_STATUSES}
+    progress['retrying'] = 0
+    for status, retried, count in rows:
+        progress[status] = progress.get(status, 0) + count
+        if status == 'pending' and retried:
+            progress['retrying'] += count
+    progress['done'] = progress['sent'] + progress['failed']
+    progress['total'] = sum(count for _, _, count in rows)
+    return progress
+
+def _collect_outbox_metrics():
+    """Numero di messaggi dell'outbox per stato, per /metrics."""
+    stats = get_outbox_stats()
+    return [
+        ('email_outbox_messages', 'gauge', "Messaggi dell'outbox email per stato", [
+            ({'status': status}, stats[status]) for status in OUTBOX_STATUSES
+        ])
+    ]
+
+metrics.register_collector(_collect_outbox_metrics)
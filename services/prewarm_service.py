@@ -0,0 +1,192 @@
+"""
+Prewarm Service
+
+Questo modulo pre-genera in background le richieste per le coppie
+azienda×template interessate da una modifica (template modificato o azienda
+aggiunta), in modo che la successiva generazione interattiva trovi già il
+risultato in cache. Il pre-warm è opzionale (impostazione prewarm_enabled),
+ha un limite di concorrenza e le sue generazioni hanno la priorità più bassa
+nello scheduler (vedi services/llm_scheduler.py): cedono sempre il passo a
+quelle interattive e batch.
+"""
+
+import queue
+import logging
+import threading
+from datetime import datetime
+
+class PrewarmQueue:
+    """Coda di pre-generazione con worker a bassa priorità."""
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._running = 0
+        self.concurrency = 1
+        self._progress = {
+            'queued': 0,
+            'completed': 0,
+            'generated': 0,
+            'cached': 0,
+            'skipped': 0,
+            'failed': 0,
+            'last_error': None,
+            'last_activity': None
+        }
+
+    def enqueue(self, pairs, concurrency=1):
+        """
+        Accoda le coppie (azienda, template) da pre-generare.
+
+        Args:
+            pairs (list): Lista di tuple (company dict, template dict)
+            concurrency (int): Numero massimo di pre-generazioni contemporanee
+
+        Returns:
+            int: Numero di coppie effettivamente accodate (escluse quelle già in coda)
+        """
+        from services.ai_service import _generate_cache_key
+
+        added = 0
+        with self._lock:
+            self.concurrency = max(1, int(concurrency))
+            for company, template in pairs:
+                cache_key = _generate_cache_key(company, template)
+                if cache_key in self._pending:
+                    continue
+                self._pending.add(cache_key)
+                self._queue.put((cache_key, company, template))
+                added += 1
+
+            self._progress['queued'] += added
+            self._progress['last_activity'] = datetime.now().isoformat()
+            self._start_workers()
+
+        if added:
+            self.logger.info(f"Pre-warm: accodate {added} coppie azienda/template")
+        return added
+
+    def _start_workers(self):
+        """Avvia i worker mancanti fino al limite di concorrenza (da chiamare con il lock)."""
+        self._workers = [w for w in self._workers if w.is_alive()]
+        while len(self._workers) < self.concurrency:
+            worker = threading.Thread(target=self._run, name=f'prewarm-{len(self._workers)}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _run(self):
+        """Ciclo di un worker di pre-generazione."""
+        from app import app
+        from services.ai_service import prewarm_review_request
+
+        while True:
+            try:
+                cache_key, company, template = self._queue.get(timeout=30)
+            except queue.Empty:
+                # Nessun lavoro: il worker termina e verrà ricreato al prossimo accodamento.
+                # La decisione va presa con il lock, che enqueue tiene mentre accoda e
+                # conta i worker vivi: altrimenti un elemento accodato tra il timeout e
+                # l'uscita resterebbe senza worker
+                with self._lock:
+                    if self._queue.empty():
+                        self._workers.remove(threading.current_thread())
+                        return
+                continue
+
+            with self._lock:
+                self._running += 1
+
+            try:
+                with app.app_context():
+                    outcome = prewarm_review_request(company, template)
+                self._record(outcome)
+            except Exception as e:
+                self.logger.warning(f"Pre-warm fallito per {company.get('name')}: {str(e)}")
+                self._record('failed', str(e))
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._pending.discard(cache_key)
+                self._queue.task_done()
+
+    def _record(self, outcome, error=None):
+        """Aggiorna i contatori di avanzamento."""
+        with self._lock:
+            self._progress['completed'] += 1
+            self._progress[outcome] += 1
+            self._progress['last_activity'] = datetime.now().isoformat()
+            if error:
+                self._progress['last_error'] = error
+
+    def status(self):
+        """
+        Restituisce lo stato di avanzamento del pre-warm.
+
+        Returns:
+            dict: Contatori, elementi in attesa e worker attivi
+        """
+        with self._lock:
+            status = dict(self._progress)
+            status['pending'] = len(self._pending)
+            status['running'] = self._running
+            status['workers'] = sum(1 for w in self._workers if w.is_alive())
+            status['concurrency'] = self.concurrency
+        return status
+
+def _prewarm_settings():
+    """
+    Restituisce lo stato di attivazione e la concorrenza del pre-warm.
+
+    Returns:
+        tuple: (enabled, concurrency)
+    """
+    from services.settings_service import get_settings
+
+    settings = get_settings()
+    return bool(settings.get('prewarm_enabled')), settings.get('prewarm_concurrency', 1)
+
+def prewarm_for_template(template):
+    """
+    Accoda il pre-warm delle aziende della stessa categoria di un template.
+
+    Args:
+        template (Template): Template aggiunto o modificato
+
+    Returns:
+        int: Numero di coppie accodate (0 se il pre-warm è disattivato)
+    """
+    from models import Company
+
+    enabled, concurrency = _prewarm_settings()
+    if not enabled:
+        return 0
+
+    template_data = template.to_dict()
+    companies = Company.query.filter_by(category_id=template.category_id).all()
+    return prewarm_queue.enqueue([(c.to_dict(), template_data) for c in companies], concurrency)
+
+def prewarm_for_company(company):
+    """
+    Accoda il pre-warm dei template della stessa categoria di un'azienda.
+
+    Args:
+        company (Company): Azienda aggiunta o modificata
+
+    Returns:
+        int: Numero di coppie accodate (0 se il pre-warm è disattivato)
+    """
+    from models import Template
+
+    enabled, concurrency = _prewarm_settings()
+    if not enabled:
+        return 0
+
+    company_data = company.to_dict()
+    templates = Template.query.filter_by(category_id=company.category_id).all()
+    return prewarm_queue.enqueue([(company_data, t.to_dict()) for t in templates], concurrency)
+
+# Istanza globale della coda di pre-warm
+prewarm_queue = PrewarmQueue()
@@ -0,0 +1,251 @@
+"""
+Prompt Builder
+
+Questo modulo costruisce i prompt per la generazione delle richieste di
+recensione. Il testo viene compattato (niente indentazione o spazi superflui)
+e adattato al contesto del modello: se il prompt non entra nel budget di token,
+i campi a priorità più bassa vengono accorciati o rimossi per primi.
+"""
+
+import re
+import logging
+
+# Caratteri per token stimati (prudente per testo italiano con tokenizer BPE)
+CHARS_PER_TOKEN = 3.0
+
+# Token riservati oltre alla generazione, per differenze tra stima e tokenizer reale
+SAFETY_MARGIN = 32
+
+# Oltre questa frazione del budget la stima locale viene verificata con il tokenizer del server
+VERIFY_THRESHOLD = 0.8
+
+# Lunghezza minima (caratteri) sotto la quale un campo viene rimosso invece che troncato
+MIN_FIELD_CHARS = 40
+
+SYSTEM_PROMPT = "Sei C-Recenzione, un assistente professionale per la generazione di richieste di recensioni di prodotti."
+
+PROMPT_TEMPLATE = """
+Genera una richiesta di recensione personalizzata per un'azienda basandoti sui seguenti dati:
+- Nome azienda: {name}
+- Prodotti: {products}
+- Categoria: {category}
+{website_line}
+Utilizza il seguente template come base e personalizzalo in modo appropriato:
+---
+{template}
+---
+
+Requisiti:
+1. La richiesta deve essere professionale, convincente e in italiano corretto
+2. Personalizza il messaggio con i dettagli specifici dell'azienda
+3. Aggiungi un'introduzione formale e una chiusura cordiale
+4. Evidenzia il valore della recensione per entrambe le parti
+5. Mantieni un tono rispettoso e professionale
+6. {placeholder_rule}
+
+Fornisci solo il testo della richiesta, senza commenti aggiuntivi.
+"""
+
+# Regola sui segnaposto: il testo normale è definitivo, quello con slot viene
+# completato per ogni azienda dal motore di template (vedi cluster_service)
+PLACEHOLDER_RULE = "Non includere placeholder o testo generico che deve essere sostituito"
+SLOT_RULE = (
+    "Scrivi esattamente {slots} ovunque servano: verranno sostituiti con i dati di "
+    "ciascun destinatario. Non usare altri placeholder tra parentesi quadre"
+)
+
+# Sequenze che chiudono la generazione di un'email: fine turno, ripetizione dei
+# delimitatori o dei requisiti del prompt, inizio di note. "Oggetto:" non è tra
+# queste perché il modello apre spesso l'email con l'oggetto: la riga iniziale e
+# un eventuale secondo messaggio vengono rimossi da clean_generated_text
+STOP_SEQUENCES = [
+    "</s>", "User:", "System:",
+    "\n---", "\nRequisiti:", "\nNota:", "\n\n\n\n"
+]
+
+# Campi accorciabili, dal meno al più importante
+FIELD_PRIORITY = ('website', 'products', 'template')
+
+_SPACES_RE = re.compile(r'[ \t]+')
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+_LEADING_SUBJECT_RE = re.compile(r'^\**oggetto\**\s*:[^\n]*\n?', re.IGNORECASE)
+_NEXT_SUBJECT_RE = re.compile(r'\n\s*\**oggetto\**\s*:', re.IGNORECASE)
+
+def compact_whitespace(text):
+    """
+    Rimuove l'indentazione e gli spazi superflui mantenendo la struttura in righe.
+
+    Args:
+        text (str): Testo da compattare
+
+    Returns:
+        str: Testo compattato
+    """
+    lines = [_SPACES_RE.sub(' ', line).strip() for line in text.splitlines()]
+    return _BLANK_LINES_RE.sub('\n\n', '\n'.join(lines)).strip()
+
+def clean_generated_text(text):
+    """
+    Rimuove dal testo generato la riga iniziale con l'oggetto dell'email e
+    tutto ciò che segue un secondo "Oggetto:" (inizio di un altro messaggio).
+
+    Args:
+        text (str): Testo generato dal modello
+
+    Returns:
+        str: Corpo dell'email (vuoto se il modello ha scritto solo l'oggetto)
+    """
+    text = _LEADING_SUBJECT_RE.sub('', text.strip(), count=1)
+    return _NEXT_SUBJECT_RE.split(text, maxsplit=1)[0].strip()
+
+def estimate_tokens(text):
+    """
+    Stima il numero di token di un testo senza chiamare il server.
+
+    Returns:
+        int: Numero di token stimato
+    """
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+def _truncate_list(text, max_chars):
+    """
+    Accorcia un elenco separato da virgole mantenendo i primi elementi interi.
+
+    Args:
+        text (str): Elenco da accorciare (es. prodotti)
+        max_chars (int): Lunghezza massima
+
+    Returns:
+        str: Elenco accorciato, con l'indicazione degli elementi omessi
+    """
+    items = [item.strip() for item in re.split(r'[,;\n]', text) if item.strip()]
+    kept = []
+    length = 0
+    for item in items:
+        if kept and length + len(item) + 2 > max_chars:
+            break
+        kept.append(item)
+        length += len(item) + 2
+
+    omitted = len(items) - len(kept)
+    if len(kept) == 1 and len(kept[0]) > max_chars:
+        return _truncate_text(kept[0], max_chars)
+    if omitted:
+        return f"{', '.join(kept)} e altri {omitted}"
+    return ', '.join(kept)
+
+def _truncate_text(text, max_chars):
+    """Accorcia un testo all'ultima parola intera entro max_chars caratteri."""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars].rsplit(None, 1)[0] if ' ' in text[:max_chars] else text[:max_chars]
+    return cut.rstrip(' ,.;:') + '…'
+
+class PromptBuilder:
+    """Costruisce prompt compatti che rispettano il contesto del modello."""
+
+    def __init__(self, client):
+        """
+        Inizializza il builder.
+
+        Args:
+            client (KoboldClient): Client usato per il conteggio dei token e la lunghezza del contesto
+        """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+
+    def _render(self, fields, slots=None):
+        """Compone il prompt completo a partire dai campi."""
+        website_line = f"- Sito web: {fields['website']}\n" if fields['website'] else ""
+        if slots:
+            placeholder_rule = SLOT_RULE.format(slots=' e '.join(slots))
+        else:
+            placeholder_rule = PLACEHOLDER_RULE
+        prompt = PROMPT_TEMPLATE.format(
+            name=fields['name'],
+            products=fields['products'] or 'prodotti vari',
+            category=fields['category'] or 'generale',
+            website_line=website_line,
+            template=fields['template'],
+            placeholder_rule=placeholder_rule
+        )
+        return compact_whitespace(f"{SYSTEM_PROMPT}\n\n{prompt}")
+
+    def _count(self, prompt, budget):
+        """
+        Conta i token del prompt.
+
+        Il tokenizer del server viene interpellato solo quando la stima locale
+        si avvicina al budget, per non aggiungere una chiamata ad ogni generazione.
+
+        Returns:
+            tuple: (numero di token, True se il conteggio è esatto)
+        """
+        estimate = estimate_tokens(prompt)
+        if estimate < budget * VERIFY_THRESHOLD:
+            return estimate, False
+
+        exact = self.client.count_tokens(prompt)
+        if exact is None:
+            return estimate, False
+        return exact, True
+
+    def build(self, company, template, max_length=1000, category_name=None, slots=None):
+        """
+        Costruisce il prompt per un'azienda e un template.
+
+        Args:
+            company (dict): Dati dell'azienda
+            template (dict): Template da utilizzare come base
+            max_length (int): Token riservati alla generazione
+            category_name (str, optional): Nome leggibile della categoria
+            slots (list, optional): Segnaposto (es. "[Nome Azienda]") che il modello
+                                    deve lasciare nel testo invece dei dati reali
+
+        Returns:
+            str: Prompt completo, entro il budget di token del modello
+        """
+        fields = {
+            'name': company['name'],
+            'products': compact_whitespace(company.get('products') or ''),
+            'category': category_name or company.get('category') or '',
+            'website': (company.get('website') or '').strip(),
+            'template': compact_whitespace(template['content'])
+        }
+
+        budget = self.client.get_context_length() - max_length - SAFETY_MARGIN
+        prompt = self._render(fields, slots)
+        tokens, exact = self._count(prompt, budget)
+
+        for field in FIELD_PRIORITY:
+            if tokens <= budget:
+                break
+
+            # Accorcia il campo in proporzione ai token in eccesso, poi ricontrolla
+            while tokens > budget and fields[field]:
+                excess_chars = int((tokens - budget) * CHARS_PER_TOKEN) + 1
+                previous = fields[field]
+                target = len(previous) - excess_chars
+                if target < MIN_FIELD_CHARS:
+                    fields[field] = ''
+                elif field == 'products':
+                    fields[field] = _truncate_list(previous, target)
+                else:
+                    fields[field] = _truncate_text(previous, target)
+
+                if len(fields[field]) >= len(previous):
+                    # Il troncamento non riduce più il campo: lo rimuoviamo
+                    fields[field] = ''
+
+                self.logger.debug(f"Campo '{field}' del prompt accorciato a {len(fields[field])} caratteri")
+                prompt = self._render(fields, slots)
+                tokens, exact = self._count(prompt, budget)
+
+        if tokens > budget:
+            self.logger.warning(f"Prompt oltre il budget anche dopo il troncamento: {tokens} token su {budget}")
+
+        self.logger.info(
+            f"Prompt per {company['name']}: {tokens} token{'' if exact else ' (stima)'}, "
+            f"budget {budget}, generazione {max_length}"
+        )
+        return prompt
@@ -17,7 +17,11 @@ DEFAULT_SETTINGS = {
     'max_length': 1000,
     'temperature': 0.7,
     'top_p': 0.9,
-    'top_k': 40
+    'top_k': 40,
+    'generation_concurrency': 2,
+    'prewarm_enabled': False,
+    'prewarm_concurrency': 1,
+    'use_job_queue': False
 }
 
 def init_default_settings():
@@ -96,6 +100,18 @@ def save_settings(settings):
         if 'top_k' in filtered_settings:
             filtered_settings['top_k'] = int(filtered_settings['top_k'])
         
+        if 'generation_concurrency' in filtered_settings:
+            filtered_settings['generation_concurrency'] = max(1, int(filtered_settings['generation_concurrency']))
+        
+        if 'prewarm_concurrency' in filtered_settings:
+            filtered_settings['prewarm_concurrency'] = max(1, int(filtered_settings['prewarm_concurrency']))
+        
+        if 'prewarm_enabled' in filtered_settings:
+            filtered_settings['prewarm_enabled'] = filtered_settings['prewarm_enabled'] in [True, 'true', 'True', 'on', '1', 1]
+        
+        if 'use_job_queue' in filtered_settings:
+            filtered_settings['use_job_queue'] = filtered_settings['use_job_queue'] in [True, 'true', 'True', 'on', '1', 1]
+        
         if 'use_fallback' in filtered_settings:
             filtered_settings['use_fallback'] = filtered_settings['use_fallback'] in [True, 'true', 'True', 'on', '1', 1]
         
@@ -118,6 +134,24 @@ def get_kobold_api_url():
     settings = get_settings()
     return os.environ.get("KOBOLD_API_URL", settings.get('kobold_api_url', DEFAULT_SETTINGS['kobold_api_url']))
 
+def get_generation_concurrency():
+    """
+    Ottiene il numero massimo di generazioni concorrenti verso l'API Kobold.
+    
+    La variabile d'ambiente KOBOLD_MAX_CONCURRENCY ha la precedenza sulle impostazioni.
+    
+    Returns:
+        int: Numero di slot paralleli da utilizzare (almeno 1)
+    """
+    value = os.environ.get("KOBOLD_MAX_CONCURRENCY")
+    if not value:
+        value = get_settings().get('generation_concurrency', DEFAULT_SETTINGS['generation_concurrency'])
+    
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return DEFAULT_SETTINGS['generation_concurrency']
+
 def update_from_env():
     """Aggiorna le impostazioni dalle variabili d'ambiente."""
     settings = get_settings()
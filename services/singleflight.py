@@ -0,0 +1,168 @@
+"""
+Single Flight
+
+Questo modulo coalizza le chiamate concorrenti con la stessa chiave: la prima
+esegue il lavoro, le successive ne attendono e riutilizzano il risultato.
+All'interno del processo si usano eventi in memoria; tra processi diversi
+(worker gunicorn) si usa un lock nello store di cache condiviso.
+"""
+
+import time
+import logging
+import threading
+
+class _Call:
+    """Chiamata in corso per una chiave."""
+
+    def __init__(self, key):
+        self.key = key
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+    def wait(self, timeout=None):
+        """
+        Attende il completamento della chiamata.
+
+        Returns:
+            Il risultato della chiamata (solleva l'eventuale eccezione del leader)
+        """
+        self.event.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class SingleFlight:
+    """Esegue al più una chiamata alla volta per chiave."""
+
+    def __init__(self, lock_store=None, lock_ttl=60, poll_interval=0.25):
+        """
+        Inizializza il gruppo di chiamate.
+
+        Args:
+            lock_store (optional): Oggetto con acquire_lock/release_lock condiviso tra processi
+            lock_ttl (float): Durata massima del lock tra processi in secondi
+            poll_interval (float): Intervallo di attesa tra i controlli dei processi in attesa
+        """
+        self.logger = logging.getLogger(__name__)
+        self.lock_store = lock_store
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+        # Chiamata di cui il thread corrente è leader all'interno di do()
+        self._local = threading.local()
+
+    def begin(self, key):
+        """
+        Registra una chiamata per la chiave o si aggancia a quella in corso.
+
+        Returns:
+            tuple: (_Call, bool) dove il booleano indica se il chiamante è il leader
+                   e deve quindi eseguire il lavoro e chiamare finish()
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                return call, False
+            call = _Call(key)
+            self._calls[key] = call
+            return call, True
+
+    def current_call(self):
+        """Restituisce la chiamata di cui il thread corrente è leader in do(), o None."""
+        return getattr(self._local, 'call', None)
+
+    def abandon(self, call):
+        """
+        Ritira una chiamata che nessun altro attende, così il leader può interromperla.
+
+        Le chiamate successive con la stessa chiave non si agganciano più a quella
+        ritirata ma ne avviano una nuova.
+
+        Returns:
+            bool: True se la chiamata è stata ritirata, False se ha chiamanti in
+                  attesa (il lavoro va portato a termine per loro)
+        """
+        with self._lock:
+            if call.waiters:
+                return False
+            if self._calls.get(call.key) is call:
+                del self._calls[call.key]
+            return True
+
+    def finish(self, key, call, result=None, error=None):
+        """Completa la chiamata del leader e risveglia i chiamanti in attesa."""
+        call.result = result
+        call.error = error
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.event.set()
+
+    def do(self, key, fn, lookup=None):
+        """
+        Esegue fn() una sola volta tra le chiamate concorrenti con la stessa chiave.
+
+        Args:
+            key (str): Chiave che identifica il lavoro
+            fn (callable): Funzione che esegue il lavoro
+            lookup (callable, optional): Funzione che restituisce il risultato già
+                prodotto da un altro processo (es. lettura dalla cache), o None;
+                viene ripetuta durante l'attesa, quindi non deve alterare statistiche
+
+        Returns:
+            Il risultato di fn(), eventualmente condiviso
+        """
+        call, leader = self.begin(key)
+
+        if not leader:
+            self.logger.debug(f"Chiamata in attesa del risultato in corso per {key}")
+            result = call.wait()
+            # Se il leader non ha prodotto nulla (es. interrotto) il lavoro va rifatto
+            return result if result else fn()
+
+        result = None
+        error = None
+        outer_call = self.current_call()
+        self._local.call = call
+        try:
+            result = self._run_across_processes(key, fn, lookup)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._local.call = outer_call
+            self.finish(key, call, result, error)
+
+    def _run_across_processes(self, key, fn, lookup):
+        """Esegue fn() sotto il lock condiviso, o riutilizza il risultato di un altro processo."""
+        if self.lock_store is None or lookup is None:
+            return fn()
+
+        # Il lock di un processo scade dopo lock_ttl: oltre, non ha senso attendere
+        deadline = time.monotonic() + self.lock_ttl
+        while True:
+            if self.lock_store.acquire_lock(key, self.lock_ttl):
+                try:
+                    # Un altro processo potrebbe aver completato il lavoro subito prima
+                    result = lookup()
+                    if result:
+                        return result
+                    return fn()
+                finally:
+                    self.lock_store.release_lock(key)
+
+            # Il lock è di un altro processo: attendiamo il suo risultato nello store condiviso.
+            # Se il processo termina senza rilasciarlo, il lock scade dopo lock_ttl.
+            result = lookup()
+            if result:
+                self.logger.debug(f"Risultato per {key} prodotto da un altro processo")
+                return result
+            if time.monotonic() >= deadline:
+                self.logger.warning(f"Nessun risultato per {key} entro {self.lock_ttl}s: esecuzione senza lock")
+                return fn()
+            time.sleep(self.poll_interval)
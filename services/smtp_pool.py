@@ -0,0 +1,330 @@
+"""
+SMTP Pool
+
+Questo modulo mantiene connessioni SMTP persistenti, già protette con
+STARTTLS e autenticate, da riutilizzare tra un invio e l'altro: l'handshake
+TLS e il login vengono pagati una volta per connessione invece che per ogni
+email. Esiste un pool per ogni combinazione di server e credenziali.
+
+Prima di riusare una connessione rimasta inattiva viene inviato un NOOP; le
+connessioni chiuse dal server vengono sostituite in modo trasparente e ogni
+connessione viene chiusa dopo un numero massimo di messaggi.
+"""
+
+import os
+import time
+import socket
+import atexit
+import hashlib
+import logging
+import smtplib
+import threading
+from services.metrics import metrics, SMTP_CONNECTION_EVENTS
+
+# Connessioni aperte al massimo per ciascun pool
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", 4))
+
+# Messaggi inviati su una connessione prima di chiuderla e aprirne una nuova
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get("SMTP_MAX_MESSAGES_PER_CONNECTION", 100))
+
+# Inattività (secondi) oltre la quale la connessione viene verificata con NOOP prima del riuso
+SMTP_PROBE_AFTER = float(os.environ.get("SMTP_PROBE_AFTER", 15))
+
+# Inattività (secondi) oltre la quale la connessione viene chiusa (i server la chiudono comunque)
+SMTP_MAX_IDLE = float(os.environ.get("SMTP_MAX_IDLE", 240))
+
+# Timeout (secondi) delle operazioni sul socket
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", 30))
+
+# Errori che indicano una connessione non più utilizzabile. smtplib.SMTPException
+# deriva da OSError: va esclusa a parte (vedi _is_connection_error)
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError, socket.error)
+
+def _response_code(error):
+    """Codice SMTP di un errore di risposta (421 se almeno un destinatario l'ha ricevuto)."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return 421 if 421 in codes else (codes[0] if codes else None)
+    return getattr(error, 'smtp_code', None)
+
+def _is_connection_error(error):
+    """True se l'errore riguarda la connessione e non una risposta del server."""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(error, CONNECTION_ERRORS) and not isinstance(error, smtplib.SMTPException)
+
+class _PooledConnection:
+    """Connessione SMTP autenticata con i dati per decidere se riusarla."""
+
+    __slots__ = ('smtp', 'created_at', 'last_used', 'messages')
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.messages = 0
+
+class SMTPConnectionPool:
+    """Pool thread-safe di connessioni verso un server SMTP con credenziali fisse."""
+
+    def __init__(self, host, port, username='', password='', use_starttls=True, size=SMTP_POOL_SIZE,
+                 max_messages=SMTP_MAX_MESSAGES_PER_CONNECTION, probe_after=SMTP_PROBE_AFTER,
+                 max_idle=SMTP_MAX_IDLE, timeout=SMTP_TIMEOUT):
+        """
+        Inizializza il pool (le connessioni vengono aperte al primo utilizzo).
+
+        Args:
+            host (str): Server SMTP
+            port (int): Porta del server
+            username (str): Utente per il login (vuoto = nessun login)
+            password (str): Password per il login
+            use_starttls (bool): Se proteggere la connessione con STARTTLS
+            size (int): Connessioni aperte al massimo
+            max_messages (int): Messaggi per connessione prima di sostituirla
+            probe_after (float): Inattività dopo la quale verificare la connessione con NOOP
+            max_idle (float): Inattività dopo la quale chiudere la connessione
+            timeout (float): Timeout delle operazioni sul socket
+        """
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_starttls = use_starttls
+        self.size = max(1, size)
+        self.max_messages = max(1, max_messages)
+        self.probe_after = probe_after
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def send_message(self, msg):
+        """
+        Invia un messaggio su una connessione del pool.
+
+        Se una connessione riutilizzata risulta chiusa dal server, il messaggio
+        viene inviato una seconda volta su una connessione nuova; un errore su
+        una connessione appena aperta viene invece propagato. Un rifiuto del
+        server (es. 550 su un destinatario) viene propagato senza ripetere
+        l'invio e la connessione resta nel pool, salvo che il codice sia 421.
+
+        Args:
+            msg (email.message.Message): Messaggio da inviare
+
+        Returns:
+            dict: Destinatari rifiutati (come smtplib.SMTP.send_message)
+        """
+        while True:
+            conn, reused = self._checkout()
+            try:
+                refused = conn.smtp.send_message(msg)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                # Il server ha risposto: il messaggio non va ripetuto su un'altra connessione
+                if _response_code(e) == 421:
+                    # Il server chiude la sessione dopo la risposta 421
+                    self._discard(conn)
+                else:
+                    # La sessione resta utilizzabile (smtplib ha già inviato RSET)
+                    self._checkin(conn)
+                raise
+            except Exception as e:
+                self._discard(conn)
+                # Solo una connessione riusata e chiusa dal server giustifica un secondo invio
+                if not reused or not _is_connection_error(e):
+                    raise
+                SMTP_CONNECTION_EVENTS.inc(event='reconnect')
+                self.logger.info(f"Connessione SMTP a {self.host} chiusa dal server ({str(e)}), nuovo tentativo")
+                continue
+            conn.messages += 1
+            self._checkin(conn)
+            return refused
+
+    def _checkout(self):
+        """
+        Restituisce una connessione pronta, riusandone una inattiva o aprendone una nuova.
+
+        Returns:
+            tuple: (_PooledConnection riservata al chiamante, True se già usata in precedenza)
+        """
+        while True:
+            with self._cond:
+                while not self._idle and self._open >= self.size:
+                    self._cond.wait()
+                if self._idle:
+                    # LIFO: la connessione usata più di recente ha meno probabilità di essere scaduta
+                    conn = self._idle.pop()
+                else:
+                    conn = None
+                    self._open += 1
+
+            if conn is None:
+                try:
+                    return self._connect(), False
+                except Exception:
+                    self._release_slot()
+                    raise
+
+            if self._usable(conn):
+                SMTP_CONNECTION_EVENTS.inc(event='reuse')
+                return conn, True
+            self._discard(conn)
+
+    def _usable(self, conn):
+        """Verifica che una connessione inattiva possa essere riutilizzata."""
+        idle = time.time() - conn.last_used
+        if idle > self.max_idle:
+            return False
+        if idle <= self.probe_after:
+            return True
+        try:
+            code, _ = conn.smtp.noop()
+        except (smtplib.SMTPException, OSError):
+            code = None
+        if code != 250:
+            SMTP_CONNECTION_EVENTS.inc(event='probe_failed')
+            self.logger.debug(f"NOOP fallito sulla connessione SMTP a {self.host}, la connessione viene sostituita")
+            return False
+        return True
+
+    def _connect(self):
+        """Apre una connessione, esegue STARTTLS e il login."""
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.ehlo()
+            if self.use_starttls:
+                smtp.starttls()
+                smtp.ehlo()
+            if self.username and self.password:
+                smtp.login(self.username, self.password)
+        except Exception:
+            _close_quietly(smtp)
+            raise
+        SMTP_CONNECTION_EVENTS.inc(event='open')
+        self.logger.debug(f"Nuova connessione SMTP a {self.host}:{self.port}")
+        return _PooledConnection(smtp)
+
+    def _checkin(self, conn):
+        """Rimette una connessione nel pool, o la chiude se ha raggiunto il limite di messaggi."""
+        if conn.messages >= self.max_messages or self._closed:
+            self._discard(conn, graceful=True)
+            return
+        conn.last_used = time.time()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def _discard(self, conn, graceful=False):
+        """Chiude una connessione e libera il suo posto nel pool."""
+        if graceful:
+            try:
+                conn.smtp.quit()
+            except Exception:
+                _close_quietly(conn.smtp)
+        else:
+            _close_quietly(conn.smtp)
+        SMTP_CONNECTION_EVENTS.inc(event='close')
+        self._release_slot()
+
+    def _release_slot(self):
+        """Libera un posto nel pool e risveglia un chiamante in attesa."""
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def close(self):
+        """Chiude tutte le connessioni inattive; quelle in uso vengono chiuse al rilascio."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn, graceful=True)
+
+    def stats(self):
+        """
+        Restituisce lo stato del pool.
+
+        Returns:
+            dict: Connessioni aperte, inattive e in uso
+        """
+        with self._cond:
+            return {
+                'open': self._open,
+                'idle': len(self._idle),
+                'busy': self._open - len(self._idle)
+            }
+
+def _close_quietly(smtp):
+    """Chiude il socket di una connessione senza propagare errori."""
+    try:
+        smtp.close()
+    except Exception:
+        pass
+
+class SMTPPoolRegistry:
+    """Pool SMTP per server e credenziali, creati al primo utilizzo."""
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, port, username='', password='', use_starttls=True):
+        """
+        Restituisce il pool per un server e delle credenziali.
+
+        Args:
+            host (str): Server SMTP
+            port (int): Porta del server
+            username (str): Utente per il login
+            password (str): Password per il login
+            use_starttls (bool): Se proteggere la connessione con STARTTLS
+
+        Returns:
+            SMTPConnectionPool: Pool condiviso
+        """
+        # La password entra nella chiave solo come hash: cambiarla crea un nuovo pool
+        secret = hashlib.sha256((password or '').encode('utf-8')).hexdigest()
+        key = (host, int(port), username or '', secret, bool(use_starttls))
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = SMTPConnectionPool(host, int(port), username, password, use_starttls)
+            return pool
+
+    def close_all(self):
+        """Chiude le connessioni di tutti i pool."""
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    def stats(self):
+        """
+        Restituisce lo stato dei pool.
+
+        Returns:
+            dict: "server:porta/utente" → stato del pool
+        """
+        with self._lock:
+            pools = list(self._pools.values())
+        return {f"{pool.host}:{pool.port}/{pool.username or '-'}": pool.stats() for pool in pools}
+
+# Istanza globale del registro dei pool
+smtp_pools = SMTPPoolRegistry()
+
+# Chiude le sessioni con QUIT all'uscita del processo
+atexit.register(smtp_pools.close_all)
+
+def _collect_smtp_metrics():
+    """Connessioni SMTP aperte e inattive per server, per /metrics."""
+    stats = smtp_pools.stats()
+    return [
+        ('smtp_pool_connections', 'gauge', "Connessioni SMTP del pool per server e stato", [
+            ({'server': server, 'state': state}, pool_stats[state])
+            for server, pool_stats in stats.items() for state in ('idle', 'busy')
+        ])
+    ]
+
+metrics.register_collector(_collect_smtp_metrics)
@@ -0,0 +1,262 @@
+"""
+Template Engine
+
+Questo modulo rende i template con segnaposto tra parentesi quadre
+(es. [Nome Azienda], [Categoria], [Nome]). Ogni template viene compilato una
+sola volta in un piano di rendering (sequenza di testo fisso e segnaposto),
+memorizzato per ID e versione del contenuto; i nomi delle categorie sono letti
+da una mappa in memoria. Il rendering non effettua quindi accessi al database.
+"""
+
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Segnaposto riconosciuti: testo breve tra parentesi quadre, su una sola riga
+PLACEHOLDER_RE = re.compile(r'\[([^\[\]\n]{1,40})\]')
+
+# Mittente predefinito per il segnaposto [Nome]
+DEFAULT_SENDER_NAME = "Team C-Recenzione"
+
+# Nome usato quando la categoria dell'azienda non è nota
+DEFAULT_CATEGORY_NAME = "prodotti"
+
+# Numero massimo di piani di rendering conservati
+PLAN_CACHE_SIZE = int(os.environ.get("TEMPLATE_PLAN_CACHE_SIZE", 512))
+
+# Validità (secondi) della mappa delle categorie, per le modifiche fatte da altri processi
+CATEGORY_MAP_TTL = float(os.environ.get("TEMPLATE_CATEGORY_TTL", 300))
+
+def _company_name(company, context):
+    """Nome dell'azienda."""
+    return company.get('name') or ''
+
+def _category_name(company, context):
+    """Nome della categoria dell'azienda."""
+    return context['category_name']
+
+def _sender_name(company, context):
+    """Nome del mittente."""
+    return context['sender_name']
+
+def _products(company, context):
+    """Prodotti dell'azienda."""
+    return company.get('products') or ''
+
+def _website(company, context):
+    """Sito web dell'azienda."""
+    return company.get('website') or ''
+
+# Segnaposto supportati: nome → funzione (company, context) che restituisce il valore
+PLACEHOLDERS = {
+    'Nome Azienda': _company_name,
+    'Categoria': _category_name,
+    'Nome': _sender_name,
+    'Prodotti': _products,
+    'Sito Web': _website
+}
+
+def register_placeholder(name, resolver):
+    """
+    Registra un nuovo segnaposto.
+
+    I piani già compilati vengono scartati, perché il segnaposto potrebbe
+    comparire in template compilati prima della registrazione.
+
+    Args:
+        name (str): Nome del segnaposto, senza parentesi quadre
+        resolver (callable): Funzione (company, context) che restituisce il testo
+    """
+    PLACEHOLDERS[name] = resolver
+    template_engine.clear()
+
+class RenderPlan:
+    """Template compilato: frammenti di testo fisso alternati a segnaposto."""
+
+    __slots__ = ('version', 'parts', 'placeholders')
+
+    def __init__(self, content):
+        """
+        Compila il contenuto di un template.
+
+        Args:
+            content (str): Testo del template
+        """
+        self.version = hashlib.md5(content.encode('utf-8')).hexdigest()
+        parts = []
+        position = 0
+        for match in PLACEHOLDER_RE.finditer(content):
+            name = match.group(1).strip()
+            resolver = PLACEHOLDERS.get(name)
+            if resolver is None:
+                # Segnaposto sconosciuto: resta come testo
+                continue
+            parts.append(content[position:match.start()])
+            parts.append(resolver)
+            position = match.end()
+        parts.append(content[position:])
+
+        # Unisce i frammenti di testo consecutivi e rimuove quelli vuoti
+        merged = []
+        for part in parts:
+            if isinstance(part, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += part
+            elif part != '':
+                merged.append(part)
+        self.parts = tuple(merged)
+        self.placeholders = sum(1 for part in self.parts if not isinstance(part, str))
+
+    def render(self, company, context):
+        """
+        Rende il template per un'azienda.
+
+        Args:
+            company (dict): Dati dell'azienda
+            context (dict): Valori comuni (nome categoria, mittente)
+
+        Returns:
+            str: Testo con i segnaposto sostituiti
+        """
+        return ''.join(part if isinstance(part, str) else part(company, context) for part in self.parts)
+
+class TemplateEngine:
+    """Compila e rende i template, con cache dei piani e dei nomi delle categorie."""
+
+    def __init__(self, plan_cache_size=PLAN_CACHE_SIZE, category_ttl=CATEGORY_MAP_TTL):
+        """
+        Inizializza il motore.
+
+        Args:
+            plan_cache_size (int): Numero massimo di piani conservati
+            category_ttl (float): Secondi dopo i quali la mappa delle categorie viene riletta
+        """
+        self.logger = logging.getLogger(__name__)
+        self.plan_cache_size = plan_cache_size
+        self.category_ttl = category_ttl
+        self._plans = OrderedDict()
+        self._categories = None
+        self._categories_loaded_at = 0
+        self._lock = threading.Lock()
+
+    def compile(self, template):
+        """
+        Restituisce il piano di rendering di un template, compilandolo se necessario.
+
+        La chiave include l'hash del contenuto: un template modificato produce
+        una nuova versione del piano senza bisogno di invalidazioni esplicite.
+
+        Args:
+            template (dict): Template con 'content' ed eventualmente 'id'
+
+        Returns:
+            RenderPlan: Piano di rendering
+        """
+        content = template['content']
+        key = (template.get('id'), len(content), hash(content))
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+
+        plan = RenderPlan(content)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.plan_cache_size:
+                self._plans.popitem(last=False)
+        self.logger.debug(f"Template {template.get('id')} compilato (versione {plan.version[:8]}, {plan.placeholders} segnaposto)")
+        return plan
+
+    def render(self, template, company, sender_name=DEFAULT_SENDER_NAME, category_name=None):
+        """
+        Rende un template per un'azienda.
+
+        Args:
+            template (dict): Template da rendere
+            company (dict): Dati dell'azienda
+            sender_name (str): Valore del segnaposto [Nome]
+            category_name (str, optional): Nome della categoria; default dalla mappa in memoria
+
+        Returns:
+            str: Testo del messaggio
+        """
+        context = {
+            'category_name': category_name or self.category_name(company.get('category')),
+            'sender_name': sender_name
+        }
+        return self.compile(template).render(company, context)
+
+    def render_many(self, template, companies, sender_name=DEFAULT_SENDER_NAME):
+        """
+        Rende lo stesso template per più aziende (es. una campagna).
+
+        Args:
+            template (dict): Template da rendere
+            companies (list): Lista di dizionari delle aziende
+            sender_name (str): Valore del segnaposto [Nome]
+
+        Returns:
+            list: Testi dei messaggi, nello stesso ordine delle aziende
+        """
+        plan = self.compile(template)
+        categories = self._category_map()
+        results = []
+        for company in companies:
+            context = {
+                'category_name': categories.get(company.get('category'), DEFAULT_CATEGORY_NAME),
+                'sender_name': sender_name
+            }
+            results.append(plan.render(company, context))
+        return results
+
+    def category_name(self, category_id, default=DEFAULT_CATEGORY_NAME):
+        """
+        Restituisce il nome di una categoria dalla mappa in memoria.
+
+        Args:
+            category_id (str): ID della categoria
+            default (str): Valore se la categoria non è nota
+
+        Returns:
+            str: Nome della categoria
+        """
+        if not category_id:
+            return default
+        return self._category_map().get(category_id, default)
+
+    def _category_map(self):
+        """Restituisce la mappa id → nome delle categorie, ricaricandola se scaduta."""
+        categories = self._categories
+        if categories is not None and time.time() - self._categories_loaded_at < self.category_ttl:
+            return categories
+
+        try:
+            from models import Category
+            rows = Category.query.with_entities(Category.id, Category.name).all()
+            categories = {category_id: name for category_id, name in rows}
+        except Exception as e:
+            # Senza contesto applicativo o database si usa l'ultima mappa nota
+            self.logger.debug(f"Mappa delle categorie non aggiornata: {str(e)}")
+            return categories or {}
+
+        with self._lock:
+            self._categories = categories
+            self._categories_loaded_at = time.time()
+        return categories
+
+    def invalidate_categories(self):
+        """Forza la rilettura della mappa delle categorie (da chiamare dopo una modifica)."""
+        with self._lock:
+            self._categories = None
+
+    def clear(self):
+        """Svuota la cache dei piani di rendering."""
+        with self._lock:
+            self._plans.clear()
+
+# Istanza globale del motore di template
+template_engine = TemplateEngine()
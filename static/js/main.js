@@ -53,12 +53,24 @@ function setupEventListeners() {
         generateBtn.addEventListener('click', generateReviewRequest);
     }
     
+    // Generate several variants of the review request
+    const variantsBtn = document.getElementById('generateVariantsBtn');
+    if (variantsBtn) {
+        variantsBtn.addEventListener('click', generateReviewVariants);
+    }
+    
     // Send review request button
     const sendBtn = document.getElementById('sendRequestBtn');
     if (sendBtn) {
         sendBtn.addEventListener('click', sendReviewRequest);
     }
     
+    // Generate and send a campaign to a whole category
+    const campaignBtn = document.getElementById('sendCampaignBtn');
+    if (campaignBtn) {
+        campaignBtn.addEventListener('click', sendCampaign);
+    }
+    
     // Company deletion confirmation
     const deleteCompanyBtns = document.querySelectorAll('.delete-company-btn');
     deleteCompanyBtns.forEach(btn => {
@@ -226,19 +238,65 @@ function generateReviewRequest() {
     
     // Show loading and disable button
     generateBtn.disabled = true;
+    sendBtn.disabled = true;
     loadingIndicator.style.display = 'inline-block';
     messagePreview.innerHTML = '<div class="text-center text-muted">Generazione in corso...</div>';
     previewContainer.style.display = 'block';
+    document.getElementById('variantsContainer').style.display = 'none';
     
-    // Call the API to generate the request
-    fetch('/generate_request', {
+    const finish = () => {
+        // Hide loading and enable button
+        generateBtn.disabled = false;
+        loadingIndicator.style.display = 'none';
+    };
+    
+    // With the job queue enabled the generation runs in the background worker
+    if (generateBtn.dataset.jobQueue === 'true') {
+        enqueueReviewRequest(companySelect.value, templateSelect.value, finish);
+    } else if (window.EventSource) {
+        // Use streaming when the browser supports Server-Sent Events
+        streamReviewRequest(companySelect.value, templateSelect.value, finish);
+    } else {
+        fetchReviewRequest(companySelect.value, templateSelect.value, finish);
+    }
+}
+
+/**
+ * Generate several alternative review requests with a single model call
+ */
+function generateReviewVariants() {
+    const companySelect = document.getElementById('companySelect');
+    const templateSelect = document.getElementById('templateSelect');
+    const messagePreview = document.getElementById('messagePreview');
+    const previewContainer = document.getElementById('previewContainer');
+    const variantsContainer = document.getElementById('variantsContainer');
+    const variantsBtn = document.getElementById('generateVariantsBtn');
+    const sendBtn = document.getElementById('sendRequestBtn');
+    const loadingIndicator = document.getElementById('variantsLoadingIndicator');
+    
+    // Validate selections
+    if (companySelect.value === '' || templateSelect.value === '') {
+        showAlert('Seleziona un\'azienda e un template per generare le varianti.', 'danger');
+        return;
+    }
+    
+    variantsBtn.disabled = true;
+    sendBtn.disabled = true;
+    loadingIndicator.style.display = 'inline-block';
+    variantsContainer.style.display = 'none';
+    variantsContainer.innerHTML = '';
+    messagePreview.innerHTML = '<div class="text-center text-muted">Generazione delle varianti in corso...</div>';
+    previewContainer.style.display = 'block';
+    
+    fetch('/generate_request/variants', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
         },
         body: JSON.stringify({
             company_id: companySelect.value,
-            template_id: templateSelect.value
+            template_id: templateSelect.value,
+            count: parseInt(variantsBtn.dataset.count, 10)
         }),
     })
     .then(response => {
@@ -248,18 +306,26 @@ function generateReviewRequest() {
         return response.json();
     })
     .then(data => {
-        // Display the generated message
-        if (data.message) {
-            messagePreview.innerHTML = formatMessagePreview(data.message);
-            // Store company info for sending
-            messagePreview.dataset.companyId = companySelect.value;
-            messagePreview.dataset.companyName = data.company.name;
-            messagePreview.dataset.companyEmail = data.company.email;
-            
-            // Enable send button
-            sendBtn.disabled = false;
+        // One entry per variant: clicking it moves the text into the preview
+        data.variants.forEach((variant, index) => {
+            const item = document.createElement('button');
+            item.type = 'button';
+            item.className = 'list-group-item list-group-item-action';
+            item.textContent = `Variante ${index + 1}: ${variant.substring(0, 120)}${variant.length > 120 ? '…' : ''}`;
+            item.addEventListener('click', () => {
+                variantsContainer.querySelectorAll('.active').forEach(el => el.classList.remove('active'));
+                item.classList.add('active');
+                showGeneratedMessage(variant, data.company);
+            });
+            variantsContainer.appendChild(item);
+        });
+        variantsContainer.style.display = data.variants.length > 1 ? 'block' : 'none';
+        
+        const first = variantsContainer.querySelector('button');
+        if (first) {
+            first.click();
         } else {
-            messagePreview.innerHTML = '<div class="alert alert-warning">Impossibile generare la richiesta. Riprova più tardi.</div>';
+            showGeneratedMessage(data.variants[0], data.company);
         }
     })
     .catch(error => {
@@ -267,12 +333,181 @@ function generateReviewRequest() {
         messagePreview.innerHTML = `<div class="alert alert-danger">Errore: ${error.message}</div>`;
     })
     .finally(() => {
-        // Hide loading and enable button
-        generateBtn.disabled = false;
+        variantsBtn.disabled = false;
         loadingIndicator.style.display = 'none';
     });
 }
 
+/**
+ * Show the final generated message and enable sending
+ */
+function showGeneratedMessage(message, company) {
+    const messagePreview = document.getElementById('messagePreview');
+    const sendBtn = document.getElementById('sendRequestBtn');
+    
+    if (message) {
+        messagePreview.innerHTML = formatMessagePreview(message);
+        // Store company info for sending
+        messagePreview.dataset.companyId = company.id;
+        messagePreview.dataset.companyName = company.name;
+        messagePreview.dataset.companyEmail = company.email;
+        
+        // Enable send button
+        sendBtn.disabled = false;
+    } else {
+        messagePreview.innerHTML = '<div class="alert alert-warning">Impossibile generare la richiesta. Riprova più tardi.</div>';
+    }
+}
+
+/**
+ * Generate a review request streaming tokens from the server (SSE)
+ */
+function streamReviewRequest(companyId, templateId, onFinish) {
+    const messagePreview = document.getElementById('messagePreview');
+    const params = new URLSearchParams({ company_id: companyId, template_id: templateId });
+    const source = new EventSource(`/generate_request/stream?${params.toString()}`);
+    let streamedText = '';
+    let completed = false;
+    
+    source.addEventListener('token', event => {
+        const data = JSON.parse(event.data);
+        streamedText += data.text;
+        messagePreview.innerHTML = formatMessagePreview(streamedText);
+    });
+    
+    source.addEventListener('done', event => {
+        const data = JSON.parse(event.data);
+        completed = true;
+        source.close();
+        showGeneratedMessage(data.message, data.company);
+        onFinish();
+    });
+    
+    source.addEventListener('error', event => {
+        source.close();
+        if (completed) {
+            return;
+        }
+        completed = true;
+        
+        // Server-side error event carries a message; otherwise the connection failed
+        if (event.data) {
+            const data = JSON.parse(event.data);
+            messagePreview.innerHTML = `<div class="alert alert-danger">Errore: ${data.error}</div>`;
+            onFinish();
+        } else if (!streamedText) {
+            // Streaming not available: fall back to the classic request
+            fetchReviewRequest(companyId, templateId, onFinish);
+        } else {
+            messagePreview.innerHTML = '<div class="alert alert-danger">Errore: connessione interrotta durante la generazione</div>';
+            onFinish();
+        }
+    });
+}
+
+/**
+ * Generate a review request through the background job queue, polling for the result
+ */
+function enqueueReviewRequest(companyId, templateId, onFinish) {
+    const messagePreview = document.getElementById('messagePreview');
+    
+    fetch('/jobs/generate', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+            company_id: companyId,
+            template_id: templateId
+        }),
+    })
+    .then(response => {
+        if (!response.ok) {
+            throw new Error('Errore nella richiesta al server');
+        }
+        return response.json();
+    })
+    .then(data => {
+        messagePreview.innerHTML = '<div class="text-center text-muted">Richiesta in coda...</div>';
+        pollGenerationJob(data.status_url, 1000, onFinish);
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        messagePreview.innerHTML = `<div class="alert alert-danger">Errore: ${error.message}</div>`;
+        onFinish();
+    });
+}
+
+/**
+ * Poll a generation job until it completes, backing off up to 5 seconds
+ */
+function pollGenerationJob(statusUrl, delay, onFinish) {
+    const messagePreview = document.getElementById('messagePreview');
+    
+    setTimeout(() => {
+        fetch(statusUrl)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('Errore nella richiesta al server');
+            }
+            return response.json();
+        })
+        .then(job => {
+            if (job.status === 'completed') {
+                showGeneratedMessage(job.result, job.company);
+                onFinish();
+            } else if (job.status === 'failed') {
+                messagePreview.innerHTML = `<div class="alert alert-danger">Errore: ${job.error || 'generazione non riuscita'}</div>`;
+                onFinish();
+            } else {
+                const label = job.status === 'running' ? 'Generazione in corso' : 'Richiesta in coda';
+                const attempt = job.attempts > 1 ? ` (tentativo ${job.attempts}/${job.max_attempts})` : '';
+                messagePreview.innerHTML = `<div class="text-center text-muted">${label}${attempt}...</div>`;
+                pollGenerationJob(statusUrl, Math.min(delay * 1.5, 5000), onFinish);
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            messagePreview.innerHTML = `<div class="alert alert-danger">Errore: ${error.message}</div>`;
+            onFinish();
+        });
+    }, delay);
+}
+
+/**
+ * Generate a review request with a single (non-streaming) call
+ */
+function fetchReviewRequest(companyId, templateId, onFinish) {
+    const messagePreview = document.getElementById('messagePreview');
+    
+    // Call the API to generate the request
+    fetch('/generate_request', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+            company_id: companyId,
+            template_id: templateId
+        }),
+    })
+    .then(response => {
+        if (!response.ok) {
+            throw new Error('Errore nella richiesta al server');
+        }
+        return response.json();
+    })
+    .then(data => {
+        // Display the generated message
+        showGeneratedMessage(data.message, data.company);
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        messagePreview.innerHTML = `<div class="alert alert-danger">Errore: ${error.message}</div>`;
+    })
+    .finally(onFinish);
+}
+
 /**
  * Format message preview with proper styling
  */
@@ -328,7 +563,7 @@ function sendReviewRequest() {
     })
     .then(data => {
         if (data.success) {
-            showAlert('Richiesta inviata con successo!', 'success');
+            showAlert(data.message || 'Richiesta accodata per l\'invio', 'success');
             
             // Reset form
             document.getElementById('companySelect').selectedIndex = 0;
@@ -351,6 +586,148 @@ function sendReviewRequest() {
     });
 }
 
+/**
+ * Read a streamed NDJSON response, calling onItem for every line
+ */
+async function readNdjson(response, onItem) {
+    if (!response.ok) {
+        const data = await response.json().catch(() => ({}));
+        throw new Error(data.error || 'Errore nella richiesta al server');
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.filter(line => line.trim()).forEach(line => onItem(JSON.parse(line)));
+        if (done) {
+            break;
+        }
+    }
+    if (buffer.trim()) {
+        onItem(JSON.parse(buffer));
+    }
+}
+
+/**
+ * Generate the messages for every company of the selected category
+ * (one generation per cluster of similar companies), then send them
+ * as a campaign showing the progress
+ */
+async function sendCampaign() {
+    const categorySelect = document.getElementById('categoryFilterDashboard');
+    const templateSelect = document.getElementById('templateSelect');
+    const campaignBtn = document.getElementById('sendCampaignBtn');
+    const loadingIndicator = document.getElementById('campaignLoadingIndicator');
+    const progress = document.getElementById('campaignProgress');
+    const progressBar = document.getElementById('campaignProgressBar');
+    const status = document.getElementById('campaignStatus');
+    
+    if (categorySelect.value === '' || templateSelect.value === '') {
+        showAlert('Seleziona una categoria e un template per la campagna.', 'danger');
+        return;
+    }
+    
+    const total = document.querySelectorAll(`#companySelect option[data-category="${categorySelect.value}"]`).length;
+    if (!confirm(`Generare e inviare la richiesta a ${total} aziende della categoria selezionata?`)) {
+        return;
+    }
+    
+    const setProgress = (done, label, of = total) => {
+        const percent = of ? Math.round(done / of * 100) : 100;
+        progressBar.style.width = `${percent}%`;
+        progressBar.textContent = `${percent}%`;
+        status.textContent = label;
+    };
+    
+    campaignBtn.disabled = true;
+    loadingIndicator.style.display = 'inline-block';
+    progress.style.display = 'flex';
+    setProgress(0, 'Generazione dei messaggi in corso...');
+    
+    try {
+        // Step 1: generate the messages (streamed as they are ready)
+        const items = [];
+        const generated = await fetch('/generate_requests_batch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                template_id: templateSelect.value,
+                category_id: categorySelect.value,
+                mode: 'cluster'
+            }),
+        });
+        await readNdjson(generated, result => {
+            if (result.success) {
+                items.push({ company_id: result.company_id, message: result.message });
+            }
+            setProgress(items.length, `Messaggi generati: ${items.length} di ${total}`);
+        });
+        if (!items.length) {
+            throw new Error('Nessun messaggio generato');
+        }
+        
+        // Step 2: queue the campaign (the worker sends the emails)
+        setProgress(0, 'Accodamento in corso...');
+        const response = await fetch('/send_campaign', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                items: items,
+                template_id: templateSelect.value,
+                subject: 'Richiesta di recensione prodotto - C-Recenzione'
+            }),
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Errore durante l\'accodamento della campagna');
+        }
+        showAlert(data.message, 'success');
+        
+        // Step 3: follow the delivery until every message is sent or failed
+        await pollCampaignProgress(data.progress_url, data.request_ids, (sent, failed, retrying) => {
+            const retry = retrying ? `, ${retrying} in attesa di nuovo tentativo` : '';
+            const failures = failed ? `, ${failed} fallite` : '';
+            setProgress(sent + failed, `Email inviate: ${sent} di ${data.queued}${failures}${retry}`, data.queued);
+        });
+    } catch (error) {
+        console.error('Error:', error);
+        status.textContent = '';
+        showAlert(`Errore: ${error.message}`, 'danger');
+    } finally {
+        campaignBtn.disabled = false;
+        loadingIndicator.style.display = 'none';
+    }
+}
+
+/**
+ * Poll the delivery progress of a queued campaign until no message is
+ * waiting to be sent, backing off up to 5 seconds
+ */
+async function pollCampaignProgress(progressUrl, requestIds, onProgress) {
+    let delay = 1000;
+    while (true) {
+        const response = await fetch(progressUrl, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ request_ids: requestIds }),
+        });
+        if (!response.ok) {
+            throw new Error('Errore nella richiesta al server');
+        }
+        const progress = await response.json();
+        onProgress(progress.sent, progress.failed, progress.retrying);
+        if (progress.done >= progress.total) {
+            return progress;
+        }
+        await new Promise(resolve => setTimeout(resolve, delay));
+        delay = Math.min(delay * 1.5, 5000);
+    }
+}
+
 /**
  * Confirm company deletion
  */
@@ -0,0 +1,100 @@
+"""
+Test del pool SMTP contro un server aiosmtpd locale (pip install aiosmtpd).
+"""
+
+import socket
+import smtplib
+import threading
+from email.mime.text import MIMEText
+
+import pytest
+
+pytest.importorskip('aiosmtpd')
+
+from aiosmtpd.controller import Controller
+from tools.bench_smtp import _free_port
+from services.smtp_pool import SMTPConnectionPool
+
+REJECTED = 'rifiutato@example.com'
+
+class RejectingHandler:
+    """Handler che rifiuta REJECTED con 550 e conta EHLO, RCPT e messaggi."""
+
+    def __init__(self):
+        self.ehlo = 0
+        self.rcpt = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        with self._lock:
+            self.ehlo += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        with self._lock:
+            self.rcpt += 1
+        if address == REJECTED:
+            return '550 5.1.1 Mailbox unavailable'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        with self._lock:
+            self.messages += 1
+        return '250 Message accepted for delivery'
+
+@pytest.fixture
+def smtp_server():
+    handler = RejectingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=_free_port('127.0.0.1'))
+    controller.start()
+    try:
+        yield handler, controller.port
+    finally:
+        controller.stop()
+
+def _message(recipient):
+    msg = MIMEText('<p>Test</p>', 'html')
+    msg['From'] = 'test@example.com'
+    msg['To'] = recipient
+    msg['Subject'] = 'Test'
+    return msg
+
+def test_rejected_recipient_on_reused_connection_is_not_resent(smtp_server):
+    handler, port = smtp_server
+    pool = SMTPConnectionPool('127.0.0.1', port, use_starttls=False, size=1)
+    try:
+        pool.send_message(_message('ok@example.com'))
+        assert pool.stats() == {'open': 1, 'idle': 1, 'busy': 0}
+
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            pool.send_message(_message(REJECTED))
+
+        # Un solo tentativo sul destinatario, nessuna nuova connessione
+        assert handler.rcpt == 2
+        assert handler.ehlo == 1
+        assert pool.stats() == {'open': 1, 'idle': 1, 'busy': 0}
+
+        # La connessione resta utilizzabile
+        pool.send_message(_message('ok@example.com'))
+        assert handler.messages == 2
+        assert handler.ehlo == 1
+    finally:
+        pool.close()
+
+def test_reused_connection_closed_by_server_is_replaced(smtp_server):
+    handler, port = smtp_server
+    pool = SMTPConnectionPool('127.0.0.1', port, use_starttls=False, size=1)
+    try:
+        pool.send_message(_message('ok@example.com'))
+        # Interruzione del socket: simula una sessione chiusa dal server
+        pool._idle[0].smtp.sock.shutdown(socket.SHUT_RDWR)
+
+        pool.send_message(_message('ok@example.com'))
+        assert handler.messages == 2
+        assert handler.ehlo == 2
+        assert pool.stats()['open'] == 1
+    finally:
+        pool.close()
@@ -0,0 +1 @@
+"""Strumenti di sviluppo: server finti e benchmark."""
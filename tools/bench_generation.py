@@ -0,0 +1,225 @@
+"""
+Benchmark delle generazioni
+
+Misura latenza (p50/p95/p99), throughput e hit ratio della cache AI eseguendo
+richieste concorrenti contro un server KoboldCpp (di default il server finto di
+tools/fake_kobold.py, avviato nello stesso processo).
+
+Modalità:
+    client   chiama direttamente kobold_client.generate_text
+    service  chiama generate_review_request (cache, single-flight, fallback)
+    route    chiama POST /generate_request tramite il test client Flask
+
+Il database e la cache AI usano file temporanei, salvo --keep-env.
+
+Esempi:
+    python -m tools.bench_generation --mode route --requests 500 --concurrency 50 --distinct 20
+    python -m tools.bench_generation --mode client --kobold-url http://gpu1:5001/api/ --concurrency 8
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.fake_kobold import start_fake_kobold, add_config_arguments, config_from_args
+
+def percentile(samples, value):
+    """
+    Calcola un percentile (nearest-rank) da una lista ordinata.
+
+    Args:
+        samples (list): Valori ordinati
+        value (float): Percentile (0-100)
+
+    Returns:
+        float|None: Valore del percentile, o None se la lista è vuota
+    """
+    if not samples:
+        return None
+    index = max(0, min(len(samples) - 1, int(round(value / 100 * len(samples))) - 1))
+    return samples[index]
+
+def _prepare_environment(args, kobold_url):
+    """Configura le variabili d'ambiente prima di importare l'applicazione."""
+    os.environ["KOBOLD_API_URL"] = kobold_url
+    os.environ.setdefault("KOBOLD_POOL_SIZE", str(max(10, args.concurrency)))
+    if not args.keep_env:
+        workdir = tempfile.mkdtemp(prefix='bench-generation-')
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        os.environ["AI_CACHE_PATH"] = os.path.join(workdir, 'ai_cache.sqlite3')
+
+def _seed_data(app, distinct):
+    """
+    Crea una categoria, un template e `distinct` aziende per il benchmark.
+
+    Returns:
+        tuple: (lista di dizionari delle aziende, dizionario del template)
+    """
+    from app import db
+    from models import Category, Company, Template
+
+    with app.app_context():
+        category = Category(name='Benchmark', description='Dati generati dal benchmark')
+        db.session.add(category)
+        db.session.commit()
+
+        template = Template(
+            name='Template Benchmark',
+            category_id=category.id,
+            content="Gentile [Nome Azienda],\n\nvorremmo ricevere una vostra recensione sui prodotti [Categoria].\n\n[Nome]"
+        )
+        companies = [
+            Company(
+                name=f'Azienda Benchmark {index}',
+                email=f'bench{index}@example.com',
+                products='cuffie, altoparlanti, cavi',
+                category_id=category.id
+            )
+            for index in range(distinct)
+        ]
+        db.session.add(template)
+        db.session.add_all(companies)
+        db.session.commit()
+        return [c.to_dict() for c in companies], template.to_dict()
+
+def _cache_counters(ai_cache):
+    """Restituisce (hit, lookup) complessivi della cache a due livelli."""
+    stats = ai_cache.stats()
+    memory = stats['memory']
+    return memory['hits'] + stats['hits'], memory['hits'] + memory['misses']
+
+def run_benchmark(args):
+    """
+    Esegue il benchmark e restituisce il riepilogo.
+
+    Returns:
+        dict: Risultati (latenze in secondi, throughput, cache, statistiche del server)
+    """
+    fake = None
+    kobold_url = args.kobold_url
+    if not kobold_url:
+        fake = start_fake_kobold(config_from_args(args))
+        kobold_url = fake.url
+    _prepare_environment(args, kobold_url)
+
+    # Import dopo la configurazione dell'ambiente
+    from app import app
+    from services.kobold_api import kobold_client
+    from services.ai_service import generate_review_request, ai_cache
+
+    # Il log di debug dell'applicazione falserebbe le misure
+    logging.getLogger().setLevel(logging.WARNING)
+
+    companies, template = _seed_data(app, args.distinct)
+    local = threading.local()
+
+    def call(index):
+        company = companies[index % len(companies)]
+        if args.mode == 'client':
+            kobold_client.generate_text(f"Scrivi una richiesta di recensione per {company['name']}.")
+        elif args.mode == 'service':
+            with app.app_context():
+                generate_review_request(company, template)
+        else:
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = app.test_client()
+            response = client.post('/generate_request', json={'company_id': company['id'], 'template_id': template['id']})
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+
+    def timed(index):
+        start = time.perf_counter()
+        try:
+            call(index)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, str(e)
+
+    # Riscaldamento: connessioni e stato dell'API, esclusi dalle misure
+    kobold_client.update_settings()
+    kobold_client.health_check()
+
+    hits_before, lookups_before = _cache_counters(ai_cache)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(timed, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    hits_after, lookups_after = _cache_counters(ai_cache)
+
+    latencies = sorted(latency for latency, error in results if error is None)
+    errors = [error for _, error in results if error is not None]
+    lookups = lookups_after - lookups_before
+
+    summary = {
+        'mode': args.mode,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'distinct': args.distinct,
+        'kobold_url': kobold_url,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 2) if elapsed else None,
+        'ok': len(latencies),
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None
+        },
+        'cache_hit_ratio': round((hits_after - hits_before) / lookups, 3) if lookups else None,
+        'backends': kobold_client.backend_stats()
+    }
+    if fake is not None:
+        summary['fake_server'] = fake.stats.snapshot()
+        fake.shutdown()
+    return summary
+
+def print_report(summary):
+    """Stampa il riepilogo in forma leggibile."""
+    def ms(value):
+        return f"{value * 1000:.1f} ms" if value is not None else "-"
+
+    print(f"Modalità:        {summary['mode']} ({summary['requests']} richieste, concorrenza {summary['concurrency']}, {summary['distinct']} aziende)")
+    print(f"Server Kobold:   {summary['kobold_url']}")
+    print(f"Durata:          {summary['elapsed']} s")
+    print(f"Throughput:      {summary['throughput']} richieste/s")
+    print(f"Riuscite/errori: {summary['ok']} / {summary['errors']}")
+    for error in summary['error_samples']:
+        print(f"  errore: {error}")
+    latency = summary['latency']
+    print(f"Latenza:         p50 {ms(latency['p50'])}, p95 {ms(latency['p95'])}, p99 {ms(latency['p99'])}, max {ms(latency['max'])}")
+    ratio = summary['cache_hit_ratio']
+    print(f"Hit ratio cache: {f'{ratio * 100:.1f}%' if ratio is not None else '-'}")
+    if 'fake_server' in summary:
+        fake = summary['fake_server']
+        print(f"Server finto:    {fake['generations']} generazioni, {fake['errors']} errori, massimo {fake['max_active']} in parallelo")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark delle generazioni di C-Recenzione")
+    parser.add_argument('--mode', choices=('client', 'service', 'route'), default='route')
+    parser.add_argument('--requests', type=int, default=200, help="Numero totale di richieste")
+    parser.add_argument('--concurrency', type=int, default=10, help="Richieste contemporanee")
+    parser.add_argument('--distinct', type=int, default=20, help="Aziende distinte (determina l'hit ratio atteso)")
+    parser.add_argument('--kobold-url', help="Server Kobold reale; se assente viene avviato il server finto")
+    parser.add_argument('--keep-env', action='store_true', help="Usa il database e la cache configurati invece di file temporanei")
+    parser.add_argument('--json', action='store_true', help="Stampa il riepilogo in JSON")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    summary = run_benchmark(args)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(summary)
+
+if __name__ == "__main__":
+    main()
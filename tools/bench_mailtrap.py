@@ -0,0 +1,160 @@
+"""
+Benchmark dell'invio tramite Mailtrap
+
+Confronta tre modalità contro il server finto di tools/fake_mailtrap.py:
+    unpooled  una richiesta requests.post (connessione nuova) per email, come in origine
+    pooled    una richiesta per email sulla sessione condivisa di email_service
+    batch     send_email_batch: fino a --batch-size email per richiesta
+
+Il ritardo --connect-delay viene applicato dal server ad ogni nuova
+connessione e simula il costo di rete e TLS dell'API remota.
+
+Esempi:
+    python -m tools.bench_mailtrap --messages 500 --concurrency 4
+    python -m tools.bench_mailtrap --mode batch --batch-size 100 --json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.bench_generation import percentile
+from tools.fake_mailtrap import start_fake_mailtrap, add_config_arguments, config_from_args
+
+SUBJECT = 'Benchmark'
+
+def _configure_environment(server, args):
+    """Imposta le variabili d'ambiente lette da email_service (prima dell'import)."""
+    os.environ['MAILTRAP_API_BASE'] = server.url
+    os.environ['MAILTRAP_API_TOKEN'] = 'bench'
+    os.environ['USE_MAILTRAP'] = 'true'
+    # Gli errori devono essere contati, non salvati localmente
+    os.environ['EMAIL_LOCAL_STORAGE'] = 'false'
+    os.environ['MAILTRAP_BATCH_SIZE'] = str(args.batch_size)
+    os.environ['EMAIL_HTTP_POOL_SIZE'] = str(args.concurrency)
+
+def _send_unpooled(url, index):
+    """Invio con una richiesta indipendente, come prima dell'introduzione della sessione."""
+    import requests
+
+    payload = {
+        'from': {'email': 'bench@example.com'},
+        'to': [{'email': f'dest{index}@example.com'}],
+        'subject': SUBJECT,
+        'html': f'<p>Messaggio di prova {index}</p>'
+    }
+    response = requests.post(url, json=payload, headers={'Authorization': 'Bearer bench'})
+    response.raise_for_status()
+
+def run_mode(mode, args, server):
+    """
+    Esegue il benchmark per una modalità.
+
+    Returns:
+        dict: Latenze, throughput, richieste HTTP e connessioni aperte
+    """
+    from services import email_service
+
+    messages = [(f'dest{index}@example.com', f'<p>Messaggio di prova {index}</p>') for index in range(args.messages)]
+    if mode == 'batch':
+        units = [messages[start:start + args.batch_size] for start in range(0, len(messages), args.batch_size)]
+    else:
+        units = [[message] for message in messages]
+
+    def timed(index_unit):
+        index, unit = index_unit
+        start = time.perf_counter()
+        try:
+            if mode == 'unpooled':
+                _send_unpooled(f"{server.url}/api/send/bench", index)
+                failed = 0
+            elif mode == 'pooled':
+                email_service.send_email(unit[0][0], SUBJECT, unit[0][1])
+                failed = 0
+            else:
+                results = email_service.send_email_batch(unit, SUBJECT)
+                failed = sum(1 for result in results if result['status'] == 'failed')
+            return time.perf_counter() - start, len(unit), failed, None
+        except Exception as e:
+            return time.perf_counter() - start, len(unit), len(unit), str(e)
+
+    before = server.stats.snapshot()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(timed, enumerate(units)))
+    elapsed = time.perf_counter() - started
+    after = server.stats.snapshot()
+
+    latencies = sorted(latency for latency, _, _, error in results if error is None)
+    errors = [error for _, _, _, error in results if error is not None]
+    failed = sum(count for _, _, count, _ in results)
+    return {
+        'mode': mode,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(messages) / elapsed, 2) if elapsed else None,
+        'ok': len(messages) - failed,
+        'failed': failed,
+        'error_samples': sorted(set(errors))[:5],
+        'http_requests': after['requests'] - before['requests'],
+        'connections': after['connections'] - before['connections'],
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'max': latencies[-1] if latencies else None
+        }
+    }
+
+def print_report(summary):
+    """Stampa i risultati in forma leggibile."""
+    def ms(value):
+        return f"{value * 1000:.1f} ms" if value is not None else "-"
+
+    print(f"Messaggi: {summary['messages']}, concorrenza {summary['concurrency']}, "
+          f"batch di {summary['batch_size']}, ritardo di connessione {summary['connect_delay']}s")
+    for result in summary['results']:
+        latency = result['latency']
+        print(f"{result['mode']:<9} {result['throughput']:>8} msg/s  p50 {ms(latency['p50'])}, p95 {ms(latency['p95'])}  "
+              f"richieste {result['http_requests']}, connessioni {result['connections']}, falliti {result['failed']}")
+        for error in result['error_samples']:
+            print(f"  errore: {error}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dell'invio tramite Mailtrap con sessione condivisa e batch")
+    parser.add_argument('--mode', choices=('unpooled', 'pooled', 'batch', 'all'), default='all')
+    parser.add_argument('--messages', type=int, default=200, help="Numero di messaggi per modalità")
+    parser.add_argument('--concurrency', type=int, default=4, help="Richieste contemporanee")
+    parser.add_argument('--batch-size', type=int, default=100, help="Messaggi per richiesta in modalità batch")
+    parser.add_argument('--json', action='store_true', help="Stampa il riepilogo in JSON")
+    add_config_arguments(parser)
+    parser.set_defaults(connect_delay=0.02)
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size deve essere almeno 1")
+
+    logging.basicConfig(level=logging.WARNING)
+    server = start_fake_mailtrap(config_from_args(args))
+    _configure_environment(server, args)
+    try:
+        modes = ('unpooled', 'pooled', 'batch') if args.mode == 'all' else (args.mode,)
+        summary = {
+            'messages': args.messages,
+            'concurrency': args.concurrency,
+            'batch_size': args.batch_size,
+            'connect_delay': args.connect_delay,
+            'results': [run_mode(mode, args, server) for mode in modes]
+        }
+    finally:
+        server.shutdown()
+
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(summary)
+
+if __name__ == "__main__":
+    main()
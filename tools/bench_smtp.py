@@ -0,0 +1,226 @@
+"""
+Benchmark dell'invio SMTP
+
+Confronta l'invio con una connessione nuova per ogni email (EHLO, STARTTLS e
+login ad ogni messaggio) con l'invio tramite il pool di services/smtp_pool.py,
+contro un server SMTP locale basato su aiosmtpd (pip install aiosmtpd).
+
+Il ritardo --handshake-delay viene applicato dal server ad ogni EHLO e
+simula il costo di rete e TLS di un server remoto.
+Per provare anche STARTTLS servono un certificato e una chiave (--tls-cert,
+--tls-key); il certificato può essere autofirmato, perché il client non lo verifica.
+
+Esempi:
+    python -m tools.bench_smtp --messages 500 --concurrency 4
+    python -m tools.bench_smtp --mode pooled --handshake-delay 0.05 --tls-cert cert.pem --tls-key key.pem
+"""
+
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import smtplib
+import argparse
+import threading
+from email.mime.text import MIMEText
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.bench_generation import percentile
+
+BENCH_USERNAME = 'bench'
+BENCH_PASSWORD = 'bench'
+
+class CountingHandler:
+    """Handler aiosmtpd che conta connessioni (EHLO) e messaggi ricevuti."""
+
+    def __init__(self, handshake_delay=0.0):
+        self.handshake_delay = handshake_delay
+        self.ehlo = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        with self._lock:
+            self.ehlo += 1
+        if self.handshake_delay:
+            await asyncio.sleep(self.handshake_delay)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        with self._lock:
+            self.messages += 1
+        return '250 Message accepted for delivery'
+
+    def snapshot(self):
+        """Restituisce i contatori correnti."""
+        with self._lock:
+            return {'ehlo': self.ehlo, 'messages': self.messages}
+
+def _free_port(host):
+    """Restituisce una porta TCP libera."""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def start_smtp_server(args):
+    """
+    Avvia il server aiosmtpd in un thread in background.
+
+    Returns:
+        tuple: (controller da fermare con stop(), handler, porta)
+    """
+    try:
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.smtp import AuthResult
+    except ImportError:
+        sys.exit("aiosmtpd non installato: pip install aiosmtpd")
+
+    def authenticator(server, session, envelope, mechanism, auth_data):
+        success = auth_data.login.decode() == BENCH_USERNAME and auth_data.password.decode() == BENCH_PASSWORD
+        return AuthResult(success=success, auth_data=auth_data)
+
+    tls_context = None
+    if args.tls_cert:
+        import ssl
+        tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        tls_context.load_cert_chain(args.tls_cert, args.tls_key)
+
+    handler = CountingHandler(args.handshake_delay)
+    port = _free_port(args.host)
+    controller = Controller(
+        handler, hostname=args.host, port=port, tls_context=tls_context,
+        authenticator=authenticator, auth_require_tls=False
+    )
+    controller.start()
+    return controller, handler, port
+
+def _build_message(index):
+    """Crea il messaggio di prova numero index."""
+    msg = MIMEText(f"<p>Messaggio di prova {index}</p>", 'html')
+    msg['From'] = 'bench@example.com'
+    msg['To'] = f'dest{index}@example.com'
+    msg['Subject'] = f'Benchmark {index}'
+    return msg
+
+def _send_unpooled(host, port, use_starttls, msg):
+    """Invio con una connessione dedicata, come prima dell'introduzione del pool."""
+    with smtplib.SMTP(host, port) as server:
+        if use_starttls:
+            server.starttls()
+        server.login(BENCH_USERNAME, BENCH_PASSWORD)
+        server.send_message(msg)
+
+def run_mode(mode, args, handler, port):
+    """
+    Esegue il benchmark per una modalità (pooled o unpooled).
+
+    Returns:
+        dict: Latenze, throughput e connessioni aperte
+    """
+    from services.smtp_pool import SMTPConnectionPool
+
+    use_starttls = bool(args.tls_cert)
+    pool = None
+    if mode == 'pooled':
+        pool = SMTPConnectionPool(
+            args.host, port, BENCH_USERNAME, BENCH_PASSWORD, use_starttls,
+            size=args.concurrency, max_messages=args.max_messages
+        )
+
+    def timed(index):
+        msg = _build_message(index)
+        start = time.perf_counter()
+        try:
+            if pool is not None:
+                pool.send_message(msg)
+            else:
+                _send_unpooled(args.host, port, use_starttls, msg)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, str(e)
+
+    before = handler.snapshot()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(timed, range(args.messages)))
+    elapsed = time.perf_counter() - started
+    if pool is not None:
+        pool.close()
+    after = handler.snapshot()
+
+    latencies = sorted(latency for latency, error in results if error is None)
+    errors = [error for _, error in results if error is not None]
+    # Con STARTTLS ogni connessione esegue EHLO due volte
+    connections = (after['ehlo'] - before['ehlo']) // (2 if use_starttls else 1)
+    return {
+        'mode': mode,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 2) if elapsed else None,
+        'ok': len(latencies),
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'received': after['messages'] - before['messages'],
+        'connections': connections,
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'max': latencies[-1] if latencies else None
+        }
+    }
+
+def print_report(summary):
+    """Stampa i risultati in forma leggibile."""
+    def ms(value):
+        return f"{value * 1000:.1f} ms" if value is not None else "-"
+
+    print(f"Messaggi: {summary['messages']}, concorrenza {summary['concurrency']}, "
+          f"STARTTLS {'sì' if summary['starttls'] else 'no'}, ritardo EHLO {summary['handshake_delay']}s")
+    for result in summary['results']:
+        latency = result['latency']
+        print(f"{result['mode']:<9} {result['throughput']:>8} msg/s  p50 {ms(latency['p50'])}, p95 {ms(latency['p95'])}  "
+              f"connessioni {result['connections']}, ricevuti {result['received']}, errori {result['errors']}")
+        for error in result['error_samples']:
+            print(f"  errore: {error}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dell'invio SMTP con e senza pool di connessioni")
+    parser.add_argument('--mode', choices=('pooled', 'unpooled', 'both'), default='both')
+    parser.add_argument('--messages', type=int, default=200, help="Numero di messaggi per modalità")
+    parser.add_argument('--concurrency', type=int, default=4, help="Invii contemporanei (e dimensione del pool)")
+    parser.add_argument('--max-messages', type=int, default=100, help="Messaggi per connessione del pool")
+    parser.add_argument('--handshake-delay', type=float, default=0.02, help="Ritardo del server ad ogni EHLO (secondi)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--tls-cert', help="Certificato per STARTTLS (PEM)")
+    parser.add_argument('--tls-key', help="Chiave del certificato (PEM)")
+    parser.add_argument('--json', action='store_true', help="Stampa il riepilogo in JSON")
+    args = parser.parse_args()
+    if bool(args.tls_cert) != bool(args.tls_key):
+        parser.error("--tls-cert e --tls-key vanno indicati insieme")
+
+    logging.basicConfig(level=logging.WARNING)
+    # Il log di aiosmtpd registra ogni sessione
+    logging.getLogger('mail.log').setLevel(logging.ERROR)
+    controller, handler, port = start_smtp_server(args)
+    try:
+        modes = ('unpooled', 'pooled') if args.mode == 'both' else (args.mode,)
+        summary = {
+            'messages': args.messages,
+            'concurrency': args.concurrency,
+            'starttls': bool(args.tls_cert),
+            'handshake_delay': args.handshake_delay,
+            'results': [run_mode(mode, args, handler, port) for mode in modes]
+        }
+    finally:
+        controller.stop()
+
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(summary)
+
+if __name__ == "__main__":
+    main()
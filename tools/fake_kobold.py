@@ -0,0 +1,315 @@
+"""
+Fake KoboldCpp
+
+Server HTTP che imita l'API di KoboldCpp per i test di carico, senza caricare
+un modello. Latenza, velocità di generazione, tasso di errore e numero di slot
+paralleli sono configurabili.
+
+Endpoint (con o senza il prefisso /api):
+    GET  /health, /v1/model, /extra/true_max_context_length, /fake/stats
+    POST /v1/generate, /extra/generate/stream, /extra/tokencount, /extra/abort
+
+Avvio:
+    python -m tools.fake_kobold --port 5001 --latency 0.2 --tokens-per-sec 30 --slots 1
+"""
+
+import json
+import random
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Parole usate per comporre il testo generato
+WORDS = (
+    "gentile", "azienda", "recensione", "prodotti", "qualità", "clienti", "feedback",
+    "collaborazione", "esperienza", "servizio", "opinione", "grazie", "cordiali", "saluti",
+    "vorremmo", "invitarvi", "valutare", "nostro", "programma", "dettagliata"
+)
+
+class FakeKoboldConfig:
+    """Parametri di comportamento del server finto."""
+
+    def __init__(self, latency=0.1, tokens_per_sec=50.0, output_tokens=120, error_rate=0.0,
+                 slots=1, context_length=4096, model='fake/koboldcpp'):
+        """
+        Inizializza la configurazione.
+
+        Args:
+            latency (float): Secondi prima del primo token (elaborazione del prompt)
+            tokens_per_sec (float): Velocità di generazione (0 = istantanea)
+            output_tokens (int): Token generati per richiesta (limitati da max_length)
+            error_rate (float): Frazione di generazioni che rispondono 503
+            slots (int): Generazioni eseguite in parallelo; le altre attendono in coda
+            context_length (int): Valore restituito da true_max_context_length
+            model (str): Nome del modello restituito da /v1/model
+        """
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.slots = slots
+        self.context_length = context_length
+        self.model = model
+
+class FakeKoboldStats:
+    """Contatori delle richieste ricevute dal server finto."""
+
+    def __init__(self):
+        self.requests = 0
+        self.generations = 0
+        self.errors = 0
+        self.aborted = 0
+        self.active = 0
+        self.max_active = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """Restituisce i contatori correnti."""
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'generations': self.generations,
+                'errors': self.errors,
+                'aborted': self.aborted,
+                'active': self.active,
+                'max_active': self.max_active,
+                'queued': self.queued
+            }
+
+class FakeKoboldHandler(BaseHTTPRequestHandler):
+    """Gestore delle richieste; configurazione e statistiche sono sul server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(f"fake_kobold: {format % args}")
+
+    @property
+    def endpoint(self):
+        """Percorso della richiesta senza il prefisso /api e senza query string."""
+        path = self.path.split('?', 1)[0].strip('/')
+        if path.startswith('api/'):
+            path = path[len('api/'):]
+        return path
+
+    def _read_json(self):
+        """Legge il corpo JSON della richiesta (vuoto se assente o non valido)."""
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _send_json(self, payload, status=200):
+        """Invia una risposta JSON."""
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.stats._lock:
+            server.stats.requests += 1
+
+        if self.endpoint == 'health':
+            self._send_json({'status': 'ok'})
+        elif self.endpoint == 'v1/model':
+            self._send_json({'result': server.config.model})
+        elif self.endpoint == 'extra/true_max_context_length':
+            self._send_json({'value': server.config.context_length})
+        elif self.endpoint == 'fake/stats':
+            self._send_json(server.stats.snapshot())
+        else:
+            self._send_json({'detail': 'Not found'}, status=404)
+
+    def do_POST(self):
+        server = self.server
+        data = self._read_json()
+        with server.stats._lock:
+            server.stats.requests += 1
+
+        if self.endpoint == 'extra/tokencount':
+            # Stima grossolana: un token ogni 4 caratteri
+            self._send_json({'value': len(data.get('prompt', '')) // 4 + 1})
+        elif self.endpoint in ('v1/generate', 'extra/generate/stream'):
+            self._generate(data, stream=self.endpoint == 'extra/generate/stream')
+        elif self.endpoint == 'extra/abort':
+            aborted = server.abort(data.get('genkey'))
+            self._send_json({'success': 'true' if aborted else 'false'})
+        else:
+            self._send_json({'detail': 'Not found'}, status=404)
+
+    def _generate(self, data, stream):
+        """Simula una generazione occupando uno slot per tutta la sua durata."""
+        server = self.server
+        config = server.config
+
+        if config.error_rate and random.random() < config.error_rate:
+            with server.stats._lock:
+                server.stats.errors += 1
+            self._send_json({'detail': 'Server busy'}, status=503)
+            return
+
+        max_length = int(data.get('max_length') or config.output_tokens)
+        # Il parametro "n" (varianti) vale solo per le generazioni non in streaming
+        count = 1 if stream else max(1, int(data.get('n') or 1))
+        outputs = [
+            [random.choice(WORDS) + ' ' for _ in range(min(max_length, config.output_tokens))]
+            for _ in range(count)
+        ]
+        if 'Nome azienda: [Nome Azienda]' in data.get('prompt', ''):
+            # Generazione per gruppi: il testo mantiene il segnaposto del nome
+            for output in outputs:
+                output[0] = 'Gentile [Nome Azienda], '
+        tokens = outputs[0]
+        token_delay = 1.0 / config.tokens_per_sec if config.tokens_per_sec else 0
+        genkey = data.get('genkey')
+        aborted = threading.Event()
+
+        with server.stats._lock:
+            server.stats.queued += 1
+            if genkey:
+                server.generations[genkey] = aborted
+        server.slots.acquire()
+        with server.stats._lock:
+            server.stats.queued -= 1
+            server.stats.active += 1
+            server.stats.generations += 1
+            server.stats.max_active = max(server.stats.max_active, server.stats.active)
+
+        try:
+            # Come KoboldCpp, la generazione prosegue anche se il client si disconnette:
+            # si ferma solo con /extra/abort
+            aborted.wait(config.latency)
+            if stream:
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                for token in tokens:
+                    if aborted.wait(token_delay):
+                        break
+                    event = f"event: message\ndata: {json.dumps({'token': token})}\n\n"
+                    try:
+                        self.wfile.write(event.encode('utf-8'))
+                        self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                self.close_connection = True
+            else:
+                # Le varianti condividono l'elaborazione del prompt: si paga solo la decodifica.
+                # Dopo un abort viene restituito il testo prodotto fino a quel momento
+                produced = 0
+                total = sum(len(output) for output in outputs)
+                while produced < total and not aborted.wait(token_delay):
+                    produced += 1
+                results = []
+                for output in outputs:
+                    results.append({'text': ''.join(output[:produced]).strip()})
+                    produced = max(0, produced - len(output))
+                self._send_json({'results': results})
+        except (BrokenPipeError, ConnectionResetError):
+            # Il client ha chiuso la connessione prima della risposta
+            self.close_connection = True
+        finally:
+            with server.stats._lock:
+                server.stats.active -= 1
+                if genkey:
+                    server.generations.pop(genkey, None)
+            server.slots.release()
+
+class FakeKoboldServer(ThreadingHTTPServer):
+    """Server HTTP multi-thread con configurazione, slot e statistiche condivisi."""
+
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, FakeKoboldHandler)
+        self.config = config
+        self.stats = FakeKoboldStats()
+        self.slots = threading.Semaphore(max(1, config.slots))
+        self.generations = {}
+
+    def abort(self, genkey):
+        """
+        Interrompe la generazione con la genkey indicata.
+
+        Returns:
+            bool: True se la generazione era in corso
+        """
+        with self.stats._lock:
+            aborted = self.generations.get(genkey)
+            if aborted is None:
+                return False
+            self.stats.aborted += 1
+        aborted.set()
+        return True
+
+    @property
+    def url(self):
+        """URL base da usare come kobold_api_url."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/"
+
+def start_fake_kobold(config=None, host='127.0.0.1', port=0):
+    """
+    Avvia il server finto in un thread in background.
+
+    Args:
+        config (FakeKoboldConfig, optional): Configurazione (default valori predefiniti)
+        host (str): Indirizzo di ascolto
+        port (int): Porta (0 = porta libera scelta dal sistema)
+
+    Returns:
+        FakeKoboldServer: Il server avviato (chiamare shutdown() per fermarlo)
+    """
+    server = FakeKoboldServer((host, port), config or FakeKoboldConfig())
+    thread = threading.Thread(target=server.serve_forever, name='fake-kobold', daemon=True)
+    thread.start()
+    return server
+
+def add_config_arguments(parser):
+    """Aggiunge a un parser le opzioni di configurazione del server finto."""
+    parser.add_argument('--latency', type=float, default=0.1, help="Secondi prima del primo token")
+    parser.add_argument('--tokens-per-sec', type=float, default=50.0, help="Token generati al secondo (0 = istantaneo)")
+    parser.add_argument('--output-tokens', type=int, default=120, help="Token generati per richiesta")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Frazione di generazioni con risposta 503")
+    parser.add_argument('--slots', type=int, default=1, help="Generazioni eseguite in parallelo")
+    parser.add_argument('--context-length', type=int, default=4096, help="Lunghezza del contesto del modello")
+
+def config_from_args(args):
+    """Crea la configurazione dalle opzioni della riga di comando."""
+    return FakeKoboldConfig(
+        latency=args.latency,
+        tokens_per_sec=args.tokens_per_sec,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        slots=args.slots,
+        context_length=args.context_length
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Server KoboldCpp finto per i test di carico")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeKoboldServer((args.host, args.port), config_from_args(args))
+    logging.info(f"Fake KoboldCpp in ascolto su {server.url} ({args.slots} slot)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
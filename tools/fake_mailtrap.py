@@ -0,0 +1,267 @@
+"""
+Fake Mailtrap
+
+Server HTTP che imita l'API di invio di Mailtrap per i test e i benchmark,
+senza spedire email. Latenza per richiesta e per messaggio, ritardo di
+apertura della connessione (costo di rete e TLS di un server remoto), tasso
+di errore e tasso di messaggi rifiutati sono configurabili.
+
+Endpoint:
+    POST /api/send/<inbox>, /api/batch/<inbox>   (anche senza <inbox>)
+    GET  /fake/stats
+
+Per usarlo con l'applicazione:
+    MAILTRAP_API_BASE=http://127.0.0.1:8025 MAILTRAP_API_TOKEN=test
+
+Avvio:
+    python -m tools.fake_mailtrap --port 8025 --latency 0.05 --connect-delay 0.05
+"""
+
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FakeMailtrapConfig:
+    """Parametri di comportamento del server finto."""
+
+    def __init__(self, latency=0.02, per_message_latency=0.0, connect_delay=0.0,
+                 error_rate=0.0, reject_rate=0.0, batch_limit=500):
+        """
+        Inizializza la configurazione.
+
+        Args:
+            latency (float): Secondi di elaborazione di ogni richiesta
+            per_message_latency (float): Secondi aggiuntivi per ogni messaggio di un batch
+            connect_delay (float): Secondi di attesa all'apertura di ogni connessione
+            error_rate (float): Frazione di richieste che rispondono 503
+            reject_rate (float): Frazione di messaggi di un batch rifiutati singolarmente
+            batch_limit (int): Messaggi accettati al massimo in un batch (oltre: 422)
+        """
+        self.latency = latency
+        self.per_message_latency = per_message_latency
+        self.connect_delay = connect_delay
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.batch_limit = batch_limit
+
+class FakeMailtrapStats:
+    """Contatori delle richieste ricevute dal server finto."""
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+        self.sends = 0
+        self.batches = 0
+        self.messages = 0
+        self.rejected = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """Restituisce i contatori correnti."""
+        with self._lock:
+            return {
+                'connections': self.connections,
+                'requests': self.requests,
+                'sends': self.sends,
+                'batches': self.batches,
+                'messages': self.messages,
+                'rejected': self.rejected,
+                'errors': self.errors
+            }
+
+class FakeMailtrapHandler(BaseHTTPRequestHandler):
+    """Gestore delle richieste; un'istanza per connessione (keep-alive)."""
+
+    protocol_version = 'HTTP/1.1'
+    # Intestazioni e corpo sono scritti separatamente: senza TCP_NODELAY, su una
+    # connessione riutilizzata la seconda scrittura attende l'ACK ritardato del client
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        server = self.server
+        with server.stats._lock:
+            server.stats.connections += 1
+        if server.config.connect_delay:
+            time.sleep(server.config.connect_delay)
+
+    def log_message(self, format, *args):
+        logging.debug(f"fake_mailtrap: {format % args}")
+
+    @property
+    def action(self):
+        """Azione richiesta ('send', 'batch', ...) dal percorso /api/<azione>/<inbox>."""
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        if len(parts) >= 2 and parts[0] == 'api':
+            return parts[1]
+        return '/'.join(parts)
+
+    def _read_json(self):
+        """Legge il corpo JSON della richiesta (None se non valido)."""
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(body) if body else {}
+        except ValueError:
+            return None
+
+    def _send_json(self, payload, status=200):
+        """Invia una risposta JSON."""
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.action == 'fake/stats':
+            self._send_json(self.server.stats.snapshot())
+        else:
+            self._send_json({'errors': ['Not found']}, status=404)
+
+    def do_POST(self):
+        server = self.server
+        config = server.config
+        data = self._read_json()
+        with server.stats._lock:
+            server.stats.requests += 1
+
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self._send_json({'errors': ['Unauthorized']}, status=401)
+            return
+        if data is None:
+            self._send_json({'errors': ['Invalid JSON']}, status=400)
+            return
+        if self.action not in ('send', 'batch'):
+            self._send_json({'errors': ['Not found']}, status=404)
+            return
+        if config.error_rate and random.random() < config.error_rate:
+            with server.stats._lock:
+                server.stats.errors += 1
+            self._send_json({'errors': ['Service unavailable']}, status=503)
+            return
+
+        if self.action == 'send':
+            self._handle_send(data)
+        else:
+            self._handle_batch(data)
+
+    def _handle_send(self, data):
+        """Simula l'invio di un singolo messaggio."""
+        server = self.server
+        if not data.get('to') or not data.get('from'):
+            self._send_json({'success': False, 'errors': ["'to' e 'from' sono obbligatori"]}, status=400)
+            return
+        time.sleep(server.config.latency)
+        with server.stats._lock:
+            server.stats.sends += 1
+            server.stats.messages += 1
+        self._send_json({'success': True, 'message_ids': [str(uuid.uuid4())]})
+
+    def _handle_batch(self, data):
+        """Simula l'invio batch: un esito per ciascuna richiesta, nello stesso ordine."""
+        server = self.server
+        config = server.config
+        requests_list = data.get('requests') or []
+        if not requests_list:
+            self._send_json({'success': False, 'errors': ["'requests' è obbligatorio"]}, status=400)
+            return
+        if len(requests_list) > config.batch_limit:
+            self._send_json({'success': False, 'errors': [f"Massimo {config.batch_limit} messaggi per batch"]}, status=422)
+            return
+
+        time.sleep(config.latency + config.per_message_latency * len(requests_list))
+        base = data.get('base') or {}
+        responses = []
+        for item in requests_list:
+            if not item.get('to') or not (item.get('from') or base.get('from')):
+                responses.append({'success': False, 'errors': ["'to' e 'from' sono obbligatori"]})
+            elif config.reject_rate and random.random() < config.reject_rate:
+                responses.append({'success': False, 'errors': ['Recipient rejected']})
+            else:
+                responses.append({'success': True, 'message_ids': [str(uuid.uuid4())]})
+
+        accepted = sum(1 for response in responses if response['success'])
+        with server.stats._lock:
+            server.stats.batches += 1
+            server.stats.messages += accepted
+            server.stats.rejected += len(responses) - accepted
+        self._send_json({'success': True, 'responses': responses})
+
+class FakeMailtrapServer(ThreadingHTTPServer):
+    """Server HTTP multi-thread con configurazione e statistiche condivise."""
+
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, FakeMailtrapHandler)
+        self.config = config
+        self.stats = FakeMailtrapStats()
+
+    @property
+    def url(self):
+        """URL base da usare come MAILTRAP_API_BASE."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+def start_fake_mailtrap(config=None, host='127.0.0.1', port=0):
+    """
+    Avvia il server finto in un thread in background.
+
+    Args:
+        config (FakeMailtrapConfig, optional): Configurazione (default valori predefiniti)
+        host (str): Indirizzo di ascolto
+        port (int): Porta (0 = porta libera scelta dal sistema)
+
+    Returns:
+        FakeMailtrapServer: Il server avviato (chiamare shutdown() per fermarlo)
+    """
+    server = FakeMailtrapServer((host, port), config or FakeMailtrapConfig())
+    thread = threading.Thread(target=server.serve_forever, name='fake-mailtrap', daemon=True)
+    thread.start()
+    return server
+
+def add_config_arguments(parser):
+    """Aggiunge a un parser le opzioni di configurazione del server finto."""
+    parser.add_argument('--latency', type=float, default=0.02, help="Secondi di elaborazione per richiesta")
+    parser.add_argument('--per-message-latency', type=float, default=0.0, help="Secondi aggiuntivi per messaggio di un batch")
+    parser.add_argument('--connect-delay', type=float, default=0.0, help="Secondi di attesa per ogni nuova connessione")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Frazione di richieste con risposta 503")
+    parser.add_argument('--reject-rate', type=float, default=0.0, help="Frazione di messaggi di un batch rifiutati")
+    parser.add_argument('--batch-limit', type=int, default=500, help="Messaggi accettati al massimo in un batch")
+
+def config_from_args(args):
+    """Crea la configurazione dalle opzioni della riga di comando."""
+    return FakeMailtrapConfig(
+        latency=args.latency,
+        per_message_latency=args.per_message_latency,
+        connect_delay=args.connect_delay,
+        error_rate=args.error_rate,
+        reject_rate=args.reject_rate,
+        batch_limit=args.batch_limit
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Server Mailtrap finto per test e benchmark")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeMailtrapServer((args.host, args.port), config_from_args(args))
+    logging.info(f"Fake Mailtrap in ascolto su {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
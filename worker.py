@@ -0,0 +1,111 @@
+"""
+Worker dei job di generazione e dell'outbox delle email.
+
+Processo separato dal server web che preleva i job accodati nel database ed
+esegue le generazioni tramite l'API Kobold, così i worker gunicorn non restano
+occupati durante le chiamate al modello. Altri thread inviano le email
+accodate nell'outbox (vedi services/outbox_service.py).
+
+Avvio:
+    python worker.py [--concurrency N] [--email-senders N] [--poll-interval SECONDI]
+"""
+
+import os
+import time
+import logging
+import argparse
+import threading
+
+# Importa l'app inizializzata (configurazione, database e modelli)
+from app import app
+from services.job_service import claim_next_job, run_job, requeue_stale_jobs, default_worker_id
+from services.outbox_service import process_outbox_batch, requeue_stale_outbox
+from services.settings_service import get_generation_concurrency
+
+# Intervallo (secondi) tra i controlli dei job abbandonati
+STALE_CHECK_INTERVAL = 60
+
+def _worker_loop(worker_id, poll_interval, stop_event):
+    """Ciclo di un thread: preleva ed esegue job finché non viene fermato."""
+    while not stop_event.is_set():
+        try:
+            with app.app_context():
+                job = claim_next_job(worker_id)
+                if job is not None:
+                    logging.info(f"[{worker_id}] Esecuzione job {job.id} (tentativo {job.attempts}/{job.max_attempts})")
+                    run_job(job)
+                    continue
+        except Exception as e:
+            logging.error(f"[{worker_id}] Errore nel ciclo del worker: {str(e)}")
+
+        # Coda vuota (o errore): attende prima di ricontrollare
+        stop_event.wait(poll_interval)
+
+def _outbox_loop(worker_id, poll_interval, stop_event):
+    """Ciclo di un thread: invia le email dell'outbox a blocchi finché non viene fermato."""
+    while not stop_event.is_set():
+        try:
+            with app.app_context():
+                if process_outbox_batch(worker_id):
+                    continue
+        except Exception as e:
+            logging.error(f"[{worker_id}] Errore nell'invio dell'outbox: {str(e)}")
+
+        # Outbox vuota (o errore): attende prima di ricontrollare
+        stop_event.wait(poll_interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker dei job di generazione di C-Recenzione")
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help="Job eseguiti in parallelo (default: impostazione generation_concurrency)")
+    parser.add_argument('--poll-interval', type=float, default=float(os.environ.get("JOB_POLL_INTERVAL", 1)),
+                        help="Secondi di attesa quando la coda è vuota")
+    parser.add_argument('--email-senders', type=int, default=int(os.environ.get("OUTBOX_SENDERS", 1)),
+                        help="Thread che inviano le email dell'outbox (0 = nessuno)")
+    args = parser.parse_args()
+
+    with app.app_context():
+        concurrency = args.concurrency or get_generation_concurrency()
+
+    base_id = default_worker_id()
+    stop_event = threading.Event()
+    threads = []
+    for index in range(concurrency):
+        thread = threading.Thread(
+            target=_worker_loop,
+            args=(f"{base_id}:{index}", args.poll_interval, stop_event),
+            name=f'job-worker-{index}',
+            daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+
+    for index in range(max(0, args.email_senders)):
+        thread = threading.Thread(
+            target=_outbox_loop,
+            args=(f"{base_id}:outbox-{index}", args.poll_interval, stop_event),
+            name=f'outbox-sender-{index}',
+            daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+
+    logging.info(f"Worker {base_id} avviato con {concurrency} thread e {max(0, args.email_senders)} thread per le email")
+
+    try:
+        while True:
+            with app.app_context():
+                try:
+                    requeue_stale_jobs()
+                    requeue_stale_outbox()
+                except Exception as e:
+                    logging.error(f"Errore nel controllo dei job e delle email abbandonati: {str(e)}")
+            time.sleep(STALE_CHECK_INTERVAL)
+    except KeyboardInterrupt:
+        logging.info("Arresto del worker in corso...")
+        stop_event.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
+if __name__ == "__main__":
+    main()